@@ -0,0 +1,413 @@
+import gzip
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import LOGGING_CONFIG
+from toolrunner import exec_cmd
+from tracing import get_manager
+from utils import admin_password_bound
+from utils import get_backends
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("backup")
+
+#: local directory where OpenDJ writes (uncompressed) backups; only the descriptor
+#: (``backup.info``) is kept once archives are shipped, as OpenDJ requires it to take
+#: incremental backups
+STAGING_DIR = "/opt/opendj/bak"
+
+BACKUP_DESCRIPTOR = "backup.info"
+
+CHUNK_SIZE = 1024 * 1024
+
+#: PID file of the running server
+SERVER_PID_FILE = "/opt/opendj/logs/server.pid"
+
+#: (truncated) native name of threads running server tasks, i.e. ``Task Thread 0``
+TASK_THREAD_PREFIX = "Task Thread"
+
+#: nice value of task threads while backup runs
+BACKUP_TASK_NICE = 19
+
+#: IO scheduling class of task threads while backup runs (``3`` is idle, ``0`` follows nice value)
+BACKUP_TASK_IO_CLASS = 3
+
+
+def get_backup_dir():
+    return os.environ.get("GLUU_LDAP_BACKUP_DIR", "/opt/opendj/backup")
+
+
+def parse_size(value):
+    """Parse size, i.e. ``512K``, ``50M``, ``1G`` into bytes.
+    """
+    value = str(value).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value or 0))
+    except ValueError:
+        return 0
+
+
+def get_backup_rate():
+    return parse_size(os.environ.get("GLUU_LDAP_BACKUP_RATE", "0"))
+
+
+def get_backup_full_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_BACKUP_FULL_INTERVAL", 604800))
+        if interval < 0:
+            interval = 604800
+    except ValueError:
+        interval = 604800
+    return interval
+
+
+def get_backup_compress_level():
+    try:
+        level = int(os.environ.get("GLUU_LDAP_BACKUP_COMPRESS_LEVEL", 6))
+        if level not in range(1, 10):
+            level = 6
+    except ValueError:
+        level = 6
+    return level
+
+
+class Throttle:
+    """Limit throughput (in bytes per second) shared by all concurrent streams.
+
+    A rate of ``0`` disables throttling.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_slot)
+            self._next_slot = start + nbytes / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def compress_file(src, dest, throttle, level):
+    """Stream ``src`` into gzip-compressed ``dest``.
+
+    Returns SHA-256 checksum and size of the uncompressed content.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp = f"{dest}.tmp"
+
+    with open(src, "rb") as fr, gzip.open(tmp, "wb", compresslevel=level) as fw:
+        for chunk in iter(lambda: fr.read(CHUNK_SIZE), b""):
+            throttle.consume(len(chunk))
+            digest.update(chunk)
+            fw.write(chunk)
+            size += len(chunk)
+
+    os.replace(tmp, dest)
+    return digest.hexdigest(), size
+
+
+def decompress_file(src, dest, throttle):
+    """Stream gzip-compressed ``src`` into ``dest``.
+
+    Returns SHA-256 checksum of the uncompressed content.
+    """
+    digest = hashlib.sha256()
+
+    with gzip.open(src, "rb") as fr:
+        with open(dest, "wb") as fw:
+            for chunk in iter(lambda: fr.read(CHUNK_SIZE), b""):
+                throttle.consume(len(chunk))
+                digest.update(chunk)
+                fw.write(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(backend_dir):
+    try:
+        with open(os.path.join(backend_dir, "manifest.json")) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}}
+
+
+def save_manifest(backend_dir, manifest):
+    path = os.path.join(backend_dir, "manifest.json")
+    with open(f"{path}.tmp", "w") as f:
+        f.write(json.dumps(manifest))
+    os.replace(f"{path}.tmp", path)
+
+
+def get_task_threads():
+    """Get IDs of threads of the running server which run its tasks (i.e. backup).
+    """
+    try:
+        with open(SERVER_PID_FILE) as f:
+            pid = int(f.read().strip())
+        tids = os.listdir(f"/proc/{pid}/task")
+    except (OSError, ValueError):
+        return []
+
+    threads = []
+    for tid in tids:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/comm") as f:
+                if f.read().startswith(TASK_THREAD_PREFIX):
+                    threads.append(int(tid))
+        except OSError:
+            continue
+    return threads
+
+
+def set_thread_nice(tids, nice):
+    for tid in tids:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except OSError:
+            continue
+
+
+def set_thread_io_class(tids, io_class):
+    """Set IO scheduling class of threads; only honored by IO schedulers which
+    support priorities (i.e. BFQ), otherwise disk reads of the task aren't limited.
+    """
+    for tid in tids:
+        out, err, code = exec_cmd(f"ionice -c {io_class} -p {tid}")
+        if code != 0:
+            err = err or out
+            logger.debug(f"Unable to set IO class of thread {tid}; reason={err.decode().strip()}")
+
+
+def run_backup(manager, backend, staging, password_file, incremental=True):
+    """Take a backup of a backend of the running server (using a task).
+
+    Backup is incremental if ``incremental`` is set and there's a previous backup in ``staging``.
+    While the task copies the backend files, threads running server tasks get the
+    lowest CPU priority and idle IO class, so the copy yields to client requests
+    (as far as the IO scheduler honors it); ``GLUU_LDAP_BACKUP_RATE`` only limits
+    compressing the archives afterwards.
+    """
+    incremental = incremental and os.path.isfile(os.path.join(staging, BACKUP_DESCRIPTOR))
+
+    cmd = " ".join([
+        "/opt/opendj/bin/backup",
+        "--hostname localhost",
+        f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+        f"--bindDN '{manager.config.get('ldap_binddn')}'",
+        f"--bindPasswordFile {password_file}",
+        f"--backendID {backend}",
+        f"--backupDirectory {staging}",
+        "--hash",
+        "--incremental" if incremental else "",
+        "--trustAll",
+    ])
+
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(output=exec_cmd(cmd)), daemon=True)
+    worker.start()
+
+    # task threads are started on demand, hence looked up while the task runs
+    reniced = set()
+    try:
+        while worker.is_alive():
+            threads = set(get_task_threads()) - reniced
+            set_thread_nice(threads, BACKUP_TASK_NICE)
+            set_thread_io_class(threads, BACKUP_TASK_IO_CLASS)
+            reniced |= threads
+            worker.join(1)
+    finally:
+        set_thread_nice(reniced, 0)
+        set_thread_io_class(reniced, 0)
+
+    out, err, code = result.get("output", (b"", b"Backup was interrupted", 1))
+    if code:
+        err = err or out
+        logger.warning(f"Unable to backup {backend} backend; reason={err.decode().strip()}")
+        return False
+    return True
+
+
+def prune_staging(staging):
+    """Remove shipped archives; OpenDJ only reads the descriptor to take incremental backups.
+    """
+    for name in os.listdir(staging):
+        path = os.path.join(staging, name)
+        if os.path.isfile(path) and name != BACKUP_DESCRIPTOR:
+            os.unlink(path)
+
+
+def backup_backend(manager, backend, password_file, throttle):
+    staging = os.path.join(STAGING_DIR, backend)
+    backend_dir = os.path.join(get_backup_dir(), backend)
+    os.makedirs(staging, exist_ok=True)
+    os.makedirs(backend_dir, exist_ok=True)
+
+    manifest = load_manifest(backend_dir)
+    full_interval = get_backup_full_interval()
+    # incremental chains grow with each backup, hence a new chain is started periodically
+    full = not manifest.get("full_at") or (full_interval and time.time() - manifest["full_at"] > full_interval)
+    if full:
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+    started_at = time.time()
+    if not run_backup(manager, backend, staging, password_file, incremental=not full):
+        return False
+
+    previous_files = set(manifest["files"])
+    if full:
+        manifest = {"files": {}, "full_at": started_at}
+
+    level = get_backup_compress_level()
+    shipped = 0
+
+    # descriptor goes last, so it never references archives which aren't shipped yet
+    names = sorted(name for name in os.listdir(staging) if os.path.isfile(os.path.join(staging, name)))
+    for name in sorted(names, key=lambda name: name == BACKUP_DESCRIPTOR):
+        path = os.path.join(staging, name)
+        checksum, size = compress_file(path, os.path.join(backend_dir, f"{name}.gz"), throttle, level)
+        manifest["files"][name] = {"sha256": checksum, "size": size}
+        shipped += size
+
+    manifest["updated_at"] = time.time()
+    save_manifest(backend_dir, manifest)
+    prune_staging(staging)
+
+    # archives of the previous chain are only removed once the new full backup is shipped
+    for name in previous_files - set(manifest["files"]):
+        try:
+            os.unlink(os.path.join(backend_dir, f"{name}.gz"))
+        except FileNotFoundError:
+            pass
+
+    kind = "full" if full else "incremental"
+    logger.info(f"Backed up {backend} backend ({kind}, {shipped} bytes shipped) in {time.time() - started_at:.1f} seconds")
+    return True
+
+
+def backup_backends(manager):
+    backends = get_backends()
+    throttle = Throttle(get_backup_rate())
+
+    with admin_password_bound(manager) as password_file:
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            results = list(executor.map(
+                lambda backend: backup_backend(manager, backend, password_file, throttle),
+                backends,
+            ))
+    return all(results)
+
+
+def verify_backend(backend, throttle):
+    backend_dir = os.path.join(get_backup_dir(), backend)
+    manifest = load_manifest(backend_dir)
+
+    if not manifest["files"]:
+        logger.warning(f"Unable to find backup of {backend} backend in {backend_dir}")
+        return False
+
+    valid = True
+    for name, meta in manifest["files"].items():
+        digest = hashlib.sha256()
+        try:
+            with gzip.open(os.path.join(backend_dir, f"{name}.gz"), "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    throttle.consume(len(chunk))
+                    digest.update(chunk)
+        except (OSError, EOFError) as exc:
+            logger.warning(f"Unable to read {name} of {backend} backend; reason={exc}")
+            valid = False
+            continue
+
+        if digest.hexdigest() != meta["sha256"]:
+            logger.warning(f"Checksum mismatch for {name} of {backend} backend")
+            valid = False
+    return valid
+
+
+def restore_backend(backend, throttle):
+    """Restore the latest backup of a backend while the server is stopped.
+    """
+    backend_dir = os.path.join(get_backup_dir(), backend)
+    manifest = load_manifest(backend_dir)
+    if not manifest["files"]:
+        logger.warning(f"Unable to find backup of {backend} backend in {backend_dir}")
+        return False
+
+    restore_dir = os.path.join(STAGING_DIR, "restore", backend)
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    os.makedirs(restore_dir)
+
+    started_at = time.time()
+    for name, meta in manifest["files"].items():
+        checksum = decompress_file(os.path.join(backend_dir, f"{name}.gz"), os.path.join(restore_dir, name), throttle)
+        if checksum != meta["sha256"]:
+            logger.warning(f"Checksum mismatch for {name} of {backend} backend; skipping restore")
+            return False
+
+    out, err, code = exec_cmd(f"/opt/opendj/bin/restore --backupDirectory {restore_dir}")
+    shutil.rmtree(restore_dir, ignore_errors=True)
+    if code:
+        err = err or out
+        logger.warning(f"Unable to restore {backend} backend; reason={err.decode().strip()}")
+        return False
+
+    logger.info(f"Restored {backend} backend in {time.time() - started_at:.1f} seconds")
+    return True
+
+
+def restore_backends(backends=None):
+    """Restore backends concurrently; returns backend IDs that have been restored.
+    """
+    backends = backends or list(get_backends())
+    throttle = Throttle(get_backup_rate())
+
+    with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+        results = dict(zip(backends, executor.map(
+            lambda backend: restore_backend(backend, throttle),
+            backends,
+        )))
+    return [backend for backend, restored in results.items() if restored]
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("backup", "restore", "verify"):
+        print(f"Usage: {sys.argv[0]} backup|restore|verify")
+        sys.exit(1)
+
+    action = sys.argv[1]
+    if action == "backup":
+        ok = backup_backends(get_manager())
+    elif action == "verify":
+        throttle = Throttle(get_backup_rate())
+        with ThreadPoolExecutor() as executor:
+            ok = all(executor.map(lambda backend: verify_backend(backend, throttle), get_backends()))
+    else:
+        ok = bool(restore_backends())
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
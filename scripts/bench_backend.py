@@ -0,0 +1,189 @@
+"""Compare backend engines using a synthetic Gluu-shaped dataset.
+
+Usage (inside a running container):
+
+    python3 /app/scripts/bench_backend.py [--types je,pdb] [--people N] [--clients N] [--tokens N]
+
+For each engine, a temporary backend is created, loaded with generated data, and
+measured for import time, search and modify throughput, latency percentiles, and
+on-disk footprint; the result is printed as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ldap3
+from pygluu.containerlib import get_manager
+
+from bench_entry_cache import percentile
+from dataset import generate_entries
+from dataset import person_dn
+from dataset import write_ldif
+from ldap_pool import new_pool
+from toolrunner import exec_cmd
+from utils import admin_password_bound
+
+BENCH_INDEXES = ["uid", "mail", "inum", "oxAuthClientId", "tknCde", "exp"]
+
+
+def dsconfig(manager, password_file, subcommand):
+    cmd = " ".join([
+        "/opt/opendj/bin/dsconfig",
+        "--trustAll",
+        "--no-prompt",
+        "--hostname localhost",
+        f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+        f"--bindDN '{manager.config.get('ldap_binddn')}'",
+        f"--bindPasswordFile {password_file}",
+        subcommand,
+    ])
+    out, err, code = exec_cmd(cmd)
+    if code:
+        raise RuntimeError((err or out).decode().strip())
+
+
+def import_ldif(manager, password_file, backend, path):
+    cmd = " ".join([
+        "/opt/opendj/bin/import-ldif",
+        "--hostname localhost",
+        f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+        f"--bindDN '{manager.config.get('ldap_binddn')}'",
+        f"--bindPasswordFile {password_file}",
+        f"--backendID {backend}",
+        f"--ldifFile {path}",
+        "--trustAll",
+    ])
+    out, err, code = exec_cmd(cmd)
+    if code:
+        raise RuntimeError((err or out).decode().strip())
+
+
+def add_indexes(conn, backend):
+    for attr in BENCH_INDEXES:
+        conn.add(
+            f"ds-cfg-attribute={attr},cn=Index,ds-cfg-backend-id={backend},cn=Backends,cn=config",
+            attributes={
+                "objectClass": ["top", "ds-cfg-backend-index"],
+                "ds-cfg-attribute": [attr],
+                "ds-cfg-index-type": ["ordering"] if attr == "exp" else ["equality"],
+                "ds-cfg-index-entry-limit": ["4000"],
+            },
+        )
+
+
+def summarize(latencies, elapsed):
+    return {
+        "operations": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def run_workers(new_conn, operation, count, concurrency):
+    """Run ``operation(conn)`` ``count`` times spread across ``concurrency`` connections.
+    """
+    def worker(ops):
+        latencies = []
+        with new_conn() as conn:
+            for _ in range(ops):
+                started_at = time.perf_counter()
+                operation(conn)
+                latencies.append((time.perf_counter() - started_at) * 1000)
+        return latencies
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(worker, [count // concurrency] * concurrency)
+        latencies = [latency for result in results for latency in result]
+    return summarize(latencies, time.perf_counter() - started_at)
+
+
+def get_disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def bench_engine(manager, password_file, new_conn, backend_type, args):
+    backend = f"bench{backend_type}"
+    base_dn = f"o={backend}"
+    result = {"type": backend_type}
+
+    dsconfig(
+        manager, password_file,
+        f"create-backend --backend-name {backend} --set base-dn:{base_dn} --type {backend_type} "
+        f"--set enabled:true --set db-cache-percent:{args.cache_percent}",
+    )
+
+    try:
+        with new_conn() as conn:
+            add_indexes(conn, backend)
+
+        with tempfile.NamedTemporaryFile(suffix=".ldif") as ldif:
+            write_ldif(ldif.name, generate_entries(base_dn, args.people, args.clients, args.tokens))
+            started_at = time.perf_counter()
+            import_ldif(manager, password_file, backend, ldif.name)
+            result["import_seconds"] = time.perf_counter() - started_at
+
+        def search(conn):
+            index = random.randrange(args.people)
+            attr, value = random.choice([("uid", f"user{index}"), ("mail", f"user{index}@example.com")])
+            conn.search(f"ou=people,{base_dn}", f"({attr}={value})", ldap3.SUBTREE, attributes=["*"])
+
+        def lookup_client(conn):
+            index = random.randrange(args.clients)
+            conn.search(f"ou=clients,{base_dn}", f"(oxAuthClientId=client-{index})", ldap3.SUBTREE, attributes=["*"])
+
+        def modify(conn):
+            dn = person_dn(base_dn, random.randrange(args.people))
+            conn.modify(dn, {"oxLastLogonTime": [ldap3.MODIFY_REPLACE, time.strftime("%Y%m%d%H%M%S.000Z", time.gmtime())]})
+
+        result["search_user"] = run_workers(new_conn, search, args.operations, args.concurrency)
+        result["search_client"] = run_workers(new_conn, lookup_client, args.operations, args.concurrency)
+        result["modify_user"] = run_workers(new_conn, modify, args.operations, args.concurrency)
+        result["disk_bytes"] = get_disk_usage(f"/opt/opendj/db/{backend}")
+    finally:
+        dsconfig(manager, password_file, f"delete-backend --backend-name {backend} --force")
+        shutil.rmtree(f"/opt/opendj/db/{backend}", ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare backend engines")
+    parser.add_argument("--types", default="je,pdb", help="Comma-separated backend types")
+    parser.add_argument("--people", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--operations", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cache-percent", type=int, default=5)
+    args = parser.parse_args()
+
+    manager = get_manager()
+    new_conn = new_pool(manager, size=args.concurrency).connection
+
+    results = []
+    with admin_password_bound(manager) as password_file:
+        for backend_type in args.types.split(","):
+            results.append(bench_engine(manager, password_file, new_conn, backend_type.strip(), args))
+
+    print(json.dumps({
+        "dataset": {"people": args.people, "clients": args.clients, "tokens": args.tokens},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
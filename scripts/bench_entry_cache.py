@@ -0,0 +1,120 @@
+"""Measure entry cache hit ratio and search latency of hot entries.
+
+Usage (inside a running container):
+
+    python3 /app/scripts/bench_entry_cache.py [searches]
+
+Hot entries (configuration, clients and scopes) are searched randomly, first
+with the FIFO entry cache disabled and then enabled; the result is printed as JSON.
+"""
+import json
+import random
+import statistics
+import sys
+import time
+
+import ldap3
+from pygluu.containerlib import get_manager
+
+from ldap_pool import get_pool
+
+ENTRY_CACHE_DN = "cn=FIFO,cn=Entry Caches,cn=config"
+
+HOT_SEARCHES = [
+    ("ou=configuration,o=gluu", "(objectClass=*)"),
+    ("ou=clients,o=gluu", "(objectClass=oxAuthClient)"),
+    ("ou=scopes,o=gluu", "(objectClass=oxAuthCustomScope)"),
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def get_hot_dns(conn):
+    dns = []
+    for base, search_filter in HOT_SEARCHES:
+        conn.search(base, search_filter, ldap3.SUBTREE, attributes=["1.1"])
+        dns += [entry.entry_dn for entry in conn.entries]
+    return dns
+
+
+def get_cache_stats(conn):
+    conn.search(
+        "cn=monitor",
+        "(objectClass=ds-entry-cache-monitor-entry)",
+        ldap3.SUBTREE,
+        attributes=["entryCacheHits", "entryCacheTries", "currentEntryCacheCount"],
+    )
+
+    stats = {"hits": 0, "tries": 0, "entries": 0}
+    for entry in conn.entries:
+        attrs = entry.entry_attributes_as_dict
+        stats["hits"] += int((attrs.get("entryCacheHits") or [0])[0])
+        stats["tries"] += int((attrs.get("entryCacheTries") or [0])[0])
+        stats["entries"] += int((attrs.get("currentEntryCacheCount") or [0])[0])
+    return stats
+
+
+def run_searches(conn, dns, count):
+    before = get_cache_stats(conn)
+    latencies = []
+
+    for _ in range(count):
+        dn = random.choice(dns)
+        started_at = time.perf_counter()
+        conn.search(dn, "(objectClass=*)", ldap3.BASE, attributes=["*"])
+        latencies.append((time.perf_counter() - started_at) * 1000)
+
+    after = get_cache_stats(conn)
+    tries = after["tries"] - before["tries"]
+    return {
+        "searches": count,
+        "hit_ratio": (after["hits"] - before["hits"]) / tries if tries else 0.0,
+        "cached_entries": after["entries"],
+        "latency_ms": {
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def set_entry_cache_enabled(conn, enabled):
+    conn.modify(ENTRY_CACHE_DN, {"ds-cfg-enabled": [ldap3.MODIFY_REPLACE, str(enabled).lower()]})
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    manager = get_manager()
+    with get_pool(manager).connection() as conn:
+        dns = get_hot_dns(conn)
+        if not dns:
+            print("Unable to find hot entries; make sure the data has been initialized")
+            sys.exit(1)
+
+        conn.search(ENTRY_CACHE_DN, "(objectClass=*)", ldap3.BASE, attributes=["ds-cfg-enabled"])
+        enabled = str(conn.entries[0]["ds-cfg-enabled"].value).lower() == "true"
+
+        try:
+            set_entry_cache_enabled(conn, False)
+            before = run_searches(conn, dns, count)
+
+            set_entry_cache_enabled(conn, True)
+            # populate the cache before measuring
+            run_searches(conn, dns, len(dns))
+            after = run_searches(conn, dns, count)
+        finally:
+            set_entry_cache_enabled(conn, enabled)
+
+    print(json.dumps({"hot_entries": len(dns), "before": before, "after": after}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
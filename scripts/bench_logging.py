@@ -0,0 +1,139 @@
+"""Measure write latency cost of each setting of access and audit loggers.
+
+Usage (inside a running container, after ``loadgen.py run --seed``):
+
+    python3 /app/scripts/bench_logging.py [--settings sync,async,buffered] [--mix write] [--duration 30] [--output result.json]
+
+For each setting, loggers are reconfigured at runtime and the load of ``loadgen.py``
+is run against the local server; throughput and latency percentiles of each setting
+are printed as JSON. Original settings of the loggers are restored afterwards.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+import ldap3
+from pygluu.containerlib import get_manager
+
+from ldap_pool import new_pool
+from loadgen import add_load_args
+from loadgen import build_result
+from loadgen import parse_mix
+from loadgen import run_load
+from log_profile import ACCESS_LOGGER_DN
+from log_profile import AUDIT_LOGGER_DN
+from log_profile import audit_filtering_mods
+from log_profile import filtering_criteria_entries
+from log_profile import publisher_mods
+
+#: subtrees excluded from audit log by the ``filtered`` setting
+FILTERED_SUBTREES = ["ou=tokens,o=gluu"]
+
+#: attributes of loggers changed by the benchmark
+LOGGER_ATTRS = [
+    "ds-cfg-enabled",
+    "ds-cfg-asynchronous",
+    "ds-cfg-auto-flush",
+    "ds-cfg-buffer-size",
+    "ds-cfg-time-interval",
+    "ds-cfg-filtering-policy",
+]
+
+
+def setting_mods(name):
+    """Get changes of access and audit loggers for setting ``name``.
+    """
+    asynchronous = name in ("async", "buffered", "filtered")
+    buffered = name in ("buffered", "filtered")
+
+    mods = [(AUDIT_LOGGER_DN, "ds-cfg-enabled", str(name != "no-audit").lower(), ldap3.MODIFY_REPLACE)]
+    for dn in (ACCESS_LOGGER_DN, AUDIT_LOGGER_DN):
+        mods += publisher_mods(dn, asynchronous=asynchronous, buffered=buffered)
+    mods += audit_filtering_mods(FILTERED_SUBTREES if name == "filtered" else [])
+    return mods
+
+
+#: settings ordered from the cheapest to the most expensive (expected)
+SETTINGS = ["no-audit", "filtered", "buffered", "async", "sync"]
+
+
+def modify(conn, mods):
+    for dn, attr, value, mod_type in mods:
+        conn.modify(dn, {attr: [(mod_type, value if isinstance(value, list) else [value])]})
+        # deleting an attribute which hasn't been set is a no-op
+        if conn.result["description"] == "noSuchAttribute" and mod_type == ldap3.MODIFY_DELETE:
+            continue
+        if conn.result["description"] != "success":
+            raise RuntimeError(f"Unable to modify {attr} of {dn}; reason={conn.result['message']}")
+
+
+def read_logger_mods(conn):
+    """Get changes restoring current settings of the loggers.
+    """
+    mods = []
+    for dn in (ACCESS_LOGGER_DN, AUDIT_LOGGER_DN):
+        conn.search(dn, "(objectClass=*)", ldap3.BASE, attributes=LOGGER_ATTRS)
+        attrs = conn.entries[0].entry_attributes_as_dict
+        for attr in LOGGER_ATTRS:
+            # missing attributes take their defaults
+            mod_type = ldap3.MODIFY_REPLACE if attrs.get(attr) else ldap3.MODIFY_DELETE
+            mods.append((dn, attr, [str(value) for value in attrs.get(attr, [])], mod_type))
+    return mods
+
+
+def add_criteria(conn):
+    """Add filtering criteria of the ``filtered`` setting; returns DNs of added entries.
+    """
+    added = []
+    # prefix avoids clashing with criteria configured on first installation
+    for dn, attrs in filtering_criteria_entries(AUDIT_LOGGER_DN, FILTERED_SUBTREES, prefix="bench-exclude"):
+        conn.add(dn, attributes=attrs)
+        if conn.result["description"] == "success":
+            added.append(dn)
+        elif conn.result["description"] != "entryAlreadyExists":
+            raise RuntimeError(f"Unable to add {dn}; reason={conn.result['message']}")
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure write latency cost of logger settings")
+    add_load_args(parser)
+    parser.set_defaults(mix="write", connections=32, duration=30)
+    parser.add_argument("--settings", default=",".join(SETTINGS), help=f"Comma-separated settings; any of {', '.join(SETTINGS)}")
+    parser.add_argument("--output", help="Save result as JSON file")
+    args = parser.parse_args()
+
+    settings = [name.strip() for name in args.settings.split(",") if name.strip()]
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        print(f"Unsupported settings: {', '.join(sorted(unknown))}")
+        sys.exit(1)
+
+    mix = parse_mix(args.mix)
+    pool = new_pool(get_manager(), size=args.connections + 1)
+    results = {}
+
+    with pool.connection() as conn:
+        original_mods = read_logger_mods(conn)
+        added = add_criteria(conn)
+        try:
+            for name in settings:
+                modify(conn, setting_mods(name))
+                histograms, elapsed = asyncio.run(run_load(pool, mix, args))
+                results[name] = build_result(mix, args, histograms, elapsed)["total"]
+        finally:
+            modify(conn, original_mods)
+            # parent of criteria is kept if it has other children
+            for dn in reversed(added):
+                conn.delete(dn)
+
+    output = {"mix": mix, "connections": args.connections, "duration": args.duration, "settings": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""Measure replication convergence of several OpenDJ instances on a single host.
+
+Usage (inside a container, against a non-production config/secret store):
+
+    python3 /app/scripts/bench_replication.py [--nodes 3] [--people N] [--clients N] [--tokens N] [--keep]
+
+Each instance is installed from the OpenDJ distribution into its own directory,
+with its own address (``127.0.0.x``) and ports, using the same install and configure
+steps as ``entrypoint.py``. The first instance is loaded with a synthetic dataset,
+then ``ldap_replicator.py`` is started for the other instances, which discover their
+peers from a fake Serf (see ``fake_serf.py``).
+
+Time-to-ready and initialization throughput of each joining instance, and replication
+lag of probe entries written to the first instance under a write load, are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+import ldap3
+from pygluu.containerlib import get_manager
+
+from dataset import generate_entries
+from dataset import token_entry
+from entrypoint import configure_opendj
+from entrypoint import configure_opendj_indexes
+from entrypoint import create_backends
+from entrypoint import install_opendj
+from entrypoint import sync_ldap_certs
+from entrypoint import sync_ldap_pkcs12
+from ldap_pool import new_pool
+from loadgen import Histogram
+from loadgen import MIXES
+from loadgen import run_load
+from template_instance import INSTANCE_PATHS
+from toolrunner import exec_cmd
+from utils import get_backends
+from utils import get_split_backends
+from utils import require_site
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Node:
+    def __init__(self, index, work_dir, port_base):
+        self.index = index
+        self.name = f"127.0.0.{index + 1}"
+        self.dir = os.path.join(work_dir, f"node-{index}")
+        self.password_file = os.path.join(self.dir, ".pw")
+
+        port = port_base + index * 10
+        self.ldap_port = port
+        self.ldaps_port = port + 1
+        self.admin_port = port + 2
+        self.replication_port = port + 3
+
+        self.pool = None
+        self.replicator = None
+
+    def member(self):
+        return {
+            "name": self.name,
+            "addr": f"{self.name}:7946",
+            "tags": {
+                "role": "ldap",
+                "admin_port": str(self.admin_port),
+                "replication_port": str(self.replication_port),
+                "ldaps_port": str(self.ldaps_port),
+                "replication_role": "auto",
+                "zone": "",
+                "replication_server": "false",
+            },
+            "status": "alive",
+        }
+
+
+def copy_distribution(source, dest):
+    def ignore(path, names):
+        if path != source:
+            return []
+        return [name for name in names if name in INSTANCE_PATHS or name.startswith(".")]
+
+    shutil.copytree(source, dest, ignore=ignore, symlinks=True)
+    for name in ("logs", "locks"):
+        os.makedirs(os.path.join(dest, name), exist_ok=True)
+
+
+def setup_node(manager, node, source):
+    """Install, start and configure an instance.
+    """
+    copy_distribution(source, node.dir)
+    manager.secret.to_file("encoded_ox_ldap_pw", node.password_file, decode=True)
+
+    install_opendj(
+        opendj_dir=node.dir,
+        hostname=node.name,
+        ldap_port=node.ldap_port,
+        ldaps_port=node.ldaps_port,
+        admin_port=node.admin_port,
+        password_file=node.password_file,
+    )
+
+    _, err, code = exec_cmd(f"{node.dir}/bin/start-ds --quiet")
+    if code:
+        raise RuntimeError(f"Unable to start instance {node.name}; reason={err.decode().strip()}")
+
+    create_backends(
+        opendj_dir=node.dir,
+        hostname=node.name,
+        admin_port=node.admin_port,
+        password_file=node.password_file,
+    )
+    configure_opendj(host=f"{node.name}:{node.ldaps_port}")
+    configure_opendj_indexes(host=f"{node.name}:{node.ldaps_port}")
+
+
+def stop_node(node):
+    if node.replicator and node.replicator.poll() is None:
+        node.replicator.terminate()
+        node.replicator.wait()
+    exec_cmd(f"{node.dir}/bin/stop-ds --quiet")
+
+
+def required_entries(manager):
+    """Build entries checked by ``ldap_replicator.py`` before replicating a backend.
+    """
+    client_id = manager.config.get("oxauth_client_id")
+    entries = [
+        (f"inum={client_id},ou=clients,o=gluu", {
+            "objectClass": ["top", "oxAuthClient"],
+            "inum": [client_id],
+            "displayName": ["oxAuth Client"],
+        }),
+        ("o=metric", {"objectClass": ["top", "organization"], "o": ["metric"]}),
+        ("ou=statistic,o=metric", {"objectClass": ["top", "organizationalUnit"], "ou": ["statistic"]}),
+    ]
+
+    if require_site():
+        entries += [
+            ("o=site", {"objectClass": ["top", "organization"], "o": ["site"]}),
+            ("ou=cache-refresh,o=site", {"objectClass": ["top", "organizationalUnit"], "ou": ["cache-refresh"]}),
+        ]
+
+    for attrs in get_split_backends().values():
+        ou = attrs["base_dn"].split(",")[0].split("=")[1]
+        entries.append((attrs["base_dn"], {"objectClass": ["top", "organizationalUnit"], "ou": [ou]}))
+    return entries
+
+
+def add_entries(new_conn, entries, concurrency):
+    """Add entries spread across ``concurrency`` connections; existing entries are ignored.
+    """
+    def worker(chunk):
+        with new_conn() as conn:
+            for dn, attrs in chunk:
+                conn.add(dn, attributes=attrs)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, [entries[index::concurrency] for index in range(concurrency)]))
+
+
+def load_source(manager, new_conn, args):
+    entries = list(generate_entries("o=gluu", args.people, args.clients, args.tokens))
+
+    # containers must exist before their children are added
+    add_entries(new_conn, entries[:5] + required_entries(manager), 1)
+    add_entries(new_conn, entries[5:], args.concurrency)
+
+
+def get_entry_counts(conn):
+    """Get number of entries of each base DN.
+    """
+    backends = get_backends()
+    conn.search(
+        "cn=monitor", "(objectClass=ds-backend-monitor-entry)", ldap3.SUBTREE,
+        attributes=["ds-backend-id", "ds-backend-entry-count"],
+    )
+
+    counts = {}
+    for entry in conn.entries:
+        attrs = entry.entry_attributes_as_dict
+        backend = (attrs.get("ds-backend-id") or [""])[0]
+        if backend in backends:
+            counts[backends[backend]] = int((attrs.get("ds-backend-entry-count") or [0])[0])
+    return counts
+
+
+def write_serf_state(work_dir, nodes):
+    state_file = os.path.join(work_dir, "serf.json")
+    with open(state_file, "w") as f:
+        json.dump({"members": [node.member() for node in nodes]}, f)
+
+    # `serf` shim picked up by the replicator via PATH
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    shim = os.path.join(bin_dir, "serf")
+    with open(shim, "w") as f:
+        f.write(f"#!/bin/sh\nexec {sys.executable} {SCRIPTS_DIR}/fake_serf.py \"$@\"\n")
+    os.chmod(shim, 0o755)
+    return state_file, bin_dir
+
+
+def start_replicator(node, state_file, bin_dir, args):
+    env = dict(
+        os.environ,
+        GLUU_OPENDJ_DIR=node.dir,
+        GLUU_SERF_ADVERTISE_ADDR=f"{node.name}:7946",
+        GLUU_LDAP_AUTO_REPLICATE="true",
+        GLUU_LDAP_REPL_CHECK_INTERVAL=str(args.check_interval),
+        # topology watch keeps the replicator running, while readiness is measured by its exit
+        GLUU_LDAP_MAX_REPLICATION_SERVERS="0",
+        FAKE_SERF_STATE=state_file,
+        FAKE_SERF_NODE=node.name,
+        PATH=f"{bin_dir}:{os.environ.get('PATH', '')}",
+    )
+    log = open(os.path.join(node.dir, "logs", "replicator.log"), "w")
+    node.replicator = subprocess.Popen(
+        [sys.executable, f"{SCRIPTS_DIR}/ldap_replicator.py"],
+        env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def wait_for_ready(nodes, new_conn, expected, timeout):
+    """Wait until replicator of each node exits; returns seconds to ready (or ``None``) of each node.
+    """
+    started_at = time.monotonic()
+    ready = {}
+    pending = list(nodes)
+
+    while pending and time.monotonic() - started_at < timeout:
+        for node in list(pending):
+            if node.replicator.poll() is None:
+                continue
+
+            pending.remove(node)
+            with new_conn(node) as conn:
+                converged = get_entry_counts(conn) == expected
+            ready[node.name] = time.monotonic() - started_at if converged else None
+        time.sleep(0.5)
+
+    for node in pending:
+        ready[node.name] = None
+    return ready
+
+
+def measure_lag(source, nodes, new_conn, args):
+    """Write probe entries to ``source`` while running a write load against it, and
+    record time until each probe is visible on other nodes.
+    """
+    histograms = {node.name: Histogram() for node in nodes}
+    load_args = Namespace(
+        connections=args.write_connections, duration=args.lag_duration,
+        base_dn="o=gluu", people=args.people, clients=args.clients,
+    )
+    load_result = {}
+
+    def run_write_load():
+        load_result["histograms"], load_result["elapsed"] = asyncio.run(
+            run_load(source.pool, MIXES["write"], load_args)
+        )
+
+    def wait_for_probe(node, dn, written_at):
+        with new_conn(node) as conn:
+            while time.perf_counter() - written_at < args.lag_timeout:
+                conn.search(dn, "(objectClass=*)", ldap3.BASE, attributes=["1.1"])
+                if conn.entries:
+                    histograms[node.name].record((time.perf_counter() - written_at) * 1000)
+                    return
+                time.sleep(0.005)
+        histograms[node.name].errors += 1
+
+    load = threading.Thread(target=run_write_load)
+    load.start()
+
+    probes = []
+    with new_conn(source) as conn, ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        deadline = time.monotonic() + args.lag_duration
+        index = 0
+        while time.monotonic() < deadline:
+            dn, attrs = token_entry("o=gluu", code=f"probe-{index}")
+            conn.add(dn, attributes=attrs)
+            written_at = time.perf_counter()
+            probes.append(dn)
+
+            list(executor.map(lambda node: wait_for_probe(node, dn, written_at), nodes))
+            index += 1
+            time.sleep(args.lag_interval)
+
+        for dn in probes:
+            conn.delete(dn)
+
+    load.join()
+
+    write_load = Histogram()
+    for histogram in load_result["histograms"].values():
+        write_load.merge(histogram)
+
+    return {
+        "probes": len(probes),
+        "write_load": write_load.to_dict(load_result["elapsed"]),
+        "lag_ms": {
+            name: {
+                "p50": histogram.percentile(50),
+                "p99": histogram.percentile(99),
+                "max": histogram.max,
+                "timeouts": histogram.errors,
+            }
+            for name, histogram in histograms.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure replication convergence of local instances")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--source", default="/opt/opendj", help="OpenDJ distribution to install instances from")
+    parser.add_argument("--work-dir", default="/tmp/ldap-bench")
+    parser.add_argument("--port-base", type=int, default=20000, help="Node N uses ports from port base + N * 10")
+    parser.add_argument("--heap", default="512m", help="Max. heap of each instance")
+    parser.add_argument("--people", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=8, help="Connections used to load the first instance")
+    parser.add_argument("--check-interval", type=int, default=1, help="Replicator check interval in seconds")
+    parser.add_argument("--ready-timeout", type=int, default=1800)
+    parser.add_argument("--write-connections", type=int, default=8)
+    parser.add_argument("--lag-duration", type=int, default=60, help="Duration of lag measurement in seconds")
+    parser.add_argument("--lag-interval", type=float, default=0.5, help="Delay between probes in seconds")
+    parser.add_argument("--lag-timeout", type=float, default=30.0)
+    parser.add_argument("--keep", action="store_true", help="Keep instances running and their files")
+    args = parser.parse_args()
+
+    if args.nodes < 2:
+        parser.error("at least 2 nodes are required")
+
+    manager = get_manager()
+
+    def new_conn(node):
+        return node.pool.connection()
+
+    os.environ.setdefault("OPENDJ_JAVA_ARGS", f"-server -Xmx{args.heap}")
+    sync_ldap_certs()
+    sync_ldap_pkcs12()
+
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+    os.makedirs(args.work_dir)
+    nodes = [Node(index, args.work_dir, args.port_base) for index in range(args.nodes)]
+    for node in nodes:
+        # source serves the loader, write load, and probes at the same time
+        node.pool = new_pool(manager, f"{node.name}:{node.ldaps_port}", size=args.concurrency + args.write_connections + 1)
+    source, joiners = nodes[0], nodes[1:]
+    result = {"nodes": args.nodes}
+
+    try:
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+            list(executor.map(lambda node: setup_node(manager, node, args.source), nodes))
+        result["setup_seconds"] = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        load_source(manager, lambda: new_conn(source), args)
+        with new_conn(source) as conn:
+            expected = get_entry_counts(conn)
+        result["load_seconds"] = time.monotonic() - started_at
+        result["entries"] = expected
+
+        state_file, bin_dir = write_serf_state(args.work_dir, nodes)
+        for node in joiners:
+            start_replicator(node, state_file, bin_dir, args)
+
+        ready = wait_for_ready(joiners, new_conn, expected, args.ready_timeout)
+        total = sum(expected.values())
+        result["time_to_ready"] = ready
+        result["init_throughput"] = {
+            name: total / seconds if seconds else None
+            for name, seconds in ready.items()
+        }
+
+        if all(ready.values()):
+            result["replication"] = measure_lag(source, joiners, new_conn, args)
+    finally:
+        if not args.keep:
+            for node in nodes:
+                stop_node(node)
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Keep the replication changelog within a disk budget.
+
+The replication server keeps changes for ``replication-purge-delay`` (3 days by
+default), hence on write-heavy clusters its changelog grows to many times the
+size of the data. At steady state the changelog size is roughly the write rate
+(in bytes per second) multiplied by the purge delay, so the purge delay is set
+to the budget divided by the observed write rate, within configured bounds.
+
+If free space of the volume drops under ``GLUU_LDAP_CHANGELOG_MIN_FREE_PERCENT``,
+the purge delay is cut to its minimum right away.
+"""
+import logging
+import logging.config
+import os
+import shutil
+import time
+
+from settings import LOGGING_CONFIG
+from toolrunner import exec_cmd
+from tracing import get_manager
+from utils import OPENDJ_DIR
+from utils import admin_password_bound
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("changelog")
+
+CHANGELOG_DIR = f"{OPENDJ_DIR}/changelogDb"
+
+#: purge delay is only changed if it differs by more than this ratio, to avoid reconfiguring on noise
+CHANGE_THRESHOLD = 0.1
+
+#: weight of the latest sample of write rate
+RATE_SMOOTHING = 0.3
+
+#: seconds per unit of durations reported by ``dsconfig``
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def get_changelog_disk_percent():
+    try:
+        percent = float(os.environ.get("GLUU_LDAP_CHANGELOG_DISK_PERCENT", 20))
+        if not 0 < percent <= 100:
+            percent = 20.0
+    except ValueError:
+        percent = 20.0
+    return percent
+
+
+def get_changelog_min_free_percent():
+    try:
+        percent = float(os.environ.get("GLUU_LDAP_CHANGELOG_MIN_FREE_PERCENT", 10))
+        if not 0 <= percent < 100:
+            percent = 10.0
+    except ValueError:
+        percent = 10.0
+    return percent
+
+
+def get_changelog_min_purge_delay():
+    try:
+        hours = int(os.environ.get("GLUU_LDAP_CHANGELOG_MIN_PURGE_DELAY", 6))
+        if hours < 1:
+            hours = 6
+    except ValueError:
+        hours = 6
+    return hours * 3600
+
+
+def get_changelog_max_purge_delay():
+    try:
+        hours = int(os.environ.get("GLUU_LDAP_CHANGELOG_MAX_PURGE_DELAY", 72))
+        if hours < 1:
+            hours = 72
+    except ValueError:
+        hours = 72
+    return max(hours * 3600, get_changelog_min_purge_delay())
+
+
+def get_changelog_check_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_CHANGELOG_CHECK_INTERVAL", 300))
+        if interval < 0:
+            interval = 300
+    except ValueError:
+        interval = 300
+    return interval
+
+
+def get_dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                # removed by purge in the meantime
+                continue
+    return total
+
+
+def parse_duration(value):
+    """Parse duration reported by ``dsconfig`` (i.e. ``3 d`` or ``259200 s``) into seconds,
+    or ``None`` if it can't be parsed.
+    """
+    parts = value.split()
+    try:
+        return int(float(parts[-2]) * DURATION_UNITS[parts[-1]])
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+def get_purge_delay(manager):
+    """Get current purge delay (in seconds), or ``None`` if it can't be read (i.e. the
+    server doesn't run a replication server yet).
+    """
+    with admin_password_bound(manager) as password_file:
+        cmd = " ".join([
+            f"{OPENDJ_DIR}/bin/dsconfig",
+            "get-replication-server-prop",
+            "--provider-name 'Multimaster Synchronization'",
+            "--property replication-purge-delay",
+            "--script-friendly",
+            "--hostname localhost",
+            f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+            f"--bindDN '{manager.config.get('ldap_binddn')}'",
+            f"--bindPasswordFile {password_file}",
+            "--trustAll",
+            "--no-prompt",
+        ])
+        out, err, code = exec_cmd(cmd)
+        if code != 0:
+            err = err or out
+            logger.warning(f"Unable to get replication purge delay; reason={err.decode().strip()}")
+            return None
+        # i.e. ``replication-purge-delay\t3 d``
+        return parse_duration(out.decode())
+
+
+def set_purge_delay(manager, seconds):
+    with admin_password_bound(manager) as password_file:
+        cmd = " ".join([
+            f"{OPENDJ_DIR}/bin/dsconfig",
+            "set-replication-server-prop",
+            "--provider-name 'Multimaster Synchronization'",
+            f"--set replication-purge-delay:{int(seconds)}s",
+            "--hostname localhost",
+            f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+            f"--bindDN '{manager.config.get('ldap_binddn')}'",
+            f"--bindPasswordFile {password_file}",
+            "--trustAll",
+            "--no-prompt",
+        ])
+        out, err, code = exec_cmd(cmd)
+        if code != 0:
+            err = err or out
+            logger.warning(f"Unable to set replication purge delay; reason={err.decode().strip()}")
+        return code == 0
+
+
+class ChangelogController:
+    """Derive purge delay of the replication changelog from disk budget and write rate.
+    """
+
+    def __init__(self, manager, path=CHANGELOG_DIR):
+        self.manager = manager
+        self.path = path
+        # delay tuned before a restart is kept, as it also scales the write rate estimate
+        self.purge_delay = get_purge_delay(manager) if os.path.isdir(path) else None
+        self.rate = None
+        self.last_size = None
+        self.last_at = None
+
+    def estimate_rate(self, size, now):
+        """Estimate write rate (bytes per second) of the changelog.
+
+        Growth between checks is the write rate until purge catches up; afterwards
+        the size divided by the purge delay is. Both underestimate the actual rate,
+        hence the higher one is used.
+        """
+        samples = []
+        if self.last_size is not None and size > self.last_size:
+            samples.append((size - self.last_size) / (now - self.last_at))
+        if self.purge_delay:
+            samples.append(size / self.purge_delay)
+        self.last_size, self.last_at = size, now
+
+        if samples:
+            sample = max(samples)
+            self.rate = sample if self.rate is None else RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate
+        return self.rate
+
+    def plan_purge_delay(self, size, usage):
+        """Get purge delay (in seconds) which keeps the changelog within the budget.
+        """
+        min_delay = get_changelog_min_purge_delay()
+        max_delay = get_changelog_max_purge_delay()
+
+        free_percent = usage.free / usage.total * 100
+        if free_percent < get_changelog_min_free_percent():
+            logger.warning(
+                f"Only {free_percent:.1f}% of changelog volume is free; "
+                f"reducing purge delay to {min_delay} seconds"
+            )
+            return min_delay
+
+        budget = usage.total * get_changelog_disk_percent() / 100
+        if size > budget:
+            logger.warning(f"Changelog size ({size} bytes) exceeds its budget ({int(budget)} bytes)")
+
+        if not self.rate:
+            return self.purge_delay or max_delay
+        return int(min(max(budget / self.rate, min_delay), max_delay))
+
+    def check(self):
+        if not os.path.isdir(self.path):
+            # server doesn't run a replication server (yet)
+            return
+
+        if self.purge_delay is None:
+            self.purge_delay = get_purge_delay(self.manager)
+
+        size = get_dir_size(self.path)
+        usage = shutil.disk_usage(self.path)
+        self.estimate_rate(size, time.monotonic())
+        delay = self.plan_purge_delay(size, usage)
+
+        logger.info(
+            f"Changelog size is {size} bytes ({size / usage.total * 100:.1f}% of volume); "
+            f"write rate is {self.rate or 0:.1f} bytes/s"
+        )
+
+        if self.purge_delay and abs(delay - self.purge_delay) <= self.purge_delay * CHANGE_THRESHOLD:
+            return
+
+        if set_purge_delay(self.manager, delay):
+            logger.info(f"Set replication purge delay to {delay} seconds")
+            self.purge_delay = delay
+
+
+def main():
+    interval = get_changelog_check_interval()
+    if not interval:
+        logger.info("Changelog management is disabled")
+        return
+
+    controller = ChangelogController(get_manager())
+    while True:
+        try:
+            controller.check()
+        except Exception as exc:
+            logger.warning(f"Unable to check replication changelog; reason={exc}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    main()
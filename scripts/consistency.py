@@ -0,0 +1,377 @@
+"""Compare replicas without reinitializing them.
+
+Usage (inside a running container):
+
+    python3 /app/scripts/consistency.py [--base-dn o=gluu] [--peers ldap-1,ldap-2] [--source ldap-0] [--repair] [--output report.json]
+
+Entries of each server are streamed using paged search and hashed into a 2-level
+Merkle tree: a group picked by hash of the subtree right under the base DN (i.e.
+``ou=people,o=gluu``), and a bucket picked by hash of the DN. Digest of a bucket
+is XOR of digests of its entries, hence it doesn't depend on the order of search
+results. Buckets are only allocated once an entry falls in them, and there are
+at most ``SUBTREE_GROUPS`` groups, hence memory is bounded by the number of
+buckets rather than entries (even if the base DN has millions of direct children).
+
+Trees of all servers are built concurrently and compared with the tree of the
+reference (current server, or ``--source``). Only entries of buckets whose
+digests differ are streamed again (at most ``MAX_BUCKETS_PER_PASS`` buckets per
+pass) to find the DNs that differ. Each difference is checked again after
+``--verify-delay`` seconds to skip changes still being replicated, and with
+``--repair``, the peer entry is overwritten by the reference one. Repairs carry
+the replication repair control, so they only apply to the peer instead of being
+replicated back to the topology as new changes.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import logging.config
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import ldap3
+
+from ldap_pool import new_pool
+from ldap_replicator import peers_from_serf_membership
+from settings import LOGGING_CONFIG
+from tracing import get_manager
+from utils import get_backends
+from utils import guess_serf_addr
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("consistency")
+
+PAGE_SIZE = 500
+
+#: number of buckets per group of subtrees
+DEFAULT_BUCKETS = 4096
+
+#: number of groups subtrees right under the base DN are hashed into
+SUBTREE_GROUPS = 16
+
+#: maximum number of buckets whose entries are kept in memory at once
+MAX_BUCKETS_PER_PASS = 1024
+
+#: operational attributes hashed besides user attributes; ``entryUUID`` is kept by replication
+HASHED_OPERATIONAL_ATTRS = ["entryUUID"]
+
+#: hashed attributes which can't be modified; ``entryUUID`` is only kept when adding an entry
+READ_ONLY_ATTRS = {"entryuuid"}
+
+#: OpenDJ replication repair control; operations carrying it are not replicated
+REPLICATION_REPAIR_CONTROL = "1.3.6.1.4.1.26027.1.5.2"
+
+Node = namedtuple("Node", ["name", "pool"])
+
+
+def normalize_dn(dn):
+    return ",".join(part.strip() for part in dn.split(",")).lower()
+
+
+def subtree_of(ndn, base_dn):
+    """Get the (normalized) subtree right under ``base_dn`` which contains ``ndn``.
+    """
+    if ndn == base_dn:
+        return base_dn
+    rdns = ndn[:-len(base_dn) - 1].split(",")
+    return f"{rdns[-1]},{base_dn}"
+
+
+def bucket_of(ndn, buckets):
+    return int.from_bytes(hashlib.sha256(ndn.encode()).digest()[:4], "big") % buckets
+
+
+def hash_entry(ndn, raw_attributes):
+    digest = hashlib.sha256(ndn.encode())
+    for attr in sorted(raw_attributes, key=str.lower):
+        digest.update(b"\0" + attr.lower().encode() + b"\0")
+        for value in sorted(raw_attributes[attr]):
+            digest.update(len(value).to_bytes(4, "big") + value)
+    return digest.digest()
+
+
+def stream_entries(pool, base_dn):
+    """Yield normalized DN, DN, and digest of each entry under ``base_dn``.
+    """
+    with pool.connection() as conn:
+        results = conn.extend.standard.paged_search(
+            base_dn, "(objectClass=*)", ldap3.SUBTREE,
+            attributes=[ldap3.ALL_ATTRIBUTES] + HASHED_OPERATIONAL_ATTRS,
+            paged_size=PAGE_SIZE, generator=True,
+        )
+        for item in results:
+            if item.get("type") != "searchResEntry":
+                continue
+            ndn = normalize_dn(item["dn"])
+            yield ndn, item["dn"], hash_entry(ndn, item["raw_attributes"])
+
+
+class HashTree:
+    """Digests of entries under a base DN, grouped by subtree group and DN bucket.
+    """
+
+    def __init__(self, base_dn, buckets=DEFAULT_BUCKETS):
+        self.base_dn = normalize_dn(base_dn)
+        self.buckets = buckets
+        # sparse, i.e. ``{group: {bucket: digest}}``
+        self.leaves = {}
+        self.entries = 0
+
+    def locate(self, ndn):
+        return bucket_of(subtree_of(ndn, self.base_dn), SUBTREE_GROUPS), bucket_of(ndn, self.buckets)
+
+    def add(self, ndn, digest):
+        group, bucket = self.locate(ndn)
+        leaves = self.leaves.setdefault(group, {})
+        leaves[bucket] = leaves.get(bucket, 0) ^ int.from_bytes(digest, "big")
+        self.entries += 1
+
+    def group_hash(self, group):
+        leaves = self.leaves.get(group)
+        if not leaves:
+            return None
+        # empty buckets (including ones whose digests cancelled out) are left out
+        nodes = "".join(f"{bucket}={leaf:064x};" for bucket, leaf in sorted(leaves.items()) if leaf)
+        return hashlib.sha256(nodes.encode()).hexdigest()
+
+    def root_hash(self):
+        nodes = "".join(f"{group}={self.group_hash(group)};" for group in sorted(self.leaves))
+        return hashlib.sha256(nodes.encode()).hexdigest()
+
+    def diff(self, other):
+        """Get ``(group, bucket)`` pairs whose digests differ from ``other``.
+        """
+        if self.root_hash() == other.root_hash():
+            return set()
+
+        differing = set()
+        for group in set(self.leaves) | set(other.leaves):
+            if self.group_hash(group) == other.group_hash(group):
+                continue
+            mine, theirs = self.leaves.get(group, {}), other.leaves.get(group, {})
+            differing.update(
+                (group, bucket) for bucket in set(mine) | set(theirs)
+                if mine.get(bucket, 0) != theirs.get(bucket, 0)
+            )
+        return differing
+
+
+def build_tree(pool, base_dn, buckets):
+    tree = HashTree(base_dn, buckets)
+    for ndn, _, digest in stream_entries(pool, base_dn):
+        tree.add(ndn, digest)
+    return tree
+
+
+def collect_buckets(pool, base_dn, buckets, wanted):
+    """Get DN and digest of entries in ``wanted`` buckets, keyed by normalized DN.
+    """
+    tree = HashTree(base_dn, buckets)
+    return {
+        ndn: (dn, digest)
+        for ndn, dn, digest in stream_entries(pool, base_dn)
+        if tree.locate(ndn) in wanted
+    }
+
+
+def read_entry(conn, dn):
+    """Get digest and attributes of an entry, or ``None`` if it doesn't exist.
+    """
+    conn.search(dn, "(objectClass=*)", ldap3.BASE, attributes=[ldap3.ALL_ATTRIBUTES] + HASHED_OPERATIONAL_ATTRS)
+    if not conn.response or conn.response[0].get("type") != "searchResEntry":
+        return None
+    raw_attributes = conn.response[0]["raw_attributes"]
+    return hash_entry(normalize_dn(dn), raw_attributes), raw_attributes
+
+
+def find_differences(reference, peers, base_dn, buckets, executor):
+    """Find DNs of entries which differ between ``reference`` and each of ``peers``.
+
+    Returns summary of trees and list of differences.
+    """
+    nodes = [reference] + peers
+    trees = dict(zip(
+        [node.name for node in nodes],
+        executor.map(lambda node: build_tree(node.pool, base_dn, buckets), nodes),
+    ))
+    summary = {name: {"root_hash": tree.root_hash(), "entries": tree.entries} for name, tree in trees.items()}
+
+    differing = {peer.name: trees[reference.name].diff(trees[peer.name]) for peer in peers}
+    all_buckets = sorted(set().union(*differing.values()))
+    del trees
+
+    differences = []
+    for start in range(0, len(all_buckets), MAX_BUCKETS_PER_PASS):
+        wanted = set(all_buckets[start:start + MAX_BUCKETS_PER_PASS])
+        pass_nodes = [reference] + [peer for peer in peers if differing[peer.name] & wanted]
+        collected = dict(zip(
+            [node.name for node in pass_nodes],
+            executor.map(lambda node: collect_buckets(node.pool, base_dn, buckets, wanted), pass_nodes),
+        ))
+
+        tree = HashTree(base_dn, buckets)
+        expected = collected[reference.name]
+        for peer in pass_nodes[1:]:
+            peer_wanted = differing[peer.name] & wanted
+            actual = collected[peer.name]
+            for ndn in set(expected) | set(actual):
+                if tree.locate(ndn) not in peer_wanted:
+                    continue
+                ref_entry, peer_entry = expected.get(ndn), actual.get(ndn)
+                if ref_entry and peer_entry and ref_entry[1] == peer_entry[1]:
+                    continue
+                status = "missing" if not peer_entry else "extra" if not ref_entry else "different"
+                differences.append({"peer": peer.name, "dn": (ref_entry or peer_entry)[0], "status": status})
+    return summary, differences
+
+
+def verify_differences(reference, peers, differences):
+    """Drop differences which no longer exist (i.e. changes which have been replicated meanwhile).
+    """
+    pools = {peer.name: peer.pool for peer in peers}
+    verified = []
+    with reference.pool.connection() as src:
+        for diff in differences:
+            with pools[diff["peer"]].connection() as dst:
+                ref_entry, peer_entry = read_entry(src, diff["dn"]), read_entry(dst, diff["dn"])
+            if ref_entry and peer_entry and ref_entry[0] == peer_entry[0]:
+                continue
+            if not ref_entry and not peer_entry:
+                continue
+            diff["status"] = "missing" if not peer_entry else "extra" if not ref_entry else "different"
+            verified.append(diff)
+    return verified
+
+
+def depth(dn):
+    return len(normalize_dn(dn).split(","))
+
+
+def _entry_uuid(raw_attributes):
+    values = next((values for attr, values in raw_attributes.items() if attr.lower() == "entryuuid"), [])
+    return values[0] if values else None
+
+
+def repair_differences(reference, peers, differences, delete_extra=False):
+    """Overwrite entries of peers with entries of ``reference``.
+
+    Missing entries are added parents first, keeping ``entryUUID`` of the reference;
+    an entry whose ``entryUUID`` differs is deleted and added again. Extra entries
+    (which may be recent writes not yet replicated to the reference) are only deleted
+    if ``delete_extra`` is set, children first.
+
+    Every operation carries the replication repair control, hence it only applies to
+    the peer; otherwise a re-added entry (with a newer change number) would be
+    replicated back to the reference and create naming conflicts across the topology.
+    """
+    pools = {peer.name: peer.pool for peer in peers}
+    ordered = sorted(
+        differences,
+        key=lambda diff: -depth(diff["dn"]) if diff["status"] == "extra" else depth(diff["dn"]),
+    )
+
+    # critical, so a server which doesn't support it rejects the operation instead of replicating it
+    controls = [(REPLICATION_REPAIR_CONTROL, True, None)]
+
+    with reference.pool.connection() as src:
+        for diff in ordered:
+            with pools[diff["peer"]].connection() as dst:
+                if diff["status"] == "extra":
+                    if not delete_extra:
+                        continue
+                    dst.delete(diff["dn"], controls=controls)
+                else:
+                    ref_entry = read_entry(src, diff["dn"])
+                    if not ref_entry:
+                        continue
+                    peer_entry = read_entry(dst, diff["dn"]) if diff["status"] == "different" else None
+
+                    if peer_entry and _entry_uuid(peer_entry[1]) != _entry_uuid(ref_entry[1]):
+                        # a different entry under the same DN; entryUUID can't be modified
+                        dst.delete(diff["dn"], controls=controls)
+                        if dst.result["description"] == "success":
+                            peer_entry = None
+
+                    if not peer_entry:
+                        dst.add(diff["dn"], attributes=ref_entry[1], controls=controls)
+                    else:
+                        attrs = {attr: values for attr, values in ref_entry[1].items() if attr.lower() not in READ_ONLY_ATTRS}
+                        stale = {attr for attr in peer_entry[1] if attr.lower() not in READ_ONLY_ATTRS} - set(ref_entry[1])
+                        changes = {attr: [(ldap3.MODIFY_REPLACE, values)] for attr, values in attrs.items()}
+                        changes.update({attr: [(ldap3.MODIFY_REPLACE, [])] for attr in stale})
+                        dst.modify(diff["dn"], changes, controls=controls)
+
+                diff["repaired"] = dst.result["description"] == "success"
+                if not diff["repaired"]:
+                    logger.warning(f"Unable to repair {diff['dn']} on {diff['peer']}; reason={dst.result['message']}")
+
+
+def get_default_base_dns():
+    """Get base DNs of backends; subordinate backends (i.e. split backends) are
+    already searched under their parent.
+    """
+    base_dns = list(get_backends().values())
+    return [dn for dn in base_dns if not any(dn.endswith(f",{other}") for other in base_dns)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare replicas using Merkle trees of entry digests")
+    parser.add_argument("--base-dn", action="append", help="Base DN to check; can be repeated (default to all backends)")
+    parser.add_argument("--peers", help="Comma-separated Serf names of peers (default to all alive peers)")
+    parser.add_argument("--source", help="Serf name of the reference server (default to current server)")
+    parser.add_argument("--buckets", type=int, default=DEFAULT_BUCKETS, help="Number of DN buckets per group of subtrees")
+    parser.add_argument("--verify-delay", type=int, default=5, help="Seconds to wait before checking differences again")
+    parser.add_argument("--repair", action="store_true", help="Overwrite differing entries of peers with entries of the reference")
+    parser.add_argument("--repair-deletes", action="store_true", help="Also delete entries which don't exist in the reference")
+    parser.add_argument("--output", help="Save report as JSON file")
+    args = parser.parse_args()
+
+    manager = get_manager()
+    current = guess_serf_addr().split(":")[0]
+    members = {member["name"]: member for member in peers_from_serf_membership()}
+
+    def member_node(name):
+        if name not in members:
+            print(f"Unable to find alive peer {name}")
+            sys.exit(1)
+        return Node(name, new_pool(manager, f"{name}:{members[name]['tags']['ldaps_port']}", size=2))
+
+    reference = member_node(args.source) if args.source and args.source != current else Node(current, new_pool(manager, size=2))
+    names = [name.strip() for name in args.peers.split(",")] if args.peers else list(members)
+    peers = [member_node(name) for name in names if name and name not in (current, reference.name)]
+    if reference.name != current and (not args.peers or current in names):
+        peers.append(Node(current, new_pool(manager, size=2)))
+
+    if not peers:
+        print("No peer to compare with")
+        sys.exit(1)
+
+    report = {"reference": reference.name, "peers": [peer.name for peer in peers], "base_dns": {}}
+    consistent = True
+
+    with ThreadPoolExecutor(max_workers=len(peers) + 1) as executor:
+        for base_dn in args.base_dn or get_default_base_dns():
+            started_at = time.monotonic()
+            summary, differences = find_differences(reference, peers, base_dn, args.buckets, executor)
+            if differences:
+                time.sleep(args.verify_delay)
+                differences = verify_differences(reference, peers, differences)
+            if differences and args.repair:
+                repair_differences(reference, peers, differences, delete_extra=args.repair_deletes)
+
+            logger.info(f"Found {len(differences)} differing entries of {base_dn} in {time.monotonic() - started_at:.1f} seconds")
+            report["base_dns"][base_dn] = {"servers": summary, "differences": differences}
+            consistent = consistent and all(diff.get("repaired") for diff in differences)
+
+    report["consistent"] = consistent
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if consistent else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import random
+import string
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+
+def generalized_time(dt):
+    return dt.strftime("%Y%m%d%H%M%S.000Z")
+
+
+def random_text(size=16):
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=size))
+
+
+def person_dn(base_dn, index):
+    return f"inum=person-{index},ou=people,{base_dn}"
+
+
+def person_entry(base_dn, index):
+    return person_dn(base_dn, index), {
+        "objectClass": ["top", "gluuPerson"],
+        "inum": [f"person-{index}"],
+        "uid": [f"user{index}"],
+        "mail": [f"user{index}@example.com"],
+        "cn": [f"User {index}"],
+        "sn": [f"{index}"],
+        "displayName": [f"User {index}"],
+        "gluuStatus": ["active"],
+    }
+
+
+def client_dn(base_dn, index):
+    return f"inum=client-{index},ou=clients,{base_dn}"
+
+
+def client_entry(base_dn, index):
+    return client_dn(base_dn, index), {
+        "objectClass": ["top", "oxAuthClient"],
+        "inum": [f"client-{index}"],
+        "oxAuthClientId": [f"client-{index}"],
+        "displayName": [f"Client {index}"],
+        "oxAuthClientSecret": [random_text(32)],
+        "oxAuthRedirectURI": [f"https://app{index}.example.com/callback"],
+        "oxAuthScope": [f"inum=scope-{n},ou=scopes,{base_dn}" for n in range(3)],
+    }
+
+
+def token_dn(base_dn, code):
+    return f"tknCde={code},ou=tokens,{base_dn}"
+
+
+def token_entry(base_dn, code=None, expires_in=3600, people=1, clients=1):
+    """Build an access token entry, similar to the ones written by oxAuth.
+    """
+    code = code or str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    return token_dn(base_dn, code), {
+        "objectClass": ["top", "token"],
+        "tknCde": [code],
+        "tknTyp": ["access_token"],
+        "grtId": [str(uuid.uuid4())],
+        "clnId": [f"client-{random.randrange(clients)}"],
+        "usrId": [f"user{random.randrange(people)}"],
+        "iat": [generalized_time(now)],
+        "exp": [generalized_time(now + timedelta(seconds=expires_in))],
+        "del": ["true"],
+    }
+
+
+def metric_entry(base_dn="o=metric"):
+    now = datetime.now(timezone.utc)
+    inum = str(uuid.uuid4())
+    return f"uniqueIdentifier={inum},ou=statistic,{base_dn}", {
+        "objectClass": ["top", "oxMetric"],
+        "uniqueIdentifier": [inum],
+        "oxStartDate": [generalized_time(now)],
+        "oxEndDate": [generalized_time(now)],
+        "oxApplicationType": ["oxAuth"],
+        "oxMetricType": ["authentication"],
+        "creationDate": [generalized_time(now)],
+        "exp": [generalized_time(now + timedelta(days=30))],
+        "del": ["true"],
+    }
+
+
+def container_entries(base_dn):
+    """Build entries required to hold generated data.
+    """
+    rdn_attr, rdn_value = base_dn.split(",")[0].split("=")
+    entries = [(base_dn, {"objectClass": ["top", "organization"], rdn_attr: [rdn_value]})]
+
+    for ou in ("people", "clients", "scopes", "tokens"):
+        entries.append((f"ou={ou},{base_dn}", {"objectClass": ["top", "organizationalUnit"], "ou": [ou]}))
+    return entries
+
+
+def generate_entries(base_dn, people, clients, tokens):
+    yield from container_entries(base_dn)
+
+    for index in range(people):
+        yield person_entry(base_dn, index)
+
+    for index in range(clients):
+        yield client_entry(base_dn, index)
+
+    for _ in range(tokens):
+        yield token_entry(base_dn, people=people, clients=clients)
+
+
+def write_ldif(path, entries):
+    with open(path, "w") as f:
+        for dn, attrs in entries:
+            f.write(f"dn: {dn}\n")
+            for attr, values in attrs.items():
+                for value in values:
+                    f.write(f"{attr}: {value}\n")
+            f.write("\n")
@@ -1,35 +1,180 @@
-import contextlib
 # import json
 import logging.config
 import os
+import pathlib
+import sys
+import time
 
-from pygluu.containerlib import get_manager
-from pygluu.containerlib.utils import exec_cmd
+from ldap3.core.exceptions import LDAPException
 
+from ldap_pool import get_pool
+from monitor import probe_latency
+from monitor import read_monitor_entries
+from peer_registry import deregister_serf_peer
 from settings import LOGGING_CONFIG
-from utils import deregister_serf_peer
+from supervisor import READY_MARKER
+from toolrunner import exec_cmd
+from tracing import get_manager
+from utils import DRAIN_MARKER
+from utils import admin_password_bound
 from utils import guess_serf_addr
 
-DEFAULT_ADMIN_PW_PATH = "/opt/opendj/.pw"
-
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("ldap_peer")
 
+#: monitor attributes counting changes not yet exchanged with peers
+OUTSTANDING_CHANGES_ATTRS = ("missing-changes", "pending-updates")
+
+
+def get_drain_readiness_delay():
+    try:
+        delay = int(os.environ.get("GLUU_LDAP_DRAIN_READINESS_DELAY", 10))
+        if delay < 0:
+            delay = 10
+    except ValueError:
+        delay = 10
+    return delay
+
+
+def get_drain_timeout():
+    try:
+        timeout = int(os.environ.get("GLUU_LDAP_DRAIN_TIMEOUT", 30))
+        if timeout < 0:
+            timeout = 30
+    except ValueError:
+        timeout = 30
+    return timeout
+
+
+def get_drain_replication_timeout():
+    try:
+        timeout = int(os.environ.get("GLUU_LDAP_DRAIN_REPLICATION_TIMEOUT", 300))
+        if timeout < 0:
+            timeout = 300
+    except ValueError:
+        timeout = 300
+    return timeout
+
+
+def fail_readiness():
+    """Make readiness checks fail, so load balancers stop sending new clients.
+    """
+    pathlib.Path(DRAIN_MARKER).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(DRAIN_MARKER).touch()
+    pathlib.Path(READY_MARKER).unlink(missing_ok=True)
+
+
+def submit_task(conn, name, object_class, class_name):
+    """Add a task entry; the task runs right away.
+    """
+    task_id = f"drain-{name}-{int(time.time())}"
+    conn.add(
+        f"ds-task-id={task_id},cn=Scheduled Tasks,cn=Tasks",
+        attributes={
+            "objectClass": ["top", "ds-task", object_class],
+            "ds-task-id": [task_id],
+            "ds-task-class-name": [class_name],
+        },
+    )
+    return conn.result["description"] == "success"
+
 
-@contextlib.contextmanager
-def admin_password_bound(manager, password_file=DEFAULT_ADMIN_PW_PATH):
-    if not os.path.isfile(password_file):
-        manager.secret.to_file(
-            "encoded_ox_ldap_pw", password_file, decode=True,
-        )
+def enter_lockdown(conn):
+    """Enter lockdown mode; the server rejects new connections except from
+    root users over loopback (existing connections are kept).
+    """
+    if not submit_task(conn, "lockdown", "ds-task-enter-lockdown-mode", "org.opends.server.tasks.EnterLockdownModeTask"):
+        logger.warning(f"Unable to enter lockdown mode; reason={conn.result['message']}")
+        return False
+    return True
+
+
+def leave_lockdown(conn):
+    """Leave lockdown mode; ``dsreplication`` connects using the advertised hostname
+    and binds as global admin, both of which are rejected in lockdown mode.
+    """
+    if not submit_task(conn, "unlock", "ds-task-leave-lockdown-mode", "org.opends.server.tasks.LeaveLockdownModeTask"):
+        logger.warning(f"Unable to leave lockdown mode; reason={conn.result['message']}")
+        return False
+    return True
+
+
+def wait_for_idle(conn, timeout, interval=1, idle_checks=3):
+    """Wait until no requests are queued for ``idle_checks`` consecutive checks.
+    """
+    deadline = time.monotonic() + timeout
+    idle = 0
+
+    while time.monotonic() < deadline:
+        _, backlog = probe_latency(conn)
+        idle = idle + 1 if not backlog else 0
+        if idle >= idle_checks:
+            return True
+        time.sleep(interval)
+    return False
+
+
+def get_outstanding_changes(conn):
+    """Get number of changes not yet replicated between current server and its peers.
+    """
+    search_filter = "(|{})".format("".join(f"({attr}=*)" for attr in OUTSTANDING_CHANGES_ATTRS))
+    entries = read_monitor_entries(
+        conn, search_filter, list(OUTSTANDING_CHANGES_ATTRS), base="cn=Replication,cn=monitor",
+    )
+
+    total = 0
+    for attrs in entries.values():
+        for attr in OUTSTANDING_CHANGES_ATTRS:
+            try:
+                total += sum(int(value) for value in attrs.get(attr, []))
+            except (TypeError, ValueError):
+                # i.e. ``<not available>``
+                continue
+    return total
+
+
+def wait_for_replication(conn, timeout, interval=2):
+    """Wait until there are no outstanding changes for peers.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        outstanding = get_outstanding_changes(conn)
+        if not outstanding:
+            return True
+        if time.monotonic() > deadline:
+            logger.warning(f"Timeout while waiting for {outstanding} outstanding changes to be replicated")
+            return False
+        time.sleep(interval)
+
+
+def drain(manager):
+    """Drain the server (whose readiness checks already fail) before replication is
+    disabled; each step is bounded by its own timeout.
+    """
+    started_at = time.monotonic()
+
+    logger.info("Draining server")
+    time.sleep(get_drain_readiness_delay())
 
     try:
-        yield password_file
-    except Exception:
-        raise
-    finally:
-        with contextlib.suppress(FileNotFoundError):
-            os.unlink(password_file)
+        with get_pool(manager).connection() as conn:
+            locked = enter_lockdown(conn)
+            if locked:
+                logger.info("Entered lockdown mode; waiting for in-flight requests")
+            try:
+                if not wait_for_idle(conn, get_drain_timeout()):
+                    logger.warning("Timeout while waiting for in-flight requests")
+
+                logger.info("Waiting for outstanding changes to be replicated to peers")
+                wait_for_replication(conn, get_drain_replication_timeout())
+            finally:
+                # readiness checks keep failing, hence no new clients are sent
+                if locked and leave_lockdown(conn):
+                    logger.info("Left lockdown mode")
+    except LDAPException as exc:
+        logger.warning(f"Unable to drain server; reason={exc}")
+
+    logger.info(f"Drained server in {time.monotonic() - started_at:.1f} seconds")
 
 
 def main():
@@ -38,7 +183,12 @@ def main():
     host = addr.split(":")[0]
     admin_port = os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444")
 
+    # the drain marker also stops heartbeats, hence it's created before the peer
+    # is deregistered so its key doesn't come back
+    logger.info("Failing readiness checks")
+    fail_readiness()
     deregister_serf_peer(manager, addr)
+    drain(manager)
 
     with admin_password_bound(manager) as password_file:
         cmd = " ".join([
@@ -57,7 +207,9 @@ def main():
 
         if code:
             err = err or out
-            logger.warning(f"Unable to disable replication for current server; reason={err.decode()}")
+            logger.error(f"Unable to disable replication for current server; reason={err.decode()}")
+            sys.exit(code)
+        logger.info("Disabled replication for current server")
 
 
 if __name__ == "__main__":
@@ -11,18 +11,43 @@ import sys
 import time
 from contextlib import contextmanager
 
+from ldap_batch import Change
+from ldap_batch import apply_batch
+from ldap_batch import log_failures
+from ldap_pool import close_pools
+from ldap_pool import get_pool
+from log_profile import AUDIT_LOGGER_DN
+from log_profile import audit_filtering_mods
+from log_profile import filtering_criteria_entries
+from log_profile import get_audit_exclude_subtrees
+from log_profile import log_profile_mods
+from seed import import_seed
 from settings import LOGGING_CONFIG
+from template_instance import KEYSTORE_FILE
+from template_instance import copy_template
+from template_instance import get_keystore_alias
+from template_instance import load_manifest
+from template_instance import personalize_config
+from template_instance import rotate_pins
+from template_instance import template_enabled
+from template_instance import template_mismatch
+from toolrunner import exec_cmd
+from topology import get_replication_role
+from topology import get_zone
+from tracing import get_manager
+from utils import DEFAULT_ADMIN_PW_PATH
+from utils import get_backend_type
+from utils import get_backends
+from utils import get_heap_size
+from utils import get_split_backends
 from utils import guess_serf_addr
+from utils import require_site
 
 import ldap3
 import javaproperties
-from pygluu.containerlib import get_manager
 from pygluu.containerlib.utils import decode_text
-from pygluu.containerlib.utils import exec_cmd
 from pygluu.containerlib.utils import as_boolean
 
-DEFAULT_ADMIN_PW_PATH = "/opt/opendj/.pw"
-
 manager = get_manager()
 
 logging.config.dictConfig(LOGGING_CONFIG)
@@ -33,49 +58,56 @@ def guess_host_addr():
     return socket.getfqdn()
 
 
-def install_opendj():
+def install_opendj(opendj_dir="/opt/opendj", hostname=None, ldap_port=None, ldaps_port=None,
+                   admin_port=None, password_file=DEFAULT_ADMIN_PW_PATH, binddn=None, keystore_password=None):
     logger.info("Installing OpenDJ.")
 
     # 1) render opendj-setup.properties
     # admin_port = 4444
-    admin_port = os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444")
+    admin_port = admin_port or os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444")
 
     ctx = {
-        "ldap_hostname": guess_host_addr(),
-        "ldap_port": manager.config.get("ldap_port"),
-        "ldaps_port": manager.config.get("ldaps_port"),
+        "ldap_hostname": hostname or guess_host_addr(),
+        "ldap_port": ldap_port or manager.config.get("ldap_port"),
+        "ldaps_port": ldaps_port or manager.config.get("ldaps_port"),
         "ldap_jmx_port": 1689,
         "ldap_admin_port": admin_port,
-        "opendj_ldap_binddn": manager.config.get("ldap_binddn"),
-        "ldapPassFn": DEFAULT_ADMIN_PW_PATH,
-        "ldap_backend_type": "je",
+        "opendj_ldap_binddn": binddn or manager.config.get("ldap_binddn"),
+        "ldapPassFn": password_file,
+        "ldap_backend_type": get_backend_type(),
     }
     with open("/app/templates/opendj-setup.properties") as fr:
         content = fr.read() % ctx
 
-        with open("/opt/opendj/opendj-setup.properties", "w") as fw:
+        with open(f"{opendj_dir}/opendj-setup.properties", "w") as fw:
             fw.write(content)
 
     # 2) run installer
     cmd = " ".join([
-        "/opt/opendj/setup",
+        f"{opendj_dir}/setup",
         "--no-prompt",
         "--cli",
         "--acceptLicense",
-        "--propertiesFilePath /opt/opendj/opendj-setup.properties",
+        f"--propertiesFilePath {opendj_dir}/opendj-setup.properties",
         "--usePkcs12keyStore /etc/certs/opendj.pkcs12",
-        "--keyStorePassword {}".format(
-            decode_text(manager.secret.get("encoded_ldapTrustStorePass"), manager.secret.get("encoded_salt")).decode()
-        ),
+        "--keyStorePassword {}".format(keystore_password or get_keystore_password()),
         "--doNotStart",
     ])
     out, err, code = exec_cmd(cmd)
     if code and err:
         logger.warning(err.decode())
 
+    write_java_properties(opendj_dir)
+
+
+def get_keystore_password():
+    return decode_text(manager.secret.get("encoded_ldapTrustStorePass"), manager.secret.get("encoded_salt")).decode()
+
+
+def write_java_properties(opendj_dir="/opt/opendj"):
     if all([os.environ.get("JAVA_VERSION", "") >= "1.8.0",
-            os.path.isfile("/opt/opendj/config/config.ldif")]):
-        with open("/opt/opendj/config/java.properties", "a") as f:
+            os.path.isfile(f"{opendj_dir}/config/config.ldif")]):
+        with open(f"{opendj_dir}/config/java.properties", "a") as f:
             status_arg = "\nstatus.java-args=-Xms8m -client -Dcom.sun.jndi.ldap.object.disableEndpointIdentification=true"
 
             max_ram_percentage = os.environ.get("GLUU_MAX_RAM_PERCENTAGE", "75.0")
@@ -85,6 +117,43 @@ def install_opendj():
             f.write(args)
 
 
+def install_from_template(opendj_dir="/opt/opendj"):
+    """Install OpenDJ by copying the template instance built into the image (see ``template_instance.py``).
+
+    Returns whether the template has been used; the server is installed by ``setup`` otherwise.
+    """
+    if not template_enabled():
+        return False
+
+    reason = template_mismatch(load_manifest(), manager.config.get("ldap_binddn"))
+    if reason:
+        logger.info(f"Unable to use template instance; reason={reason}")
+        return False
+
+    logger.info("Installing OpenDJ from template instance.")
+    copy_template(opendj_dir)
+
+    keystore_password = get_keystore_password()
+    with open(DEFAULT_ADMIN_PW_PATH) as f:
+        root_password = f.read().strip()
+
+    personalize_config(
+        opendj_dir,
+        ports={
+            "ldap": manager.config.get("ldap_port"),
+            "ldaps": manager.config.get("ldaps_port"),
+            "admin": os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444"),
+        },
+        keystore_alias=get_keystore_alias(KEYSTORE_FILE, keystore_password),
+        keystore_password=keystore_password,
+        root_password=root_password,
+    )
+    # keys protected by these PINs are regenerated once the server is started
+    rotate_pins(opendj_dir)
+    write_java_properties(opendj_dir)
+    return True
+
+
 def run_dsjavaproperties():
     _, err, code = exec_cmd("/opt/opendj/bin/dsjavaproperties")
     if code and err:
@@ -124,6 +193,8 @@ def ds_context():
     except Exception:
         raise
     finally:
+        # pooled connections won't survive the restart
+        close_pools()
         exec_cmd("/opt/opendj/bin/stop-ds --quiet")
 
 
@@ -152,17 +223,6 @@ def run_upgrade():
                 exec_cmd("cp /opt/opendj/config/buildinfo /opt/opendj/config/buildinfo-{}".format(buildinfo))
 
 
-def require_site():
-    persistence_type = os.environ.get("GLUU_PERSISTENCE_TYPE", "ldap")
-    ldap_mapping = os.environ.get("GLUU_PERSISTENCE_LDAP_MAPPING", "default")
-
-    if persistence_type == "ldap":
-        return True
-    if persistence_type == "hybrid" and ldap_mapping == "site":
-        return True
-    return False
-
-
 def main():
     alt_name = os.environ.get("GLUU_CERT_ALT_NAME", "")
 
@@ -213,24 +273,39 @@ def main():
     if not any([os.path.isfile("/opt/opendj/config/config.ldif"),
                 os.path.isdir("/opt/opendj/config/schema")]):
         cleanup_config_dir()
-        install_opendj()
 
-        with ds_context():
-            # modify admin-keystore and ads-truststore (for replication), if required
-            if os.environ.get("GLUU_SERF_ADVERTISE_ADDR", ""):
-                logger.info("Advertise address is detected ...")
+        if install_from_template():
+            with ds_context():
+                # keys of the template are shared by every container of the image
                 logger.info("Reconfiguring keystore for admin")
                 modify_admin_keystore()
                 logger.info("Reconfiguring keystore for replication")
                 modify_ads_truststore()
 
-        with ds_context():
-            # if not is_wrends():
-            #     run_dsjavaproperties()
+            with ds_context():
+                configure_opendj()
+        else:
+            install_opendj()
+
+            with ds_context():
+                # modify admin-keystore and ads-truststore (for replication), if required
+                if os.environ.get("GLUU_SERF_ADVERTISE_ADDR", ""):
+                    logger.info("Advertise address is detected ...")
+                    logger.info("Reconfiguring keystore for admin")
+                    modify_admin_keystore()
+                    logger.info("Reconfiguring keystore for replication")
+                    modify_ads_truststore()
+
+            with ds_context():
+                # if not is_wrends():
+                #     run_dsjavaproperties()
+
+                create_backends()
+                configure_opendj()
+                configure_opendj_indexes()
 
-            create_backends()
-            configure_opendj()
-            configure_opendj_indexes()
+        # load data exported by another server (if any) while the server is stopped
+        import_seed()
 
     # prepare serf config
     configure_serf()
@@ -438,6 +513,10 @@ def configure_serf():
             "admin_port": os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444"),
             "replication_port": os.environ.get("GLUU_LDAP_ADVERTISE_REPLICATION_PORT", "8989"),
             "ldaps_port": os.environ.get("GLUU_LDAP_ADVERTISE_LDAPS_PORT", "1636"),
+            "replication_role": get_replication_role(),
+            "zone": get_zone(),
+            # updated by ldap_replicator.py once the replication server is running
+            "replication_server": "false",
         },
         "log_level": os.environ.get("GLUU_SERF_LOG_LEVEL", "warn"),
         "profile": os.environ.get("GLUU_SERF_PROFILE", "lan"),
@@ -452,28 +531,25 @@ def configure_serf():
     conf_fn.write_text(json.dumps(conf))
 
 
-def configure_opendj_indexes():
+def configure_opendj_indexes(host="localhost:1636", pool=None):
     logger.info("Configuring indexes for available backends.")
 
     with open("/app/templates/index.json") as f:
         data = json.load(f)
 
-    host = "localhost:1636"
-    user = manager.config.get("ldap_binddn")
-    password = decode_text(
-        manager.secret.get("encoded_ox_ldap_pw"),
-        manager.secret.get("encoded_salt")
-    )
-
-    ldap_server = ldap3.Server(host, 1636, use_ssl=True)
+    pool = pool or get_pool(manager, host)
 
-    backends = ["userRoot", "metric"]
-    if require_site():
-        backends.append("site")
+    backends = list(get_backends())
+    split_backends = list(get_split_backends())
 
-    with ldap3.Connection(ldap_server, user, password) as conn:
+    with pool.connection() as conn:
         for attr_map in data:
-            for backend in attr_map["backend"]:
+            # split backends hold data of userRoot, hence use the same indexes
+            index_backends = attr_map["backend"]
+            if "userRoot" in index_backends:
+                index_backends = index_backends + split_backends
+
+            for backend in index_backends:
                 if backend not in backends:
                     continue
 
@@ -490,30 +566,48 @@ def configure_opendj_indexes():
                     logger.warning(conn.result["message"])
 
 
-def create_backends():
+def get_userroot_cache_percent():
+    # split backends take their cache share from userRoot
+    return 70 - sum(
+        attrs["db_cache_percent"] for attrs in get_split_backends().values()
+    )
+
+
+def create_backends(opendj_dir="/opt/opendj", hostname=None, admin_port=None, password_file=DEFAULT_ADMIN_PW_PATH, binddn=None):
     logger.info("Creating backends.")
+    backend_type = get_backend_type()
     mods = [
-        "create-backend --backend-name metric --set base-dn:o=metric --type je --set enabled:true --set db-cache-percent:10",
+        # shrink userRoot first, otherwise caches of new backends may exceed the memory quota
+        f"set-backend-prop --backend-name userRoot --set db-cache-percent:{get_userroot_cache_percent()}",
+        f"create-backend --backend-name metric --set base-dn:o=metric --type {backend_type} --set enabled:true --set db-cache-percent:10",
     ]
     if require_site():
         mods.append(
-            "create-backend --backend-name site --set base-dn:o=site --type je --set enabled:true --set db-cache-percent:20",
+            f"create-backend --backend-name site --set base-dn:o=site --type {backend_type} --set enabled:true --set db-cache-percent:20",
         )
 
-    hostname = guess_host_addr()
-    binddn = manager.config.get("ldap_binddn")
-    admin_port = os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444")
+    for backend, attrs in get_split_backends().items():
+        mod = f"create-backend --backend-name {backend} --set base-dn:{attrs['base_dn']} --type {backend_type} --set enabled:true " \
+            f"--set db-cache-percent:{attrs['db_cache_percent']}"
+        # cleaner is specific to JE
+        if backend_type == "je":
+            mod += f" --set db-num-cleaner-threads:{attrs['db_num_cleaner_threads']}"
+        mods.append(mod)
+
+    hostname = hostname or guess_host_addr()
+    binddn = binddn or manager.config.get("ldap_binddn")
+    admin_port = admin_port or os.environ.get("GLUU_LDAP_ADVERTISE_ADMIN_PORT", "4444")
     # admin_port = 4444
 
     for mod in mods:
         cmd = " ".join([
-            "/opt/opendj/bin/dsconfig",
+            f"{opendj_dir}/bin/dsconfig",
             "--trustAll",
             "--no-prompt",
             f"--hostname {hostname}",
             f"--port {admin_port}",
             f"--bindDN '{binddn}'",
-            f"--bindPasswordFile {DEFAULT_ADMIN_PW_PATH}",
+            f"--bindPasswordFile {password_file}",
             mod,
         ])
         _, err, code = exec_cmd(cmd)
@@ -522,25 +616,79 @@ def create_backends():
             sys.exit(1)
 
 
-def configure_opendj():
-    logger.info("Configuring OpenDJ.")
+#: entries read on (nearly) every request, i.e. configuration, clients and scopes
+ENTRY_CACHE_INCLUDE_FILTERS = [
+    "(objectClass=gluuConfiguration)",
+    "(objectClass=oxAuthConfiguration)",
+    "(objectClass=oxTrustConfiguration)",
+    "(objectClass=oxApplicationConfiguration)",
+    "(objectClass=gluuOrganization)",
+    "(objectClass=gluuAttribute)",
+    "(objectClass=oxCustomScript)",
+    "(objectClass=oxAuthClient)",
+    "(objectClass=oxAuthCustomScope)",
+    "(objectClass=oxSectorIdentifier)",
+]
+
+#: high-churn entries that would evict hot entries from the cache
+ENTRY_CACHE_EXCLUDE_FILTERS = [
+    "(objectClass=token)",
+    "(objectClass=oxAuthGrant)",
+    "(objectClass=oxAuthSessionId)",
+    "(objectClass=oxAuthUmaRPT)",
+    "(objectClass=oxAuthUmaPCT)",
+    "(objectClass=cibaRequest)",
+    "(objectClass=cache)",
+    "(objectClass=oxMetric)",
+]
+
+#: rough size of a cached configuration/client entry (decoded) in bytes
+ENTRY_CACHE_AVG_ENTRY_SIZE = 4096
+
+
+def get_entry_cache_max_entries():
+    """Calculate max. entries in entry cache from its share of the JVM heap.
+    """
+    try:
+        percent = float(os.environ.get("GLUU_LDAP_ENTRY_CACHE_PERCENT", 5))
+        if not 0 < percent < 50:
+            percent = 5
+    except ValueError:
+        percent = 5
+    return max(1000, int(get_heap_size() * percent / 100 / ENTRY_CACHE_AVG_ENTRY_SIZE))
 
-    host = "localhost:1636"
-    user = manager.config.get("ldap_binddn")
-    password = decode_text(
-        manager.secret.get("encoded_ox_ldap_pw"),
-        manager.secret.get("encoded_salt")
-    )
 
-    ldap_server = ldap3.Server(host, 1636, use_ssl=True)
+def get_preload_time_limit():
+    try:
+        limit = int(os.environ.get("GLUU_LDAP_PRELOAD_TIME_LIMIT", 30))
+        if limit < 0:
+            limit = 30
+    except ValueError:
+        limit = 30
+    return limit
+
+
+def entry_cache_mods():
+    dn = "cn=FIFO,cn=Entry Caches,cn=config"
+    return [
+        (dn, "ds-cfg-include-filter", ENTRY_CACHE_INCLUDE_FILTERS, ldap3.MODIFY_REPLACE),
+        (dn, "ds-cfg-exclude-filter", ENTRY_CACHE_EXCLUDE_FILTERS, ldap3.MODIFY_REPLACE),
+        (dn, "ds-cfg-max-entries", str(get_entry_cache_max_entries()), ldap3.MODIFY_REPLACE),
+        (dn, "ds-cfg-enabled", "true", ldap3.MODIFY_REPLACE),
+    ]
+
+
+def configure_opendj(host="localhost:1636"):
+    logger.info("Configuring OpenDJ.")
+
+    pool = get_pool(manager, host)
 
     mods = [
-        ('ds-cfg-backend-id=userRoot,cn=Backends,cn=config', 'ds-cfg-db-cache-percent', '70', ldap3.MODIFY_REPLACE),
+        ('ds-cfg-backend-id=userRoot,cn=Backends,cn=config', 'ds-cfg-db-cache-percent', str(get_userroot_cache_percent()), ldap3.MODIFY_REPLACE),
         ('cn=config', 'ds-cfg-single-structural-objectclass-behavior', 'accept', ldap3.MODIFY_REPLACE),
         ('cn=config', 'ds-cfg-reject-unauthenticated-requests', 'true', ldap3.MODIFY_REPLACE),
         ('cn=Default Password Policy,cn=Password Policies,cn=config', 'ds-cfg-allow-pre-encoded-passwords', 'true', ldap3.MODIFY_REPLACE),
         ('cn=Default Password Policy,cn=Password Policies,cn=config', 'ds-cfg-default-password-storage-scheme', 'cn=Salted SHA-512,cn=Password Storage Schemes,cn=config', ldap3.MODIFY_REPLACE),
-        ('cn=File-Based Audit Logger,cn=Loggers,cn=config', 'ds-cfg-enabled', 'true', ldap3.MODIFY_REPLACE),
         ('cn=LDAP Connection Handler,cn=Connection Handlers,cn=config', 'ds-cfg-enabled', 'false', ldap3.MODIFY_REPLACE),
         ('cn=JMX Connection Handler,cn=Connection Handlers,cn=config', 'ds-cfg-enabled', 'false', ldap3.MODIFY_REPLACE),
         ('cn=Access Control Handler,cn=config', 'ds-cfg-global-aci', '(targetattr!="userPassword||authPassword||debugsearchindex||changes||changeNumber||changeType||changeTime||targetDN||newRDN||newSuperior||deleteOldRDN")(version 3.0; acl "Anonymous read access"; allow (read,search,compare) userdn="ldap:///anyone";)', ldap3.MODIFY_DELETE),
@@ -551,44 +699,60 @@ def configure_opendj():
             ("cn=Core Schema,cn=Schema Providers,cn=config", "ds-cfg-allow-zero-length-values-directory-string", "true", ldap3.MODIFY_REPLACE)
         )
 
-    with ldap3.Connection(ldap_server, user, password) as conn:
-        for dn, attr, value, mod_type in mods:
-            conn.modify(dn, {attr: [mod_type, value]})
-            if conn.result["description"] != "success":
-                logger.warning(conn.result["message"])
+    if as_boolean(os.environ.get("GLUU_LDAP_ENTRY_CACHE_ENABLED", True)):
+        mods += entry_cache_mods()
 
-    # Create uniqueness for attrbiutes
-    with ldap3.Connection(ldap_server, user, password) as conn:
-        attrs = [
-            ("mail", "Unique mail address"),
-            ("uid", "Unique uid entry"),
-        ]
-
-        for attr, cn in attrs:
-            conn.add(
-                'cn={},cn=Plugins,cn=config'.format(cn),
-                attributes={
-                    'objectClass': ['top', 'ds-cfg-plugin', 'ds-cfg-unique-attribute-plugin'],
-                    'ds-cfg-java-class': ['org.opends.server.plugins.UniqueAttributePlugin'],
-                    'ds-cfg-enabled': ['true'],
-                    'ds-cfg-plugin-type': [
-                        'postoperationadd',
-                        'postoperationmodify',
-                        'postoperationmodifydn',
-                        'postsynchronizationadd',
-                        'postsynchronizationmodify',
-                        'postsynchronizationmodifydn',
-                        'preoperationadd',
-                        'preoperationmodify',
-                        'preoperationmodifydn',
-                    ],
-                    'ds-cfg-type': [attr],
-                    'cn': [cn],
-                    'ds-cfg-base-dn': ['o=gluu']
-                }
+    audit_exclude_subtrees = get_audit_exclude_subtrees()
+    mods += log_profile_mods()
+    mods += audit_filtering_mods(audit_exclude_subtrees)
+
+    # load DB cache on startup so the first requests don't hit disk (only supported by JE)
+    if get_backend_type() == "je":
+        preload_time_limit = get_preload_time_limit()
+        for backend in get_backends():
+            mods.append(
+                (f"ds-cfg-backend-id={backend},cn=Backends,cn=config", "ds-cfg-preload-time-limit", f"{preload_time_limit} seconds", ldap3.MODIFY_REPLACE)
             )
-            if conn.result["description"] != "success":
-                logger.warning(conn.result["message"])
+
+    # Create uniqueness for attrbiutes
+    attrs = [
+        ("mail", "Unique mail address"),
+        ("uid", "Unique uid entry"),
+    ]
+    entries = [
+        (
+            'cn={},cn=Plugins,cn=config'.format(cn),
+            {
+                'objectClass': ['top', 'ds-cfg-plugin', 'ds-cfg-unique-attribute-plugin'],
+                'ds-cfg-java-class': ['org.opends.server.plugins.UniqueAttributePlugin'],
+                'ds-cfg-enabled': ['true'],
+                'ds-cfg-plugin-type': [
+                    'postoperationadd',
+                    'postoperationmodify',
+                    'postoperationmodifydn',
+                    'postsynchronizationadd',
+                    'postsynchronizationmodify',
+                    'postsynchronizationmodifydn',
+                    'preoperationadd',
+                    'preoperationmodify',
+                    'preoperationmodifydn',
+                ],
+                'ds-cfg-type': [attr],
+                'cn': [cn],
+                'ds-cfg-base-dn': ['o=gluu']
+            },
+        )
+        for attr, cn in attrs
+    ]
+
+    # parent of filtering criteria is added along with other changes, as it doesn't depend on them
+    criteria_entries = filtering_criteria_entries(AUDIT_LOGGER_DN, audit_exclude_subtrees) if audit_exclude_subtrees else []
+
+    # changes of the same DN are merged, and all operations are pipelined
+    results = apply_batch(pool, changes=[Change(*mod) for mod in mods], entries=entries + criteria_entries[:1])
+    if criteria_entries[1:]:
+        results += apply_batch(pool, entries=criteria_entries[1:])
+    log_failures(results)
 
 
 def disable_tls13():
@@ -635,16 +799,7 @@ def modify_ads_truststore():
 
         cfg_key = out.decode().split("=")[-1].replace(":", "")
 
-        host = "localhost:1636"
-        user = manager.config.get("ldap_binddn")
-        password = decode_text(
-            manager.secret.get("encoded_ox_ldap_pw"),
-            manager.secret.get("encoded_salt")
-        )
-
-        ldap_server = ldap3.Server(host, 1636, use_ssl=True)
-
-        with ldap3.Connection(ldap_server, user, password) as conn:
+        with get_pool(manager).connection() as conn:
             conn.delete(f"ds-cfg-key-id={cfg_key},cn=instance keys,cn=admin data")
             if conn.result["description"] != "success":
                 logger.warning(conn.result["message"])
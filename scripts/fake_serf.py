@@ -0,0 +1,67 @@
+"""Minimal stand-in of ``serf`` CLI used by ``bench_replication.py``.
+
+Answers ``serf members`` and ``serf info`` (JSON format only) from a state file
+shared by all local instances, so ``ldap_replicator.py`` can discover peers
+without running Serf agents.
+
+The state file (``FAKE_SERF_STATE``) has the following structure:
+
+    {"members": [{"name": "127.0.0.1", "addr": "127.0.0.1:7946", "tags": {...}, "status": "alive"}]}
+
+and the name of current member is taken from ``FAKE_SERF_NODE``.
+"""
+import argparse
+import json
+import os
+import sys
+
+
+def load_members():
+    with open(os.environ["FAKE_SERF_STATE"]) as f:
+        return json.load(f)["members"]
+
+
+def members(args):
+    tags = dict(tag.split("=", 1) for tag in args.tag)
+    result = [
+        member for member in load_members()
+        if all(member["tags"].get(key) == value for key, value in tags.items())
+        and (not args.status or member.get("status", "alive") == args.status)
+    ]
+    print(json.dumps({"members": result}))
+
+
+def info(args):
+    node = os.environ["FAKE_SERF_NODE"]
+    for member in load_members():
+        if member["name"] == node:
+            print(json.dumps({"agent": {"name": node}, "tags": member["tags"]}))
+            return
+    print(f"Error: unknown node {node}", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="serf")
+    subparsers = parser.add_subparsers(dest="command")
+
+    members_parser = subparsers.add_parser("members")
+    members_parser.add_argument("-tag", action="append", default=[])
+    members_parser.add_argument("-status", default="")
+    members_parser.add_argument("-format", default="json")
+
+    info_parser = subparsers.add_parser("info")
+    info_parser.add_argument("-format", default="json")
+
+    args = parser.parse_args()
+    if args.command == "members":
+        members(args)
+    elif args.command == "info":
+        info(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,18 @@ import os
 import sys
 
 import ldap3
-from pygluu.containerlib import get_manager
-from pygluu.containerlib.utils import decode_text
 
+from ldap_pool import get_pool
 from ldap_replicator import peers_from_serf_membership
+from tracing import get_manager
+from utils import DRAIN_MARKER
+from warmup import WARMUP_MARKER
+from warmup import warmup_enabled
 
 
-def get_ldap_entries(host, user, password):
+def get_ldap_entries(pool):
     persistence_type = os.environ.get("GLUU_PERSISTENCE_TYPE", "ldap")
     ldap_mapping = os.environ.get("GLUU_PERSISTENCE_LDAP_MAPPING", "default")
-    ldap_server = ldap3.Server(host, 1636, use_ssl=True)
 
     # a minimum service stack is having oxTrust, hence check whether entry
     # for oxTrust exists in LDAP
@@ -34,7 +36,7 @@ def get_ldap_entries(host, user, password):
     else:
         search = default_search
 
-    with ldap3.Connection(ldap_server, user, password) as conn:
+    with pool.connection() as conn:
         conn.search(
             search_base=search[0],
             search_filter=search[1],
@@ -45,32 +47,39 @@ def get_ldap_entries(host, user, password):
         return conn.entries
 
 
-def main():
+def check_ready(manager=None):
+    """Check whether the server is ready to serve requests.
+    """
+    # server being drained must not receive new requests
+    if os.path.isfile(DRAIN_MARKER):
+        return False
+
+    # server is not ready until its caches have been warmed up
+    if warmup_enabled() and not os.path.isfile(WARMUP_MARKER):
+        return False
+
     # check how many member in ldap cluster,
     peers_num = len(peers_from_serf_membership())
 
     if peers_num == 0:
-        sys.exit(1)
+        return False
     elif peers_num == 1:
         # if there's only 1 alive member, mark the server as ready to allow
         # data injection to persistence
-        sys.exit(0)
+        return True
     else:
         # if there are more than 1 instances, determine the server readiness by
         # checking entries in persistence
-        manager = get_manager()
-        host = "localhost:1636"
-        user = manager.config.get("ldap_binddn")
-        password = decode_text(
-            manager.secret.get("encoded_ox_ldap_pw"),
-            manager.secret.get("encoded_salt")
-        )
+        manager = manager or get_manager()
+        result = get_ldap_entries(get_pool(manager))
+        return bool(result)
 
-        result = get_ldap_entries(host, user, password)
-        if result:
-            sys.exit(0)
-        else:
-            sys.exit(1)
+
+def main():
+    if check_ready():
+        sys.exit(0)
+    else:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+"""Throttle replication initialization so it doesn't starve client requests of its source.
+
+``dsreplication initialize`` makes the source push the whole backend as fast as
+the replication flow control allows. Before it starts, the source's latency is
+probed (the same way as purge does) and the initialization window (number of
+entries in flight on the link between source and current server) is sized from
+it. OpenDJ reads the window once when the push starts, hence it can't be changed
+while the initialization runs; the latency is still probed and reported.
+
+Progress and current rate are written to ``INIT_STATUS_FILE``, i.e.:
+
+    {"base_dn": "o=gluu", "source": "ldap-0", "state": "running", "processed": 1200,
+     "remaining": 8800, "rate": 150.0, "window": 50, "source_latency_ms": 12.5}
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from ldap3.core.exceptions import LDAPException
+from pygluu.containerlib.utils import as_boolean
+
+from ldap_pool import get_pool
+from lease import get_seed_max_concurrency
+from monitor import probe_latency
+from toolrunner import exec_cmd
+from utils import OPENDJ_DIR
+
+logger = logging.getLogger("ldap_replicator")
+
+INIT_STATUS_FILE = "/app/tmp/init-status.json"
+
+#: window used by OpenDJ if not configured
+DEFAULT_INIT_WINDOW = 100
+
+#: seconds between latency probes while initialization is running
+PROBE_INTERVAL = 5
+
+
+def init_throttle_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_INIT_THROTTLE_ENABLED", True))
+
+
+def get_init_target_latency():
+    try:
+        latency = int(os.environ.get("GLUU_LDAP_INIT_TARGET_LATENCY", 50))
+        if latency < 1:
+            latency = 50
+    except ValueError:
+        latency = 50
+    return latency
+
+
+def get_init_max_window():
+    try:
+        window = int(os.environ.get("GLUU_LDAP_INIT_MAX_WINDOW", DEFAULT_INIT_WINDOW))
+        if window < 1:
+            window = DEFAULT_INIT_WINDOW
+    except ValueError:
+        window = DEFAULT_INIT_WINDOW
+    return window
+
+
+def get_init_max_wait():
+    try:
+        wait = int(os.environ.get("GLUU_LDAP_INIT_MAX_WAIT", 300))
+        if wait < 0:
+            wait = 300
+    except ValueError:
+        wait = 300
+    return wait
+
+
+def write_status(status):
+    os.makedirs(os.path.dirname(INIT_STATUS_FILE), exist_ok=True)
+    with open(f"{INIT_STATUS_FILE}.tmp", "w") as f:
+        f.write(json.dumps(status))
+    os.replace(f"{INIT_STATUS_FILE}.tmp", INIT_STATUS_FILE)
+
+
+class InitController:
+    """Run ``dsreplication initialize`` of ``base_dn`` from ``source`` once latency
+    of ``source`` is under ``GLUU_LDAP_INIT_TARGET_LATENCY``, with a window sized from it.
+    """
+
+    def __init__(self, manager, source, base_dn, password_file):
+        self.manager = manager
+        self.source = source
+        self.base_dn = base_dn
+        self.password_file = password_file
+
+        self.source_pool = get_pool(manager, f"{source['name']}:{source['tags']['ldaps_port']}")
+        self.local_pool = get_pool(manager)
+
+        self.max_window = get_init_max_window()
+        self.target = get_init_target_latency() / 1000
+        self.window = None
+        self.status = {
+            "base_dn": base_dn,
+            "source": source["name"],
+            "state": "waiting",
+            "processed": 0,
+            "remaining": None,
+            "rate": 0.0,
+            "window": None,
+            "source_latency_ms": None,
+        }
+
+    def probe(self):
+        """Get latency (in seconds) of the source; a backlog counts as saturation.
+        """
+        try:
+            with self.source_pool.connection() as conn:
+                latency, backlog = probe_latency(conn)
+        except LDAPException as exc:
+            logger.warning(f"Unable to probe latency of {self.source['name']}; reason={exc}")
+            return None
+
+        self.status["source_latency_ms"] = round(latency * 1000, 1)
+        return latency if not backlog else float("inf")
+
+    def dsconfig(self, subcommand, *options):
+        """Run ``dsconfig`` against the replication domain on the source.
+        """
+        cmd = " ".join([
+            f"{OPENDJ_DIR}/bin/dsconfig",
+            subcommand,
+            "--provider-name 'Multimaster Synchronization'",
+            f"--domain-name '{self.base_dn}'",
+            *options,
+            f"--hostname {self.source['name']}",
+            f"--port {self.source['tags']['admin_port']}",
+            f"--bindDN '{self.manager.config.get('ldap_binddn')}'",
+            f"--bindPasswordFile {self.password_file}",
+            "--trustAll",
+            "--no-prompt",
+        ])
+        return exec_cmd(cmd)
+
+    def get_window(self):
+        """Get initialization window configured on the source, or ``None`` if it can't be read.
+        """
+        out, err, code = self.dsconfig(
+            "get-replication-domain-prop", "--property initialization-window-size", "--script-friendly",
+        )
+        if code != 0:
+            err = err or out
+            logger.warning(f"Unable to get initialization window on {self.source['name']}; reason={err.decode().strip()}")
+            return None
+
+        # i.e. ``initialization-window-size\t100``
+        try:
+            return int(out.decode().split()[-1])
+        except (IndexError, ValueError):
+            return None
+
+    def size_window(self, latency):
+        """Get initialization window for the given source latency; the window shrinks
+        in proportion to latency above target, down to a twentieth of the maximum.
+        """
+        if latency is None or latency <= self.target:
+            return self.max_window
+        return max(1, self.max_window // 20, int(self.max_window * self.target / latency))
+
+    def set_window(self, window):
+        """Set initialization window of the replication domain on the source;
+        only takes effect on initializations started afterwards.
+        """
+        window = int(window)
+        if window == self.window:
+            return
+
+        out, err, code = self.dsconfig(
+            "set-replication-domain-prop", f"--set initialization-window-size:{window}",
+        )
+        if code != 0:
+            err = err or out
+            logger.warning(f"Unable to set initialization window on {self.source['name']}; reason={err.decode().strip()}")
+            return
+
+        self.window = window
+        self.status["window"] = window
+
+    def read_progress(self):
+        """Read entry counts of the initialization task; ``dsreplication initialize``
+        creates the task on the source, which pushes entries to current server.
+        """
+        try:
+            with self.source_pool.connection() as conn:
+                conn.search(
+                    "cn=Scheduled Tasks,cn=Tasks",
+                    f"(&(objectClass=ds-task-initialize-remote-replica)(ds-task-initialize-domain-dn={self.base_dn}))",
+                    attributes=["ds-task-state", "ds-task-processed-entry-count", "ds-task-unprocessed-entry-count"],
+                )
+                entries = conn.entries
+        except LDAPException:
+            return None, None
+
+        if not entries:
+            return None, None
+
+        # tasks of previous initializations are kept for a while
+        running = [entry for entry in entries if "RUNNING" in str(entry.entry_attributes_as_dict.get("ds-task-state", [""])[0]).upper()]
+        attrs = (running or entries)[-1].entry_attributes_as_dict
+        processed = int((attrs.get("ds-task-processed-entry-count") or [0])[0])
+        remaining = int((attrs.get("ds-task-unprocessed-entry-count") or [0])[0])
+        return processed, remaining
+
+    def wait_for_source(self):
+        """Wait until the source is under target latency (bounded by ``GLUU_LDAP_INIT_MAX_WAIT``);
+        returns the last latency, or ``None`` if it can't be probed.
+        """
+        deadline = time.monotonic() + get_init_max_wait()
+        latency = None
+        while time.monotonic() < deadline:
+            latency = self.probe()
+            write_status(self.status)
+            if latency is not None and latency <= self.target:
+                return latency
+            time.sleep(PROBE_INTERVAL)
+        logger.warning(f"Source {self.source['name']} is still busy; initializing {self.base_dn} anyway")
+        return latency
+
+    def run(self, init_cmd):
+        """Run ``init_cmd`` in background while reporting its progress; returns result of ``exec_cmd``.
+        """
+        latency = self.wait_for_source()
+
+        # the window is a property of the source's domain, shared by every joiner
+        # initializing from it; with more than one joiner per source, they would
+        # overwrite each other's window, hence it's left as is
+        original_window = None
+        if get_seed_max_concurrency() == 1:
+            original_window = self.get_window()
+        if original_window is not None:
+            self.set_window(self.size_window(latency))
+
+        result = {}
+        worker = threading.Thread(target=lambda: result.update(output=exec_cmd(init_cmd)), daemon=True)
+        worker.start()
+
+        self.status["state"] = "running"
+        started_at = last_at = time.monotonic()
+        last_processed = 0
+
+        try:
+            while worker.is_alive():
+                worker.join(PROBE_INTERVAL)
+
+                self.probe()
+                processed, remaining = self.read_progress()
+                if processed is not None:
+                    now = time.monotonic()
+                    self.status.update(
+                        processed=processed,
+                        remaining=remaining,
+                        rate=round((processed - last_processed) / max(now - last_at, 0.001), 1),
+                    )
+                    last_processed, last_at = processed, now
+                write_status(self.status)
+        finally:
+            # restore the window configured before, as it's used by every link of the source
+            if original_window is not None:
+                self.set_window(original_window)
+
+        output = result.get("output", (b"", b"Initialization was interrupted", 1))
+        _, _, code = output
+        elapsed = time.monotonic() - started_at
+        self.status.update(state="failed" if code else "done", rate=round(self.status["processed"] / max(elapsed, 0.001), 1))
+        write_status(self.status)
+        return output
@@ -0,0 +1,133 @@
+"""Apply a batch of independent changes (i.e. to ``cn=config``) in as few round-trips as possible.
+
+Changes targeting the same DN are merged into a single modify operation, and
+operations of different DNs are pipelined over one asynchronous connection
+(requests are sent without waiting for responses of previous ones).
+
+Example:
+
+    results = apply_batch(pool, changes=[
+        Change("cn=config", "ds-cfg-reject-unauthenticated-requests", "true", ldap3.MODIFY_REPLACE),
+        Change("cn=config", "ds-cfg-single-structural-objectclass-behavior", "accept", ldap3.MODIFY_REPLACE),
+    ])
+    log_failures(results)
+"""
+import logging
+import time
+from collections import deque
+from collections import namedtuple
+
+import ldap3
+from ldap3.core.exceptions import LDAPException
+
+logger = logging.getLogger("ldap_batch")
+
+#: maximum number of outstanding requests
+PIPELINE_WINDOW = 32
+
+Change = namedtuple("Change", ["dn", "attr", "value", "mod_type"])
+
+#: result of an operation; ``changes`` are the changes applied by a modify
+#: (empty for an add)
+BatchResult = namedtuple("BatchResult", ["operation", "dn", "changes", "result"])
+
+
+def group_changes(changes):
+    """Group changes by DN, preserving their order.
+    """
+    grouped = {}
+    for change in changes:
+        grouped.setdefault(change.dn, []).append(change)
+    return grouped
+
+
+def to_modify_request(changes):
+    """Convert changes of a single DN into ``ldap3`` modify format.
+    """
+    request = {}
+    for change in changes:
+        value = change.value if isinstance(change.value, (list, tuple)) else [change.value]
+        request.setdefault(change.attr, []).append((change.mod_type, value))
+    return request
+
+
+def open_async_connection(pool):
+    """Open a connection using asynchronous strategy, with the same server and
+    credentials of ``pool``.
+    """
+    conn = ldap3.Connection(
+        pool.server, pool.user, pool.password,
+        client_strategy=ldap3.ASYNC, receive_timeout=pool.timeout, raise_exceptions=False,
+    )
+    if not conn.bind():
+        conn.unbind()
+        raise LDAPException(f"Unable to bind to {pool.server.host}; reason={conn.result.get('description')}")
+    return conn
+
+
+def pipeline(conn, requests, pool=None, window=PIPELINE_WINDOW):
+    """Send requests without waiting for previous responses (up to ``window`` outstanding).
+
+    Each request is a ``(operation, dn, changes, send)`` tuple where ``send``
+    issues the operation and returns its message ID. Returns list of ``BatchResult``
+    in the same order as requests.
+    """
+    results = []
+    outstanding = deque()
+
+    def collect():
+        operation, dn, changes, message_id, sent_at = outstanding.popleft()
+        _, result = conn.get_response(message_id)
+        if pool:
+            pool.notify(operation, time.perf_counter() - sent_at, result)
+        results.append(BatchResult(operation, dn, changes, result))
+
+    for operation, dn, changes, send in requests:
+        if len(outstanding) >= window:
+            collect()
+        outstanding.append((operation, dn, changes, send(), time.perf_counter()))
+
+    while outstanding:
+        collect()
+    return results
+
+
+def apply_batch(pool, changes=(), entries=()):
+    """Apply modify ``changes`` and add ``entries`` (list of ``(dn, attributes)``).
+
+    Operations in a batch must not depend on each other, as their order on the
+    server is not guaranteed. If a merged modify fails, changes of its DN are
+    retried one by one, so a single rejected change doesn't discard the others
+    and the result is reported per change.
+    """
+    conn = open_async_connection(pool)
+    try:
+        requests = [
+            ("modify", dn, dn_changes, lambda dn=dn, dn_changes=dn_changes: conn.modify(dn, to_modify_request(dn_changes)))
+            for dn, dn_changes in group_changes(changes).items()
+        ]
+        requests += [
+            ("add", dn, [], lambda dn=dn, attrs=attrs: conn.add(dn, attributes=attrs))
+            for dn, attrs in entries
+        ]
+        results = pipeline(conn, requests, pool)
+
+        retries = [
+            ("modify", change.dn, [change], lambda change=change: conn.modify(change.dn, to_modify_request([change])))
+            for item in results
+            if item.operation == "modify" and len(item.changes) > 1 and item.result["description"] != "success"
+            for change in item.changes
+        ]
+        if retries:
+            failed = {dn for _, dn, _, _ in retries}
+            results = [item for item in results if item.operation != "modify" or item.dn not in failed]
+            results += pipeline(conn, retries, pool)
+        return results
+    finally:
+        conn.unbind()
+
+
+def log_failures(results):
+    for item in results:
+        if item.result["description"] != "success":
+            logger.warning(f"Unable to {item.operation} {item.dn}; reason={item.result['message'] or item.result['description']}")
@@ -0,0 +1,276 @@
+"""Shared pool of LDAPS connections.
+
+Connections are bound once and reused across callers (threads or asyncio tasks),
+TLS sessions are resumed when new connections are opened, idle connections are
+checked before reuse, and each operation can be observed through timing hooks.
+
+Example:
+
+    pool = get_pool(manager)
+    with pool.connection() as conn:
+        conn.search("o=gluu", "(objectClass=*)", ldap3.BASE)
+"""
+import contextlib
+import logging
+import os
+import ssl
+import threading
+import time
+from collections import deque
+
+import ldap3
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.core.exceptions import LDAPException
+from pygluu.containerlib.utils import decode_text
+
+from tracing import TRACING_ENABLED
+from tracing import ldap_hook
+
+logger = logging.getLogger("ldap_pool")
+
+#: idle connections are checked (using a root DSE search) before reuse if they
+#: have been idle longer than this (in seconds)
+IDLE_CHECK_INTERVAL = 5
+
+
+class PoolTimeout(LDAPException):
+    pass
+
+
+class SessionReusingTls(ldap3.Tls):
+    """TLS settings which share a single SSL context and resume the latest TLS
+    session, so new connections skip the full handshake.
+
+    Certificates are not validated, same as the default ``ldap3.Tls``.
+    """
+
+    def __init__(self):
+        super().__init__(validate=ssl.CERT_NONE)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        self.session = None
+
+    def wrap_socket(self, connection, do_handshake=False):
+        wrapped_socket = self.context.wrap_socket(
+            connection.socket,
+            server_side=False,
+            do_handshake_on_connect=do_handshake,
+            session=self.session,
+        )
+        if do_handshake and wrapped_socket.session:
+            self.session = wrapped_socket.session
+        connection.socket = wrapped_socket
+
+
+class TimedConnection(ldap3.Connection):
+    """Connection which reports elapsed time of each operation to hooks of its pool.
+    """
+
+    def __init__(self, *args, pool=None, **kwargs):
+        self.pool = pool
+        super().__init__(*args, **kwargs)
+
+    def _timed(self, operation, func, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if self.pool:
+                self.pool.notify(operation, time.perf_counter() - started_at, self.result)
+
+    def search(self, *args, **kwargs):
+        return self._timed("search", super().search, *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self._timed("add", super().add, *args, **kwargs)
+
+    def modify(self, *args, **kwargs):
+        return self._timed("modify", super().modify, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._timed("delete", super().delete, *args, **kwargs)
+
+    def modify_dn(self, *args, **kwargs):
+        return self._timed("modify_dn", super().modify_dn, *args, **kwargs)
+
+    def compare(self, *args, **kwargs):
+        return self._timed("compare", super().compare, *args, **kwargs)
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of bound connections to a single server.
+
+    :param host: Server address in ``host:port`` format.
+    :param user: Bind DN.
+    :param password: Bind password.
+    :param size: Maximum number of connections (in use and idle).
+    :param timeout: Seconds to wait for a free connection, and connect/receive timeout.
+    """
+
+    def __init__(self, host, user, password, size=4, timeout=30):
+        self.server = ldap3.Server(host, use_ssl=True, tls=SessionReusingTls(), connect_timeout=timeout)
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.hooks = []
+        if TRACING_ENABLED:
+            self.add_hook(ldap_hook(host))
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def add_hook(self, hook):
+        """Register ``hook(operation, elapsed, result)`` called after each operation.
+        """
+        self.hooks.append(hook)
+
+    def notify(self, operation, elapsed, result):
+        for hook in self.hooks:
+            try:
+                hook(operation, elapsed, result)
+            except Exception as exc:
+                logger.warning(f"Unable to run timing hook; reason={exc}")
+
+    def _new_connection(self):
+        conn = TimedConnection(
+            self.server, self.user, self.password,
+            pool=self, receive_timeout=self.timeout, raise_exceptions=False,
+        )
+        if not conn.bind():
+            conn.unbind()
+            raise LDAPException(f"Unable to bind to {self.server.host}; reason={conn.result.get('description')}")
+        return conn
+
+    def _is_usable(self, conn, last_used):
+        if conn.closed:
+            return False
+
+        # rebind if server has dropped the bind (i.e. after bind DN's password was changed)
+        if not conn.bound and not conn.rebind():
+            return False
+
+        if time.monotonic() - last_used < IDLE_CHECK_INTERVAL:
+            return True
+
+        try:
+            return conn.search("", "(objectClass=*)", ldap3.BASE, attributes=["1.1"])
+        except LDAPException:
+            return False
+
+    def _discard(self, conn):
+        with contextlib.suppress(LDAPException):
+            conn.unbind()
+
+    def acquire(self):
+        """Get a bound connection; must be returned by calling :meth:`release`.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No free connection to {self.server.host} after {self.timeout} seconds")
+
+        try:
+            while True:
+                with self._lock:
+                    # most recently used first, as they are less likely to be stale
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._new_connection()
+
+                conn, last_used = item
+                if self._is_usable(conn, last_used):
+                    return conn
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        if discard or conn.closed:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except LDAPCommunicationError:
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def aconnection(self):
+        """Asyncio variant of :meth:`connection`; waiting for a free connection
+        doesn't block the event loop (operations themselves are still blocking).
+        """
+        import asyncio
+
+        conn = await asyncio.get_running_loop().run_in_executor(None, self.acquire)
+        try:
+            yield conn
+        except LDAPCommunicationError:
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        """Unbind idle connections (i.e. before the server is stopped).
+        """
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+def get_pool_size():
+    try:
+        size = int(os.environ.get("GLUU_LDAP_POOL_SIZE", 4))
+        if size < 1:
+            size = 4
+    except ValueError:
+        size = 4
+    return size
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def new_pool(manager, host="localhost:1636", size=4):
+    """Create a pool of connections to ``host`` bound as ``ldap_binddn``.
+    """
+    user = manager.config.get("ldap_binddn")
+    password = decode_text(
+        manager.secret.get("encoded_ox_ldap_pw"),
+        manager.secret.get("encoded_salt")
+    )
+    return ConnectionPool(host, user, password, size=size)
+
+
+def get_pool(manager, host="localhost:1636"):
+    """Get the pool of connections to ``host`` shared by the whole process (created on first use).
+    """
+    with _pools_lock:
+        if host not in _pools:
+            _pools[host] = new_pool(manager, host, size=get_pool_size())
+        return _pools[host]
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
@@ -1,4 +1,3 @@
-import contextlib
 import json
 import logging
 import logging.config
@@ -7,96 +6,150 @@ import sys
 import time
 from collections import defaultdict
 
-from pygluu.containerlib import get_manager
-from pygluu.containerlib.utils import exec_cmd
+from ldap3.core.exceptions import LDAPException
 from pygluu.containerlib.utils import as_boolean
 
+from init_throttle import InitController
+from init_throttle import init_throttle_enabled
+from ldap_pool import get_pool
+from lease import seed_source
+from repl_health import auto_reinit_enabled
+from repl_health import find_broken_domains
+from repl_health import get_repl_health_interval
+from repl_health import get_repl_stall_timeout
+from repl_health import pick_reinit_source
+from repl_health import read_domain_states
+from repl_health import reinit_slot
+from seed import get_seeded_dns
+from seed import unmark_seeded_dn
 from settings import LOGGING_CONFIG
+from toolrunner import exec_cmd
+from topology import advertise_replication_server
+from topology import get_max_replication_servers
+from topology import get_topology_check_interval
+from topology import has_replication_server
+from topology import membership_signature
+from topology import pick_replication_server
+from topology import plan_replication_servers
+from topology import remove_replication_server
+from topology import runs_replication_server
+from tracing import get_manager
+from utils import OPENDJ_DIR
+from utils import admin_password_bound
+from utils import get_backends
 from utils import guess_serf_addr
 
-DEFAULT_ADMIN_PW_PATH = "/opt/opendj/.pw"
-
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("ldap_replicator")
 
 manager = get_manager()
 
 
-@contextlib.contextmanager
-def admin_password_bound(manager, password_file=DEFAULT_ADMIN_PW_PATH):
-    if not os.path.isfile(password_file):
-        manager.secret.to_file(
-            "encoded_ox_ldap_pw", password_file, decode=True,
-        )
+def enable_replication(peer, server, base_dn, password_file, replication_server=True):
+    """Enable replication of ``base_dn`` between ``peer`` and ``server``.
 
-    try:
-        yield password_file
-    except Exception:
-        raise
-    finally:
-        with contextlib.suppress(FileNotFoundError):
-            os.unlink(password_file)
+    If ``replication_server`` is false, ``server`` joins as directory server only,
+    hence ``peer`` must run a replication server.
+    """
+    ldap_binddn = manager.config.get("ldap_binddn")
+
+    if replication_server:
+        server_opts = [
+            f"--replicationPort2 {server['tags']['replication_port']}",
+            "--secureReplication2",
+        ]
+    else:
+        server_opts = ["--noReplicationServer2"]
+
+    enable_cmd = " ".join([
+        f"{OPENDJ_DIR}/bin/dsreplication",
+        "enable",
+        f"--host1 {peer['name']}",
+        f"--port1 {peer['tags']['admin_port']}",
+        f"--bindDN1 '{ldap_binddn}'",
+        f"--bindPasswordFile1 {password_file}",
+        f"--replicationPort1 {peer['tags']['replication_port']}",
+        "--secureReplication1",
+        f"--host2 {server['name']}",
+        f"--port2 {server['tags']['admin_port']}",
+        f"--bindDN2 '{ldap_binddn}'",
+        f"--bindPasswordFile2 {password_file}",
+    ] + server_opts + [
+        "--adminUID admin",
+        f"--adminPasswordFile {password_file}",
+        f"--baseDN '{base_dn}'",
+        "-X",
+        "-n",
+        "-Q",
+    ])
+    # logger.info(enable_cmd)
+    out, err, code = exec_cmd(enable_cmd)
+    if code:
+        err = err or out
+        logger.warning(err.decode().strip())
+    return code
 
 
-def replicate_from(peer, server, base_dn):
+def replicate_from(peer, server, base_dn, rs_peer=None):
     """Configure replication between 2 LDAP servers.
-    """
-    ldap_binddn = manager.config.get("ldap_binddn")
 
+    If ``rs_peer`` is set, current server joins as directory server only and
+    connects to replication server of ``rs_peer``, while data is still initialized
+    from ``peer``.
+    """
     with admin_password_bound(manager) as password_file:
         # enable replication for specific backend
-        logger.info(f"Enabling OpenDJ replication of {base_dn} between {peer['name']} and {server['name']}.")
-
-        enable_cmd = " ".join([
-            "/opt/opendj/bin/dsreplication",
-            "enable",
-            f"--host1 {peer['name']}",
-            f"--port1 {peer['tags']['admin_port']}",
-            f"--bindDN1 '{ldap_binddn}'",
-            f"--bindPasswordFile1 {password_file}",
-            f"--replicationPort1 {peer['tags']['replication_port']}",
-            "--secureReplication1",
-            f"--host2 {server['name']}",
-            f"--port2 {server['tags']['admin_port']}",
-            f"--bindDN2 '{ldap_binddn}'",
-            f"--bindPasswordFile2 {password_file}",
-            f"--replicationPort2 {server['tags']['replication_port']}",
-            "--secureReplication2",
-            "--adminUID admin",
-            f"--adminPasswordFile {password_file}",
-            f"--baseDN '{base_dn}'",
-            "-X",
-            "-n",
-            "-Q",
-        ])
-        # logger.info(enable_cmd)
-        out, err, code = exec_cmd(enable_cmd)
-        if code:
-            err = err or out
-            logger.warning(err.decode().strip())
-
-        # initialize replication for specific backend
-        logger.info(f"Initializing OpenDJ replication of {base_dn} between {peer['name']} and {server['name']}.")
-
-        init_cmd = " ".join([
-            "/opt/opendj/bin/dsreplication",
-            "initialize",
-            f"--baseDN '{base_dn}'",
-            "--adminUID admin",
-            f"--adminPasswordFile {password_file}",
-            f"--hostSource {peer['name']}",
-            f"--portSource {peer['tags']['admin_port']}",
-            f"--hostDestination {server['name']}",
-            f"--portDestination {server['tags']['admin_port']}",
-            "-X",
-            "-n",
-            "-Q",
-        ])
-        # logger.info(init_cmd)
+        if rs_peer:
+            logger.info(
+                f"Enabling OpenDJ replication of {base_dn} between {rs_peer['name']} and {server['name']} "
+                "(directory server only)."
+            )
+            code = enable_replication(rs_peer, server, base_dn, password_file, replication_server=False)
+        else:
+            logger.info(f"Enabling OpenDJ replication of {base_dn} between {peer['name']} and {server['name']}.")
+            code = enable_replication(peer, server, base_dn, password_file)
+
+        # data imported from seed already shares the generation ID and replication state
+        # with its source, hence replication only needs to replay changes made after the export
+        if not code and base_dn in get_seeded_dns():
+            logger.info(f"Skipping initialization of {base_dn} as it has been seeded from export.")
+            unmark_seeded_dn(base_dn)
+            return
+
+        initialize_replication(peer, server, base_dn, password_file)
+
+
+def initialize_replication(peer, server, base_dn, password_file):
+    """Overwrite data of ``base_dn`` in current server with data of ``peer``.
+
+    Returns exit code of ``dsreplication initialize``.
+    """
+    logger.info(f"Initializing OpenDJ replication of {base_dn} between {peer['name']} and {server['name']}.")
+
+    init_cmd = " ".join([
+        f"{OPENDJ_DIR}/bin/dsreplication",
+        "initialize",
+        f"--baseDN '{base_dn}'",
+        "--adminUID admin",
+        f"--adminPasswordFile {password_file}",
+        f"--hostSource {peer['name']}",
+        f"--portSource {peer['tags']['admin_port']}",
+        f"--hostDestination {server['name']}",
+        f"--portDestination {server['tags']['admin_port']}",
+        "-X",
+        "-n",
+        "-Q",
+    ])
+    # logger.info(init_cmd)
+    if init_throttle_enabled():
+        # wait for the source to calm down and size the window from its latency
+        out, err, code = InitController(manager, peer, base_dn, password_file).run(init_cmd)
+    else:
         out, err, code = exec_cmd(init_cmd)
-        if code:
-            err = err or out
-            logger.warning(err.decode().strip())
+    if code:
+        err = err or out
+        logger.warning(err.decode().strip())
+    return code
 
 
 def check_required_entry(host, port, user, base_dn):
@@ -106,13 +159,16 @@ def check_required_entry(host, port, user, base_dn):
         dn = "ou=statistic,o=metric"
     elif base_dn == "o=site":
         dn = "ou=cache-refresh,o=site"
-    else:
+    elif base_dn == "o=gluu":
         client_id = manager.config.get('oxauth_client_id')
         dn = f"inum={client_id},ou=clients,{base_dn}"
+    else:
+        # split backends only have their base entry
+        dn = base_dn
 
     with admin_password_bound(manager) as password_file:
         cmd = " ".join([
-            "/opt/opendj/bin/ldapsearch",
+            f"{OPENDJ_DIR}/bin/ldapsearch",
             f"--hostname {host}",
             f"--port {port}",
             f"--baseDN '{dn}'",
@@ -129,7 +185,7 @@ def check_required_entry(host, port, user, base_dn):
 
 def get_ldap_status(bind_dn):
     with admin_password_bound(manager) as password_file:
-        cmd = f"/opt/opendj/bin/status -D '{bind_dn}' --bindPasswordFile {password_file} --connectTimeout 10000 -X"
+        cmd = f"{OPENDJ_DIR}/bin/status -D '{bind_dn}' --bindPasswordFile {password_file} --connectTimeout 10000 -X"
         out, err, code = exec_cmd(cmd)
         return out.strip(), err.strip(), code
 
@@ -198,9 +254,10 @@ def get_datasources(user, interval, non_repl_only=True):
             entry_num = src.split(":")[-1].strip()
             datasources[dn]["entries"] = int(entry_num)
 
+    base_dns = get_backends().values()
     datasources = {
         k: v for k, v in datasources.items()
-        if k in ("o=gluu", "o=site", "o=metric")
+        if k in base_dns
     }
 
     if non_repl_only:
@@ -286,6 +343,172 @@ def get_server_info():
     return server
 
 
+def get_replication_server_peer(server, peers):
+    """Get a peer whose replication server is used by current server, if the
+    topology plan makes current server a directory server only (``None`` otherwise).
+    """
+    members = peers + [dict(server, tags=dict(server["tags"], replication_server="false"))]
+    if server["name"] in plan_replication_servers(members):
+        return None
+
+    # without a running replication server (i.e. the first peers of the cluster),
+    # current server has to run one
+    return pick_replication_server(peers, server["tags"].get("zone", ""))
+
+
+def rebalance_topology(server, ldap_user, members):
+    """Start or stop the local replication server to follow the topology plan.
+
+    Returns ``True`` if current server matches the plan.
+    """
+    out, _, code = get_ldap_status(ldap_user)
+    if code != 0:
+        logger.warning(f"Unable to get status from LDAP server; reason={out.decode()}")
+        return False
+
+    active = has_replication_server(out.decode())
+    # tags of current server in Serf may lag behind, hence use the actual state
+    members = [member for member in members if member["name"] != server["name"]]
+    local = dict(server, tags=dict(server["tags"], replication_server=str(active).lower()))
+    planned = plan_replication_servers(members + [local])
+
+    if (server["name"] in planned) == active:
+        advertise_replication_server(active)
+        return True
+
+    with admin_password_bound(manager) as password_file:
+        if not active:
+            rs_peer = pick_replication_server(members, server["tags"].get("zone", ""))
+            if not rs_peer:
+                return False
+
+            logger.info(f"Starting replication server as planned by topology (connected to {rs_peer['name']})")
+            codes = [
+                enable_replication(rs_peer, server, base_dn, password_file)
+                for base_dn in get_backends().values()
+            ]
+            if any(codes):
+                return False
+        else:
+            # stop only after every planned member runs a replication server,
+            # so the cluster never has less replication servers than planned
+            if not all(runs_replication_server(member) for member in members if member["name"] in planned):
+                logger.info("Waiting for planned replication servers before stopping the local one")
+                return False
+
+            logger.info("Stopping replication server as it's not planned by topology")
+            if not remove_replication_server(server, password_file):
+                return False
+
+    advertise_replication_server(not active)
+    return True
+
+
+def read_server_domain_states(name, host="localhost:1636"):
+    """Get state of replication domains of a server, or ``None`` if it's unreachable.
+    """
+    try:
+        with get_pool(manager, host).connection() as conn:
+            return read_domain_states(conn)
+    except LDAPException as exc:
+        logger.warning(f"Unable to read replication state of {name}; reason={exc}")
+        return None
+
+
+def repair_replication(server, members):
+    """Re-initialize backends whose replication silently stopped, one at a time, from a healthy peer.
+    """
+    peers = [member for member in members if member["name"] != server["name"]]
+    if not peers:
+        return
+
+    timeout = get_repl_stall_timeout()
+    local_states = read_server_domain_states(server["name"])
+    if local_states is None:
+        return
+
+    peer_states = {}
+    for peer in peers:
+        states = read_server_domain_states(peer["name"], f"{peer['name']}:{peer['tags']['ldaps_port']}")
+        if states is not None:
+            peer_states[peer["name"]] = states
+    broken = find_broken_domains(local_states, peer_states, get_backends().values(), timeout)
+
+    for base_dn, reason in broken.items():
+        logger.warning(f"Replication of {base_dn} is broken; {reason}")
+
+        peer = pick_reinit_source(peers, local_states, peer_states, base_dn, timeout)
+        if not peer:
+            logger.warning(f"No healthy peer to re-initialize {base_dn} from")
+            continue
+
+        with reinit_slot(manager, base_dn, server["name"]) as acquired:
+            if not acquired:
+                logger.info(f"Skipping re-initialization of {base_dn}; done recently or in progress on another server")
+                continue
+
+            # states may have changed since they were read (i.e. the source has just been re-initialized)
+            local_states = read_server_domain_states(server["name"])
+            source_states = read_server_domain_states(peer["name"], f"{peer['name']}:{peer['tags']['ldaps_port']}")
+            if not local_states or not source_states:
+                continue
+            peer_states[peer["name"]] = source_states
+            if base_dn not in find_broken_domains(local_states, peer_states, [base_dn], timeout):
+                continue
+
+            with admin_password_bound(manager) as password_file:
+                if not initialize_replication(peer, server, base_dn, password_file):
+                    logger.info(f"Re-initialized {base_dn} from {peer['name']}")
+
+
+def watch_replication(server, ldap_user):
+    """Rebalance replication servers whenever membership (or topology tags) changes,
+    and repair replication of backends which silently stopped.
+    """
+    topology_enabled = bool(get_max_replication_servers())
+    reinit_enabled = auto_reinit_enabled()
+    if not topology_enabled and not reinit_enabled:
+        return
+
+    signature = None
+    next_topology_check = next_health_check = 0
+
+    while True:
+        members = peers_from_serf_membership()
+
+        if topology_enabled and time.monotonic() >= next_topology_check:
+            current = membership_signature(members)
+            # retry on the next check unless current server has settled
+            if current != signature and rebalance_topology(server, ldap_user, members):
+                signature = current
+            next_topology_check = time.monotonic() + get_topology_check_interval()
+
+        if reinit_enabled and time.monotonic() >= next_health_check:
+            repair_replication(server, members)
+            next_health_check = time.monotonic() + get_repl_health_interval()
+
+        next_checks = []
+        if topology_enabled:
+            next_checks.append(next_topology_check)
+        if reinit_enabled:
+            next_checks.append(next_health_check)
+        time.sleep(max(1, min(next_checks) - time.monotonic()))
+
+
+def advertise_actual_replication_server(server, ldap_user):
+    """Advertise whether current server runs a replication server; the tag is reset
+    to ``false`` on every boot, while a replication server may have been configured earlier.
+    """
+    out, _, code = get_ldap_status(ldap_user)
+    if code != 0:
+        logger.warning(f"Unable to get status from LDAP server; reason={out.decode()}")
+        return
+
+    active = has_replication_server(out.decode())
+    server["tags"]["replication_server"] = str(active).lower()
+    advertise_replication_server(active)
+
+
 def main():
     auto_repl = as_boolean(os.environ.get("GLUU_LDAP_AUTO_REPLICATE", True))
     if not auto_repl:
@@ -294,6 +517,7 @@ def main():
 
     server = get_server_info()
     ldap_user = manager.config.get("ldap_binddn")
+    advertise_actual_replication_server(server, ldap_user)
 
     interval = get_repl_interval()
     max_retries = get_repl_max_retries()
@@ -302,24 +526,24 @@ def main():
     while retry < max_retries:
         logger.info(f"Checking replicated backends (attempt {retry + 1})")
 
-        peers = peers_from_serf_membership()
-
-        for peer in peers:
-            if peer["name"] == server["name"]:
-                continue
+        datasources = get_datasources(ldap_user, interval)
 
-            datasources = get_datasources(ldap_user, interval)
+        # if there's no backend that need to be replicated, skip the rest of the process;
+        # note, backends whose Generation ID differs from peers (or which stopped replaying
+        # changes) are re-initialized later by ``watch_replication``; please refer to
+        # https://backstage.forgerock.com/knowledge/kb/article/a36616593 for details
+        if not datasources:
+            logger.info("All required backends have been replicated")
+            break
 
-            # if there's no backend that need to be replicated, skip the rest of the process;
-            # note, in some cases the Generation ID will be different due to mismatched data structure
-            # to fix this issue we can re-init replication manually; please refer to
-            # https://backstage.forgerock.com/knowledge/kb/article/a36616593 for details
-            if not datasources:
-                logger.info("All required backends have been replicated")
-                return
+        peers = [
+            peer for peer in peers_from_serf_membership()
+            if peer["name"] != server["name"]
+        ]
+        rs_peer = get_replication_server_peer(server, peers)
 
-            logger.info(f"Found peer at {peer['name']}")
-            for dn, _ in datasources.items():
+        def has_data(peer):
+            for dn in datasources:
                 _, err, code = check_required_entry(
                     peer["name"], peer["tags"]["ldaps_port"], ldap_user, dn,
                 )
@@ -327,16 +551,32 @@ def main():
                     logger.warning(
                         f"Unable to get required entry at LDAP server {peer['name']}; reason={err.decode()}"
                     )
-                    continue
-
-                # replicate from server that has data; note: can't assume the
-                # whole replication process is succeed, hence subsequence checks
-                # will be executed
-                replicate_from(peer, server, dn)
+                    return False
+            return True
+
+        # take a seeding lease from the least busy source (that has data) to cap
+        # concurrent initializations per source when many servers join at once
+        with seed_source(manager, peers, server["name"], has_data) as peer:
+            if not peer:
+                logger.info("No seeding source is available at the moment")
+            else:
+                logger.info(f"Found peer at {peer['name']}")
+
+                for dn, _ in datasources.items():
+                    # replicate from server that has data; note: can't assume the
+                    # whole replication process is succeed, hence subsequence checks
+                    # will be executed
+                    replicate_from(peer, server, dn, rs_peer)
 
         # delay between next check
         time.sleep(interval)
         retry += 1
+    else:
+        # i.e. the first server of a cluster has no peer to replicate from; it still
+        # needs to follow the topology plan once peers join and enable replication with it
+        logger.warning(f"Unable to replicate all required backends after {max_retries} attempts")
+
+    watch_replication(server, ldap_user)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import contextlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from utils import backoff_delays
+
+logger = logging.getLogger("lease")
+
+#: config key (next to ``serf_peers``) that holds seeding leases, keyed by source name
+SEED_LEASES_KEY = "serf_seed_leases"
+
+
+def get_seed_max_concurrency():
+    try:
+        limit = int(os.environ.get("GLUU_LDAP_SEED_MAX_CONCURRENCY", 1))
+        if limit < 1:
+            limit = 1
+    except ValueError:
+        limit = 1
+    return limit
+
+
+def get_seed_lease_ttl():
+    try:
+        ttl = int(os.environ.get("GLUU_LDAP_SEED_LEASE_TTL", 600))
+        if ttl < 30:
+            ttl = 600
+    except ValueError:
+        ttl = 600
+    return ttl
+
+
+def _configmap_ref(adapter):
+    settings = getattr(adapter, "settings", None) or os.environ
+    return (
+        settings.get("GLUU_CONFIG_KUBERNETES_CONFIGMAP", "gluu"),
+        settings.get("GLUU_CONFIG_KUBERNETES_NAMESPACE", "default"),
+    )
+
+
+def _configmap_compare_and_set(adapter, key, expected, value):
+    """Replace the ConfigMap only if it hasn't changed since it was read; the API server
+    rejects the update (409 Conflict) if ``resourceVersion`` of the ConfigMap is outdated.
+
+    Note, each call transfers the whole ConfigMap twice, and fails on any concurrent
+    write to it (not only to ``key``).
+    """
+    from kubernetes.client.rest import ApiException
+
+    name, namespace = _configmap_ref(adapter)
+    configmap = adapter.client.read_namespaced_config_map(name=name, namespace=namespace)
+    data = configmap.data or {}
+    if data.get(key) != expected:
+        return False
+
+    # ``value`` of ``None`` removes the key
+    if value is None:
+        data.pop(key, None)
+    else:
+        data[key] = value
+    configmap.data = data
+
+    try:
+        adapter.client.replace_namespaced_config_map(name=name, namespace=namespace, body=configmap)
+    except ApiException as exc:
+        if exc.status == 409:
+            return False
+        raise
+    return True
+
+
+def compare_and_set(manager, key, expected, value):
+    """Set ``key`` to ``value`` only if its current value equals ``expected``;
+    ``value`` of ``None`` removes the key.
+
+    The update is atomic with both supported config adapters: Consul adapter uses
+    check-and-set (``cas``) index of the key, and Kubernetes adapter uses
+    ``resourceVersion`` of the ConfigMap. Other adapters fall back to read-modify-write
+    followed by read-back verification, which narrows (but doesn't close) the race window.
+    """
+    adapter = getattr(manager.config, "adapter", None)
+    client = getattr(adapter, "client", None)
+
+    if hasattr(adapter, "_merge_path") and hasattr(client, "kv"):
+        path = adapter._merge_path(key)
+        _, item = client.kv.get(path)
+        current = item["Value"].decode() if item and item["Value"] is not None else None
+        if current != expected:
+            return False
+        index = item["ModifyIndex"] if item else 0
+        if value is None:
+            return bool(client.kv.delete(path, cas=index))
+        return bool(client.kv.put(path, value, cas=index))
+
+    if hasattr(client, "replace_namespaced_config_map"):
+        return _configmap_compare_and_set(adapter, key, expected, value)
+
+    if manager.config.get(key) != expected:
+        return False
+    # without a way to remove keys, an empty value marks a removed key
+    manager.config.set(key, "" if value is None else value)
+    return manager.config.get(key) == ("" if value is None else value)
+
+
+def _prune_leases(leases, now):
+    return {
+        name: {holder: expiry for holder, expiry in holders.items() if expiry > now}
+        for name, holders in leases.items()
+        if any(expiry > now for expiry in holders.values())
+    }
+
+
+def update_leases(manager, key, mutate, max_attempts=20):
+    """Atomically apply ``mutate`` to leases stored in ``key``.
+
+    Leases are stored in the following structure:
+
+        {"<name>": {"<holder>": <expiry timestamp>}}
+
+    The ``mutate`` callable receives leases (with expired entries removed) and
+    modifies them in-place; it returns ``False`` to abort the update.
+    Returns the leases as written, or ``None`` if the update was aborted or
+    lost the race too many times.
+
+    Concurrent updates are only safe with Consul or Kubernetes config adapter
+    (see ``compare_and_set``).
+    """
+    delays = backoff_delays(0.05, 2.0)
+
+    for _ in range(max_attempts):
+        raw = manager.config.get(key)
+        try:
+            leases = json.loads(raw) if raw else {}
+        except json.JSONDecodeError:
+            leases = {}
+
+        leases = _prune_leases(leases, time.time())
+        if mutate(leases) is False:
+            return None
+
+        if compare_and_set(manager, key, raw, json.dumps(leases)):
+            return leases
+        time.sleep(next(delays))
+
+    logger.warning(f"Unable to update {key} after {max_attempts} attempts")
+    return None
+
+
+def get_leases(manager, key):
+    try:
+        leases = json.loads(manager.config.get(key, "{}"))
+    except json.JSONDecodeError:
+        leases = {}
+    return _prune_leases(leases, time.time())
+
+
+def acquire_lease(manager, key, name, holder, limit, ttl):
+    def mutate(leases):
+        holders = leases.setdefault(name, {})
+        if holder not in holders and len(holders) >= limit:
+            return False
+        holders[holder] = time.time() + ttl
+
+    return update_leases(manager, key, mutate) is not None
+
+
+def renew_lease(manager, key, name, holder, ttl):
+    def mutate(leases):
+        leases.setdefault(name, {})[holder] = time.time() + ttl
+
+    return update_leases(manager, key, mutate) is not None
+
+
+def release_lease(manager, key, name, holder):
+    def mutate(leases):
+        holders = leases.get(name, {})
+        if holder not in holders:
+            return False
+        holders.pop(holder)
+        if not holders:
+            leases.pop(name)
+
+    update_leases(manager, key, mutate)
+
+
+@contextlib.contextmanager
+def lease_renewed(manager, key, name, holder, ttl):
+    """Renew an acquired lease in background and release it at the end of the context.
+    """
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(ttl / 3):
+            if not renew_lease(manager, key, name, holder, ttl):
+                logger.warning(f"Unable to renew lease {name} in {key}")
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+
+    try:
+        yield
+    finally:
+        stopped.set()
+        renewer.join()
+        release_lease(manager, key, name, holder)
+
+
+def pick_seed_sources(peers, leases):
+    """Order candidate sources by their load.
+
+    Peers that are being seeded themselves (i.e. holding a lease) are excluded;
+    peers which have no data yet (i.e. new or failed to seed) aren't holding a
+    lease either, hence ``seed_source`` checks each candidate before leasing it.
+    """
+    seeding = {holder for holders in leases.values() for holder in holders}
+    candidates = [peer for peer in peers if peer["name"] not in seeding]
+    random.shuffle(candidates)
+    return sorted(candidates, key=lambda peer: len(leases.get(peer["name"], {})))
+
+
+@contextlib.contextmanager
+def seed_source(manager, peers, holder, has_data=None):
+    """Acquire a seeding slot from the least busy source among ``peers``.
+
+    Candidates for which ``has_data(peer)`` is false are skipped, so the slot is
+    only taken from a peer that has data to seed from.
+    Yields the chosen peer (or ``None`` if every source is at its concurrency limit
+    or has no data); the lease is renewed in background and released at the end of the context.
+    """
+    limit = get_seed_max_concurrency()
+    ttl = get_seed_lease_ttl()
+
+    peer = None
+    for candidate in pick_seed_sources(peers, get_leases(manager, SEED_LEASES_KEY)):
+        if has_data and not has_data(candidate):
+            logger.info(f"Skipping seeding source {candidate['name']} as it has no data yet")
+            continue
+        if acquire_lease(manager, SEED_LEASES_KEY, candidate["name"], holder, limit, ttl):
+            peer = candidate
+            break
+
+    if not peer:
+        yield None
+        return
+
+    logger.info(f"Acquired seeding lease from {peer['name']} (limit={limit}, ttl={ttl}s)")
+    with lease_renewed(manager, SEED_LEASES_KEY, peer["name"], holder, ttl):
+        yield peer
+    logger.info(f"Released seeding lease from {peer['name']}")
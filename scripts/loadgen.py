@@ -0,0 +1,282 @@
+"""Generate Gluu-shaped LDAP load against the local server.
+
+Usage (inside a running container):
+
+    python3 /app/scripts/loadgen.py run [--mix oxauth] [--connections 64] [--duration 60] [--seed] [--output result.json]
+    python3 /app/scripts/loadgen.py compare baseline.json candidate.json
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import ldap3
+from pygluu.containerlib import get_manager
+
+from dataset import client_entry
+from dataset import container_entries
+from dataset import metric_entry
+from dataset import person_entry
+from dataset import token_entry
+from ldap_pool import new_pool
+
+#: operation weights of predefined mixes
+MIXES = {
+    # oxAuth authorization/token flows
+    "oxauth": {"client_lookup": 35, "user_search": 20, "token_add": 20, "token_delete": 15, "metric_add": 10},
+    "read": {"client_lookup": 60, "user_search": 40},
+    "write": {"token_add": 50, "token_delete": 40, "metric_add": 10},
+}
+
+#: histogram bucket boundaries in milliseconds (4 buckets per power of 2, from 50us to ~30s)
+BUCKETS = [0.05 * 2 ** (i / 4) for i in range(80)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.errors = 0
+        self.max = 0.0
+
+    def record(self, latency_ms):
+        self.counts[bisect.bisect_left(BUCKETS, latency_ms)] += 1
+        self.total += 1
+        self.max = max(self.max, latency_ms)
+
+    def percentile(self, pct):
+        if not self.total:
+            return 0.0
+
+        rank = math.ceil(pct / 100 * self.total)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.errors += other.errors
+        self.max = max(self.max, other.max)
+
+    def to_dict(self, elapsed):
+        return {
+            "count": self.total,
+            "errors": self.errors,
+            "throughput": self.total / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9),
+                "max": self.max,
+            },
+            # non-empty buckets as upper bound (ms) and count
+            "histogram": [
+                [BUCKETS[index] if index < len(BUCKETS) else None, count]
+                for index, count in enumerate(self.counts) if count
+            ],
+        }
+
+
+class Worker:
+    """Run operations on its own connection; tracks tokens it has added so it can delete them.
+    """
+
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.tokens = deque()
+
+    def client_lookup(self):
+        index = random.randrange(self.args.clients)
+        attr = random.choice(["inum", "oxAuthClientId"])
+        self.conn.search(f"ou=clients,{self.args.base_dn}", f"({attr}=client-{index})", ldap3.SUBTREE, attributes=["*"])
+        return self.conn.result["description"] == "success"
+
+    def user_search(self):
+        index = random.randrange(self.args.people)
+        attr, value = random.choice([("uid", f"user{index}"), ("mail", f"user{index}@example.com")])
+        self.conn.search(f"ou=people,{self.args.base_dn}", f"({attr}={value})", ldap3.SUBTREE, attributes=["*"])
+        return self.conn.result["description"] == "success"
+
+    def token_add(self):
+        dn, attrs = token_entry(self.args.base_dn, people=self.args.people, clients=self.args.clients)
+        self.conn.add(dn, attributes=attrs)
+        if self.conn.result["description"] != "success":
+            return False
+        self.tokens.append(dn)
+        return True
+
+    def token_delete(self):
+        if not self.tokens:
+            return self.token_add()
+        self.conn.delete(self.tokens.popleft())
+        return self.conn.result["description"] == "success"
+
+    def metric_add(self):
+        dn, attrs = metric_entry()
+        self.conn.add(dn, attributes=attrs)
+        return self.conn.result["description"] == "success"
+
+    def cleanup(self):
+        while self.tokens:
+            self.conn.delete(self.tokens.popleft())
+
+
+def seed_data(conn, args):
+    """Add synthetic people and clients (and missing containers) used by the load.
+    """
+    entries = container_entries(args.base_dn)[1:] + [container_entries("o=metric")[0]]
+    entries.append(("ou=statistic,o=metric", {"objectClass": ["top", "organizationalUnit"], "ou": ["statistic"]}))
+    entries += [person_entry(args.base_dn, index) for index in range(args.people)]
+    entries += [client_entry(args.base_dn, index) for index in range(args.clients)]
+
+    for dn, attrs in entries:
+        conn.add(dn, attributes=attrs)
+
+
+def parse_mix(value):
+    if value in MIXES:
+        return MIXES[value]
+    # custom mix, i.e. client_lookup=50,token_add=50
+    return {name: int(weight) for name, weight in (item.split("=") for item in value.split(","))}
+
+
+async def run_load(pool, mix, args):
+    """Run operations of ``mix`` across ``args.connections`` concurrent connections
+    taken from ``pool``.
+
+    Returns per-operation histograms and elapsed time.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=args.connections)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    conns = await asyncio.gather(*[
+        loop.run_in_executor(executor, pool.acquire) for _ in range(args.connections)
+    ])
+    workers = [Worker(conn, args) for conn in conns]
+    histograms = {name: Histogram() for name in names}
+
+    async def drive(worker, deadline):
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            started_at = time.perf_counter()
+            ok = await loop.run_in_executor(executor, getattr(worker, name))
+            histograms[name].record((time.perf_counter() - started_at) * 1000)
+            if not ok:
+                histograms[name].errors += 1
+
+    started_at = time.monotonic()
+    await asyncio.gather(*[drive(worker, started_at + args.duration) for worker in workers])
+    elapsed = time.monotonic() - started_at
+
+    def close(worker):
+        worker.cleanup()
+        pool.release(worker.conn)
+
+    await asyncio.gather(*[loop.run_in_executor(executor, close, worker) for worker in workers])
+    executor.shutdown()
+    return histograms, elapsed
+
+
+def build_result(mix, args, histograms, elapsed):
+    total = Histogram()
+    for histogram in histograms.values():
+        total.merge(histogram)
+
+    return {
+        "started_at": time.time() - elapsed,
+        "mix": mix,
+        "connections": args.connections,
+        "duration": elapsed,
+        "operations": {name: histogram.to_dict(elapsed) for name, histogram in histograms.items()},
+        "total": total.to_dict(elapsed),
+    }
+
+
+def compare(baseline, candidate):
+    """Print throughput and latency changes between 2 results.
+    """
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    names = sorted(set(baseline["operations"]) | set(candidate["operations"])) + ["total"]
+    print(f"{'operation':<16}{'throughput':>14}{'p50':>10}{'p99':>10}")
+    for name in names:
+        old = baseline["total"] if name == "total" else baseline["operations"].get(name)
+        new = candidate["total"] if name == "total" else candidate["operations"].get(name)
+        if not old or not new:
+            continue
+        print(
+            f"{name:<16}{change(old['throughput'], new['throughput']):>14}"
+            f"{change(old['latency_ms']['p50'], new['latency_ms']['p50']):>10}"
+            f"{change(old['latency_ms']['p99'], new['latency_ms']['p99']):>10}"
+        )
+
+
+def add_load_args(parser):
+    parser.add_argument("--mix", default="oxauth", help=f"One of {', '.join(MIXES)} or custom weights, i.e. client_lookup=50,token_add=50")
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--duration", type=int, default=60, help="Duration in seconds")
+    parser.add_argument("--base-dn", default="o=gluu")
+    parser.add_argument("--people", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Gluu-shaped LDAP load")
+    subparsers = parser.add_subparsers(dest="action")
+
+    run_parser = subparsers.add_parser("run")
+    add_load_args(run_parser)
+    run_parser.add_argument("--seed", action="store_true", help="Add synthetic people and clients before running")
+    run_parser.add_argument("--output", help="Save result as JSON file")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+
+    if args.action == "compare":
+        with open(args.baseline) as f1, open(args.candidate) as f2:
+            compare(json.load(f1), json.load(f2))
+        return
+
+    if args.action != "run":
+        parser.print_help()
+        sys.exit(1)
+
+    pool = new_pool(get_manager(), size=args.connections)
+    if args.seed:
+        with pool.connection() as conn:
+            seed_data(conn, args)
+
+    mix = parse_mix(args.mix)
+    histograms, elapsed = asyncio.run(run_load(pool, mix, args))
+    result = build_result(mix, args, histograms, elapsed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    for name, stats in list(result["operations"].items()) + [("total", result["total"])]:
+        print(
+            f"{name:<16}{stats['count']:>10} ops{stats['throughput']:>10.1f} ops/s"
+            f"  p50={stats['latency_ms']['p50']:.2f}ms p99={stats['latency_ms']['p99']:.2f}ms errors={stats['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
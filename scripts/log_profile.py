@@ -0,0 +1,167 @@
+"""Logging profile of access and audit loggers.
+
+With the ``sync`` profile, loggers keep OpenDJ defaults: each record is written
+and flushed by the worker thread processing the request, so every write pays for
+a synchronous append to both access and audit log.
+
+With the ``buffered`` profile, records are handed to a queue drained by a
+dedicated thread, written into a buffer of ``GLUU_LDAP_LOG_BUFFER_SIZE`` KB, and
+flushed every ``GLUU_LDAP_LOG_FLUSH_INTERVAL`` ms. Log files are rotated by size
+and daily, and only the newest ``GLUU_LDAP_LOG_RETENTION_FILES`` files are kept.
+
+Independently of the profile, writes under ``GLUU_LDAP_AUDIT_EXCLUDE_SUBTREES``
+(i.e. short-lived tokens) are left out of the audit log.
+"""
+import json
+import logging
+import os
+
+import ldap3
+
+logger = logging.getLogger("entrypoint")
+
+PROFILE_SYNC = "sync"
+PROFILE_BUFFERED = "buffered"
+
+ACCESS_LOGGER_DN = "cn=File-Based Access Logger,cn=Loggers,cn=config"
+AUDIT_LOGGER_DN = "cn=File-Based Audit Logger,cn=Loggers,cn=config"
+
+SIZE_ROTATION_POLICY_DN = "cn=Size Limit Rotation Policy,cn=Log Rotation Policies,cn=config"
+TIME_ROTATION_POLICY_DN = "cn=24 Hours Time Limit Rotation Policy,cn=Log Rotation Policies,cn=config"
+FILE_COUNT_RETENTION_POLICY_DN = "cn=File Count Retention Policy,cn=Log Retention Policies,cn=config"
+
+#: operations recorded by the audit log
+WRITE_RECORD_TYPES = ["add", "delete", "modify", "rename"]
+
+
+def get_log_profile():
+    profile = os.environ.get("GLUU_LDAP_LOG_PROFILE", PROFILE_SYNC)
+    if profile not in (PROFILE_SYNC, PROFILE_BUFFERED):
+        logger.warning(f"Unsupported logging profile {profile}; falling back to {PROFILE_SYNC}")
+        profile = PROFILE_SYNC
+    return profile
+
+
+def get_log_buffer_size():
+    try:
+        size = int(os.environ.get("GLUU_LDAP_LOG_BUFFER_SIZE", 64))
+        if size < 1:
+            size = 64
+    except ValueError:
+        size = 64
+    return size
+
+
+def get_log_flush_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_LOG_FLUSH_INTERVAL", 5000))
+        if interval < 1:
+            interval = 5000
+    except ValueError:
+        interval = 5000
+    return interval
+
+
+def get_log_rotation_size():
+    try:
+        size = int(os.environ.get("GLUU_LDAP_LOG_ROTATION_SIZE", 100))
+        if size < 1:
+            size = 100
+    except ValueError:
+        size = 100
+    return size
+
+
+def get_log_retention_files():
+    try:
+        count = int(os.environ.get("GLUU_LDAP_LOG_RETENTION_FILES", 10))
+        if count < 1:
+            count = 10
+    except ValueError:
+        count = 10
+    return count
+
+
+def get_audit_exclude_subtrees():
+    try:
+        subtrees = json.loads(os.environ.get("GLUU_LDAP_AUDIT_EXCLUDE_SUBTREES", "[]"))
+        if not isinstance(subtrees, list):
+            subtrees = []
+    except json.JSONDecodeError:
+        subtrees = []
+    return subtrees
+
+
+def publisher_mods(dn, asynchronous=False, buffered=False):
+    """Get changes of a file-based publisher to (not) queue and buffer its records.
+    """
+    mods = [
+        (dn, "ds-cfg-asynchronous", str(asynchronous).lower(), ldap3.MODIFY_REPLACE),
+        (dn, "ds-cfg-auto-flush", str(not buffered).lower(), ldap3.MODIFY_REPLACE),
+    ]
+    if buffered:
+        mods += [
+            (dn, "ds-cfg-buffer-size", f"{get_log_buffer_size()} kb", ldap3.MODIFY_REPLACE),
+            (dn, "ds-cfg-time-interval", f"{get_log_flush_interval()} ms", ldap3.MODIFY_REPLACE),
+        ]
+    return mods
+
+
+def rotation_mods(dn):
+    """Get changes of a file-based publisher to rotate by size and daily, and keep a number of files.
+    """
+    return [
+        (dn, "ds-cfg-rotation-policy", [SIZE_ROTATION_POLICY_DN, TIME_ROTATION_POLICY_DN], ldap3.MODIFY_REPLACE),
+        (dn, "ds-cfg-retention-policy", [FILE_COUNT_RETENTION_POLICY_DN], ldap3.MODIFY_REPLACE),
+    ]
+
+
+def log_profile_mods(profile=None):
+    """Get changes of access and audit loggers for the logging ``profile``.
+    """
+    profile = profile or get_log_profile()
+
+    # audit log is disabled by default
+    mods = [(AUDIT_LOGGER_DN, "ds-cfg-enabled", "true", ldap3.MODIFY_REPLACE)]
+    if profile != PROFILE_BUFFERED:
+        return mods
+
+    for dn in (ACCESS_LOGGER_DN, AUDIT_LOGGER_DN):
+        mods += publisher_mods(dn, asynchronous=True, buffered=True)
+        mods += rotation_mods(dn)
+
+    mods += [
+        (SIZE_ROTATION_POLICY_DN, "ds-cfg-file-size-limit", f"{get_log_rotation_size()} mb", ldap3.MODIFY_REPLACE),
+        (FILE_COUNT_RETENTION_POLICY_DN, "ds-cfg-number-of-files", str(get_log_retention_files()), ldap3.MODIFY_REPLACE),
+    ]
+    return mods
+
+
+def filtering_criteria_entries(publisher_dn, subtrees, record_types=WRITE_RECORD_TYPES, prefix="exclude"):
+    """Get entries of filtering criteria matching ``record_types`` targeting (entries under) ``subtrees``.
+
+    The first entry is the parent of the criteria, hence must be added before the others.
+    """
+    parent_dn = f"cn=Filtering Criteria,{publisher_dn}"
+    entries = [(parent_dn, {"objectClass": ["top", "ds-cfg-branch"], "cn": ["Filtering Criteria"]})]
+
+    for index, subtree in enumerate(subtrees):
+        cn = f"{prefix}-{index}"
+        entries.append((
+            f"cn={cn},{parent_dn}",
+            {
+                "objectClass": ["top", "ds-cfg-access-log-filtering-criteria"],
+                "cn": [cn],
+                "ds-cfg-log-record-type": record_types,
+                # DN patterns; ``**`` matches any number of RDNs
+                "ds-cfg-request-target-dn-equal-to": [subtree, f"**,{subtree}"],
+            },
+        ))
+    return entries
+
+
+def audit_filtering_mods(subtrees):
+    """Get changes of the audit logger to drop records matching any of its criteria.
+    """
+    policy = "exclusive" if subtrees else "no-filtering"
+    return [(AUDIT_LOGGER_DN, "ds-cfg-filtering-policy", policy, ldap3.MODIFY_REPLACE)]
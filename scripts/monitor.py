@@ -0,0 +1,65 @@
+import time
+
+import ldap3
+
+
+def probe_latency(conn):
+    """Measure latency (in seconds) of a cheap search against the server.
+
+    The probe reads ``cn=Work Queue,cn=monitor``, hence it waits in the same
+    queue as client requests and reflects the load of the server.
+    Returns latency and the current request backlog.
+    """
+    started_at = time.monotonic()
+    conn.search(
+        search_base="cn=Work Queue,cn=monitor",
+        search_filter="(objectClass=*)",
+        search_scope=ldap3.BASE,
+        attributes=["currentRequestBacklog"],
+    )
+    latency = time.monotonic() - started_at
+
+    backlog = 0
+    if conn.entries:
+        try:
+            backlog = int(conn.entries[0]["currentRequestBacklog"].value or 0)
+        except (TypeError, ValueError):
+            backlog = 0
+    return latency, backlog
+
+
+def read_monitor_entries(conn, search_filter="(objectClass=*)", attributes=None, base="cn=monitor"):
+    """Get monitor entries as a mapping of DN and attributes.
+    """
+    conn.search(
+        search_base=base,
+        search_filter=search_filter,
+        search_scope=ldap3.SUBTREE,
+        attributes=attributes or ["*", "+"],
+    )
+    return {
+        entry.entry_dn: entry.entry_attributes_as_dict
+        for entry in conn.entries
+    }
+
+
+class AdaptiveRate:
+    """Adjust operation rate using additive-increase/multiplicative-decrease.
+
+    The rate grows by ``step`` while observed latency stays under ``target``
+    and is halved whenever it rises above it.
+    """
+
+    def __init__(self, initial, minimum, maximum, target, step=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.step = step or max(1, initial // 10)
+        self.rate = min(max(initial, minimum), maximum)
+
+    def update(self, latency):
+        if latency > self.target:
+            self.rate = max(self.minimum, self.rate / 2)
+        else:
+            self.rate = min(self.maximum, self.rate + self.step)
+        return self.rate
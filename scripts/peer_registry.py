@@ -0,0 +1,206 @@
+"""Registry of Serf peers used to join the cluster.
+
+Each peer is stored under its own config key (``serf_peer_<addr>``) with a heartbeat
+timestamp, so registering a peer doesn't rewrite the list of all peers and a
+crashed peer drops out once its heartbeat goes stale (and its key is removed once
+the heartbeat is ``STALE_PEER_TTL_FACTOR`` times older than the TTL):
+
+    {"addr": "ldap-0.ldap:7946", "heartbeat": 1603108800.0}
+
+For compatibility with older containers, peers are also registered in the legacy
+``serf_peers`` list; addresses found only in the legacy list are only dialed while
+no peer has its own key, and are removed from the list along with stale keys.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+from lease import compare_and_set
+from toolrunner import exec_cmd
+from utils import DRAIN_MARKER
+from utils import backoff_delays
+
+logger = logging.getLogger("ldap_peer")
+
+PEER_KEY_PREFIX = "serf_peer_"
+
+LEGACY_PEERS_KEY = "serf_peers"
+
+#: keys of peers whose heartbeat is older than this many TTLs are removed from config
+STALE_PEER_TTL_FACTOR = 10
+
+#: maximum number of peers dialed when joining the cluster; joining any of them is enough
+JOIN_MAX_PEERS = 5
+
+
+def get_peer_ttl():
+    try:
+        ttl = int(os.environ.get("GLUU_SERF_PEER_TTL", 60))
+        if ttl < 10:
+            ttl = 60
+    except ValueError:
+        ttl = 60
+    return ttl
+
+
+def peer_key(addr):
+    # some config adapters (i.e. Kubernetes ConfigMap) only allow alphanumeric, ``-``, ``_``, and ``.`` in keys
+    return PEER_KEY_PREFIX + re.sub(r"[^-._a-zA-Z0-9]", "_", addr)
+
+
+def update_key(manager, key, mutate, max_attempts=20):
+    """Atomically replace value of ``key`` with ``mutate(raw_value)``; ``mutate``
+    returns ``None`` to abort. Returns whether the value was written.
+
+    Concurrent updates are only safe with Consul or Kubernetes config adapter
+    (see ``lease.compare_and_set``).
+    """
+    delays = backoff_delays(0.05, 2.0)
+
+    for _ in range(max_attempts):
+        raw = manager.config.get(key)
+        value = mutate(raw)
+        if value is None:
+            return False
+        if compare_and_set(manager, key, raw, value):
+            return True
+        time.sleep(next(delays))
+
+    logger.warning(f"Unable to update {key} after {max_attempts} attempts")
+    return False
+
+
+def update_legacy_peers(manager, add=None, remove=None):
+    def mutate(raw):
+        try:
+            peers = set(json.loads(raw)) if raw else set()
+        except json.JSONDecodeError:
+            peers = set()
+
+        updated = (peers | {add}) - {remove, None}
+        if updated == peers:
+            return None
+        return json.dumps(sorted(updated))
+
+    update_key(manager, LEGACY_PEERS_KEY, mutate)
+
+
+def heartbeat(manager, addr, alive=True):
+    """Write heartbeat of ``addr``; a dead peer gets ``0`` so it's skipped immediately.
+    """
+    value = json.dumps({"addr": addr, "heartbeat": time.time() if alive else 0})
+    return update_key(manager, peer_key(addr), lambda raw: value)
+
+
+def register_serf_peer(manager, addr, legacy=True):
+    heartbeat(manager, addr)
+    if legacy:
+        update_legacy_peers(manager, add=addr)
+
+
+def remove_peer_key(manager, key, raw):
+    """Remove ``key`` of a peer, unless its value has changed from ``raw`` (i.e. the peer is back).
+    """
+    try:
+        return compare_and_set(manager, key, raw, None)
+    except Exception as exc:
+        logger.warning(f"Unable to remove {key}; reason={exc}")
+        return False
+
+
+def deregister_serf_peer(manager, addr):
+    key = peer_key(addr)
+    raw = manager.config.get(key)
+    if raw and not remove_peer_key(manager, key, raw):
+        # don't leave a live heartbeat behind
+        heartbeat(manager, addr, alive=False)
+    update_legacy_peers(manager, remove=addr)
+
+
+def get_serf_peers(manager, ttl=None):
+    """Get addresses of peers, most recently live first.
+
+    Peers with stale heartbeat are skipped, and their keys (and legacy entries) are
+    removed once the heartbeat is ``STALE_PEER_TTL_FACTOR`` times older than ``ttl``.
+    Legacy peers (without their own key) are only returned if no peer has its own key,
+    as they can't be told apart from crashed peers.
+    """
+    ttl = ttl or get_peer_ttl()
+    now = time.time()
+    config = manager.config.all()
+
+    peers = []
+    registered = set()
+    for key, raw in config.items():
+        if not key.startswith(PEER_KEY_PREFIX) or not raw:
+            continue
+        try:
+            peer = raw if isinstance(raw, dict) else json.loads(raw)
+        except json.JSONDecodeError:
+            continue
+
+        registered.add(peer["addr"])
+        age = now - peer.get("heartbeat", 0)
+        if age <= ttl:
+            peers.append(peer)
+        elif age > ttl * STALE_PEER_TTL_FACTOR and isinstance(raw, str):
+            if remove_peer_key(manager, key, raw):
+                update_legacy_peers(manager, remove=peer["addr"])
+
+    addrs = [peer["addr"] for peer in sorted(peers, key=lambda peer: peer["heartbeat"], reverse=True)]
+    if registered:
+        return addrs
+
+    legacy = config.get(LEGACY_PEERS_KEY) or "[]"
+    try:
+        legacy = legacy if isinstance(legacy, list) else json.loads(legacy)
+    except json.JSONDecodeError:
+        legacy = []
+    return legacy
+
+
+def join_serf_cluster(addrs, max_peers=JOIN_MAX_PEERS):
+    """Join the cluster by dialing up to ``max_peers`` addresses in parallel.
+
+    Returns whether any of them has been joined, as soon as the first one is.
+    """
+    addrs = addrs[:max_peers]
+    if not addrs:
+        return False
+
+    def join(addr):
+        out, err, code = exec_cmd(f"serf join {addr}")
+        if code != 0:
+            err = err or out
+            logger.warning(f"Unable to join Serf cluster via {addr}; reason={err.decode().strip()}")
+        return code == 0
+
+    executor = ThreadPoolExecutor(max_workers=len(addrs))
+    try:
+        return any(future.result() for future in as_completed([executor.submit(join, addr) for addr in addrs]))
+    finally:
+        # dials to unreachable peers are left to time out in background
+        executor.shutdown(wait=False)
+
+
+def run_heartbeat(manager, addr, stopped=None):
+    """Keep heartbeat of ``addr`` fresh until ``stopped`` (a ``threading.Event``) is set.
+
+    With Kubernetes config adapter, each heartbeat reads and replaces the whole
+    configmap (see ``lease.compare_and_set``), and fails if anything else wrote to
+    it meanwhile; a failed heartbeat is retried on the next interval.
+    """
+    stopped = stopped or threading.Event()
+    interval = get_peer_ttl() / 3
+
+    while not stopped.wait(interval):
+        # peer being drained has been deregistered, hence must not come back
+        if os.path.isfile(DRAIN_MARKER):
+            continue
+        if not heartbeat(manager, addr):
+            logger.warning(f"Unable to refresh heartbeat of Serf peer {addr}")
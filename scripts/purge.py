@@ -0,0 +1,198 @@
+import json
+import logging
+import logging.config
+import os
+import socket
+import time
+from datetime import datetime
+from datetime import timezone
+
+import ldap3
+
+from ldap_pool import get_pool
+from lease import acquire_lease
+from lease import lease_renewed
+from monitor import AdaptiveRate
+from monitor import probe_latency
+from settings import LOGGING_CONFIG
+from tracing import get_manager
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("purge")
+
+#: subtrees that contain expiring entries; entries are purged once they are
+#: marked as deletable (``del``) and expired (``exp``), similar to oxAuth cleaner
+PURGE_TARGETS = {
+    "tokens": "ou=tokens,o=gluu",
+    "sessions": "ou=sessions,o=gluu",
+    "cache": "ou=cache,o=gluu",
+    "metric": "o=metric",
+}
+
+PURGE_LEASES_KEY = "ldap_purge_leases"
+
+CHECKPOINT_FILE = "/opt/opendj/config/purge-checkpoint.json"
+
+PAGED_RESULTS_OID = "1.2.840.113556.1.4.319"
+
+
+def _get_int_env(name, default, minimum=1):
+    try:
+        value = int(os.environ.get(name, default))
+        if value < minimum:
+            value = default
+    except ValueError:
+        value = default
+    return value
+
+
+def get_purge_interval():
+    return _get_int_env("GLUU_LDAP_PURGE_INTERVAL", 0, minimum=0)
+
+
+def get_purge_batch_size():
+    return _get_int_env("GLUU_LDAP_PURGE_BATCH_SIZE", 500)
+
+
+def get_purge_max_rate():
+    return _get_int_env("GLUU_LDAP_PURGE_MAX_RATE", 1000)
+
+
+def get_purge_target_latency():
+    # in milliseconds
+    return _get_int_env("GLUU_LDAP_PURGE_TARGET_LATENCY", 50)
+
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_checkpoint(checkpoint):
+    with open(f"{CHECKPOINT_FILE}.tmp", "w") as f:
+        f.write(json.dumps(checkpoint))
+    os.replace(f"{CHECKPOINT_FILE}.tmp", CHECKPOINT_FILE)
+
+
+def new_checkpoint():
+    return {
+        # generalized time, i.e. 20201019120000.000Z
+        "cutoff": datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S.000Z"),
+        "started_at": time.time(),
+        "targets": {},
+    }
+
+
+def purge_target(conn, name, base_dn, checkpoint, controller):
+    """Delete expired entries under ``base_dn`` in batches of paged search results.
+
+    Each batch is paced by ``controller``, which backs off when server latency rises.
+    """
+    state = checkpoint["targets"].setdefault(name, {"deleted": 0, "failed": 0, "done": False})
+    if state["done"]:
+        return
+
+    search_filter = f"(&(del=TRUE)(exp<={checkpoint['cutoff']}))"
+    batch_size = get_purge_batch_size()
+    cookie = None
+
+    logger.info(f"Purging expired entries under {base_dn}")
+
+    while True:
+        started_at = time.monotonic()
+        conn.search(
+            search_base=base_dn,
+            search_filter=search_filter,
+            search_scope=ldap3.SUBTREE,
+            attributes=["1.1"],
+            paged_size=batch_size,
+            paged_cookie=cookie,
+        )
+
+        if conn.result["description"] == "noSuchObject":
+            # subtree is not stored in this server (i.e. hybrid persistence)
+            break
+        if conn.result["description"] != "success":
+            logger.warning(f"Unable to search expired entries under {base_dn}; reason={conn.result['message']}")
+            return
+
+        dns = [entry.entry_dn for entry in conn.entries]
+        cookie = conn.result.get("controls", {}).get(PAGED_RESULTS_OID, {}).get("value", {}).get("cookie")
+
+        # each entry is deleted by its own (small) operation, hence replicated
+        # as a single change rather than a large subtree delete
+        for dn in dns:
+            conn.delete(dn)
+            if conn.result["description"] in ("success", "noSuchObject"):
+                state["deleted"] += 1
+            else:
+                state["failed"] += 1
+                logger.warning(f"Unable to delete {dn}; reason={conn.result['message']}")
+        save_checkpoint(checkpoint)
+
+        if not cookie:
+            break
+
+        latency, backlog = probe_latency(conn)
+        # queued requests mean the server is saturated regardless of latency
+        rate = controller.update(latency if not backlog else float("inf"))
+        pause = len(dns) / rate - (time.monotonic() - started_at)
+        if pause > 0:
+            time.sleep(pause)
+
+    state["done"] = True
+    save_checkpoint(checkpoint)
+    logger.info(f"Purged {state['deleted']} expired entries under {base_dn} ({state['failed']} failed)")
+
+
+def purge(manager):
+    """Purge expired entries; resumes unfinished run (if any) from its checkpoint.
+    """
+    checkpoint = load_checkpoint()
+    if checkpoint and not all(state["done"] for state in checkpoint["targets"].values()):
+        logger.info(f"Resuming purge of entries expired before {checkpoint['cutoff']}")
+    else:
+        checkpoint = new_checkpoint()
+
+    max_rate = get_purge_max_rate()
+    controller = AdaptiveRate(
+        initial=max_rate / 10,
+        minimum=max(1, max_rate / 100),
+        maximum=max_rate,
+        target=get_purge_target_latency() / 1000,
+    )
+
+    with get_pool(manager).connection() as conn:
+        for name, base_dn in PURGE_TARGETS.items():
+            purge_target(conn, name, base_dn, checkpoint, controller)
+
+
+def main():
+    manager = get_manager()
+    interval = get_purge_interval()
+    holder = socket.getfqdn()
+    ttl = 300
+
+    while True:
+        if interval:
+            time.sleep(interval)
+
+        # purge from a single server at a time; deletions are replicated to others
+        if acquire_lease(manager, PURGE_LEASES_KEY, "purge", holder, 1, ttl):
+            with lease_renewed(manager, PURGE_LEASES_KEY, "purge", holder, ttl):
+                try:
+                    purge(manager)
+                except Exception as exc:
+                    logger.warning(f"Unable to purge expired entries; reason={exc}")
+        else:
+            logger.info("Purge is running on another server")
+
+        if not interval:
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,15 @@ import logging
 import logging.config
 import os
 
-from pygluu.containerlib import get_manager
 from pygluu.containerlib.utils import as_boolean
-from pygluu.containerlib.utils import exec_cmd
 
+from peer_registry import get_serf_peers
+from peer_registry import join_serf_cluster
+from peer_registry import register_serf_peer
+from peer_registry import update_legacy_peers
 from settings import LOGGING_CONFIG
+from tracing import get_manager
 from utils import guess_serf_addr
-from utils import get_serf_peers
-from utils import register_serf_peer
 
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("ldap_peer")
@@ -31,8 +32,10 @@ def peers_from_file():
 def main():
     manager = get_manager()
 
-    for addr in peers_from_file():
-        register_serf_peer(manager, addr)
+    # static peers have no heartbeat, hence only kept in legacy list
+    static_peers = peers_from_file()
+    for addr in static_peers:
+        update_legacy_peers(manager, add=addr)
 
     addr = guess_serf_addr()
     register_serf_peer(manager, addr)
@@ -42,13 +45,13 @@ def main():
         # join Serf cluster using multicast (no extra code needed)
         return
 
-    # join Serf cluster manually
-    peers = " ".join(get_serf_peers(manager))
-    out, err, code = exec_cmd(f"serf join {peers}")
-    err = err or out
-
-    if code != 0:
-        logger.warning(f"Unable to join Serf cluster; reason={err}")
+    # join Serf cluster manually, dialing only peers that are recently live
+    peers = [
+        peer for peer in dict.fromkeys(get_serf_peers(manager) + static_peers)
+        if peer != addr
+    ]
+    if peers and not join_serf_cluster(peers):
+        logger.warning("Unable to join Serf cluster via any known peer")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""Detect replication domains which silently stopped replicating.
+
+A replica stops accepting changes of a domain when its generation ID differs
+from the one of its replication server (i.e. after restoring data from another
+cluster), while ``status`` keeps reporting replication as enabled. A replica may
+also stop replaying changes (i.e. after the changelog has been purged past its
+state), in which case its missing changes keep piling up.
+
+Both are detected per base DN from ``cn=Replication,cn=monitor`` of current
+server and its peers:
+
+- the generation ID of a local domain differs from the one held by a strict majority
+  of all replicas (at least 3 must report one; otherwise the mismatch is only logged)
+- the oldest change missing from a local domain is older than ``GLUU_LDAP_REPL_STALL_TIMEOUT``
+
+Only the affected backend is re-initialized, from a healthy peer. A cluster-wide
+lease (keyed by base DN) prevents servers from re-initializing the same backend
+at once (i.e. from each other), and a server re-initializes the same backend at
+most once per ``GLUU_LDAP_REINIT_MIN_INTERVAL``.
+"""
+import contextlib
+import logging
+import os
+import time
+from collections import Counter
+
+import ldap3
+from pygluu.containerlib.utils import as_boolean
+
+from lease import acquire_lease
+from lease import get_leases
+from lease import get_seed_lease_ttl
+from lease import lease_renewed
+from lease import renew_lease
+from monitor import read_monitor_entries
+
+logger = logging.getLogger("repl_health")
+
+#: config key (next to ``serf_seed_leases``) that holds re-initialization locks, keyed by base DN
+REINIT_LEASES_KEY = "serf_reinit_leases"
+
+#: config key that holds recent re-initializations, keyed by base DN; expiry of each
+#: entry is the earliest time the server may re-initialize the backend again
+REINIT_HISTORY_KEY = "serf_reinit_history"
+
+DOMAINS_DN = "cn=domains,cn=Multimaster Synchronization,cn=Synchronization Providers,cn=config"
+
+#: generation ID of a domain which has no data yet
+UNKNOWN_GENERATION_ID = "-1"
+
+DOMAIN_MONITOR_ATTRS = [
+    "domain-name",
+    "server-id",
+    "generation-id",
+    "missing-changes",
+    "approx-older-change-not-synchronized-millis",
+]
+
+
+def auto_reinit_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_AUTO_REINIT", True))
+
+
+def get_repl_health_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_REPL_HEALTH_INTERVAL", 60))
+        if interval < 10:
+            interval = 60
+    except ValueError:
+        interval = 60
+    return interval
+
+
+def get_repl_stall_timeout():
+    try:
+        timeout = int(os.environ.get("GLUU_LDAP_REPL_STALL_TIMEOUT", 900))
+        if timeout < 60:
+            timeout = 900
+    except ValueError:
+        timeout = 900
+    return timeout
+
+
+def get_reinit_min_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_REINIT_MIN_INTERVAL", 3600))
+        if interval < 60:
+            interval = 3600
+    except ValueError:
+        interval = 3600
+    return interval
+
+
+def _first(attrs, name):
+    values = attrs.get(name) or [""]
+    return str(values[0]).strip()
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        # i.e. ``<not available>``
+        return 0
+
+
+def get_local_server_ids(conn):
+    """Get server ID of each replication domain of the server, keyed by (lowercase) base DN.
+    """
+    conn.search(DOMAINS_DN, "(objectClass=*)", ldap3.LEVEL, attributes=["ds-cfg-base-dn", "ds-cfg-server-id"])
+    return {
+        _first(entry.entry_attributes_as_dict, "ds-cfg-base-dn").lower(): _first(entry.entry_attributes_as_dict, "ds-cfg-server-id")
+        for entry in conn.entries
+    }
+
+
+def read_domain_states(conn):
+    """Get state of replication domains of the server, keyed by (lowercase) base DN.
+
+    The state has the following structure:
+
+        {"generation_id": "1234", "missing_changes": 0, "oldest_missing_change": 0}
+
+    where ``oldest_missing_change`` is a timestamp in milliseconds (``0`` if unknown).
+    """
+    server_ids = get_local_server_ids(conn)
+    entries = read_monitor_entries(conn, "(domain-name=*)", DOMAIN_MONITOR_ATTRS, base="cn=Replication,cn=monitor")
+
+    states = {}
+    for attrs in entries.values():
+        base_dn = _first(attrs, "domain-name").lower()
+        # monitor also has entries of remote servers connected to local replication server
+        if not server_ids.get(base_dn) or server_ids[base_dn] != _first(attrs, "server-id"):
+            continue
+
+        state = states.setdefault(base_dn, {"generation_id": None, "missing_changes": 0, "oldest_missing_change": 0})
+        state["generation_id"] = _first(attrs, "generation-id") or state["generation_id"]
+        state["missing_changes"] = max(state["missing_changes"], _to_int(_first(attrs, "missing-changes")))
+
+        oldest = _to_int(_first(attrs, "approx-older-change-not-synchronized-millis"))
+        if oldest and (not state["oldest_missing_change"] or oldest < state["oldest_missing_change"]):
+            state["oldest_missing_change"] = oldest
+    return states
+
+
+def is_stalled(state, timeout, now=None):
+    oldest = state["oldest_missing_change"]
+    return bool(state["missing_changes"] and oldest and (now or time.time()) - oldest / 1000 > timeout)
+
+
+def expected_generation_id(local_state, peer_states, base_dn):
+    """Get generation ID of ``base_dn`` held by a strict majority of all replicas
+    (current server included), or ``None`` if there's none.
+
+    At least 3 replicas must report a generation ID, as between 2 replicas there's
+    no telling which one is authoritative.
+    """
+    ids = Counter(
+        states[base_dn]["generation_id"]
+        for states in [{base_dn: local_state}] + list(peer_states.values())
+        if base_dn in states and states[base_dn]["generation_id"] not in (None, UNKNOWN_GENERATION_ID)
+    )
+    total = sum(ids.values())
+    if total < 3:
+        return None
+
+    top, count = ids.most_common(1)[0]
+    if count * 2 <= total:
+        return None
+    return top
+
+
+def find_broken_domains(local_states, peer_states, base_dns, timeout):
+    """Get base DNs whose local replica needs re-initialization, and the reason of each.
+    """
+    broken = {}
+    for base_dn in base_dns:
+        state = local_states.get(base_dn.lower())
+        # not replicated yet; initialized by the replicator as usual
+        if not state:
+            continue
+
+        peer_ids = {
+            states[base_dn.lower()]["generation_id"]
+            for states in peer_states.values()
+            if base_dn.lower() in states
+        } - {None, UNKNOWN_GENERATION_ID}
+        expected = expected_generation_id(state, peer_states, base_dn.lower())
+
+        if expected and state["generation_id"] != expected:
+            broken[base_dn] = f"generation ID {state['generation_id']} differs from {expected} of most replicas"
+        elif not expected and peer_ids - {state["generation_id"]}:
+            logger.warning(
+                f"Generation IDs of {base_dn} differ between replicas ({', '.join(sorted(peer_ids | {str(state['generation_id'])}))}), "
+                "but none is held by a majority of at least 3 replicas; re-initialize manually"
+            )
+        elif is_stalled(state, timeout):
+            broken[base_dn] = f"{state['missing_changes']} changes have been missing for over {timeout} seconds"
+    return broken
+
+
+def pick_reinit_source(peers, local_states, peer_states, base_dn, timeout):
+    """Get the healthy peer having the expected generation ID and the least missing changes.
+
+    The expected generation ID is the majority one, or (if replicas don't disagree)
+    the one of current server, i.e. when replication is only stalled.
+    """
+    local_state = local_states.get(base_dn.lower())
+    if not local_state:
+        return None
+    expected = expected_generation_id(local_state, peer_states, base_dn.lower()) or local_state["generation_id"]
+
+    candidates = []
+    for peer in peers:
+        state = peer_states.get(peer["name"], {}).get(base_dn.lower())
+        if state and state["generation_id"] == expected and not is_stalled(state, timeout):
+            candidates.append((state["missing_changes"], peer["name"], peer))
+    return min(candidates)[2] if candidates else None
+
+
+@contextlib.contextmanager
+def reinit_slot(manager, base_dn, holder):
+    """Acquire the cluster-wide lock of re-initializing ``base_dn``.
+
+    Yields ``False`` if ``holder`` has re-initialized ``base_dn`` recently or another
+    server holds the lock. Once acquired, the attempt is recorded (even if it fails)
+    so the next one waits for ``GLUU_LDAP_REINIT_MIN_INTERVAL``.
+    """
+    if holder in get_leases(manager, REINIT_HISTORY_KEY).get(base_dn, {}):
+        yield False
+        return
+
+    ttl = get_seed_lease_ttl()
+    if not acquire_lease(manager, REINIT_LEASES_KEY, base_dn, holder, 1, ttl):
+        yield False
+        return
+
+    try:
+        with lease_renewed(manager, REINIT_LEASES_KEY, base_dn, holder, ttl):
+            yield True
+    finally:
+        renew_lease(manager, REINIT_HISTORY_KEY, base_dn, holder, get_reinit_min_interval())
@@ -0,0 +1,258 @@
+import json
+import logging
+import logging.config
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backup import get_backup_dir
+from backup import load_manifest as load_backup_manifest
+from backup import restore_backends
+from settings import LOGGING_CONFIG
+from toolrunner import exec_cmd
+from tracing import get_manager
+from utils import OPENDJ_DIR
+from utils import admin_password_bound
+from utils import get_backends
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("seed")
+
+#: file contains base DNs that have been seeded by offline import
+#: (hence replication must not re-initialize them)
+SEEDED_MARKER = f"{OPENDJ_DIR}/config/seeded.json"
+
+
+def get_seed_mode():
+    mode = os.environ.get("GLUU_LDAP_SEED_MODE", "initialize")
+    if mode not in ("initialize", "import", "restore"):
+        mode = "initialize"
+    return mode
+
+
+def get_seed_dir():
+    return os.environ.get("GLUU_LDAP_SEED_DIR", "/opt/opendj/seed")
+
+
+def get_seed_max_age():
+    try:
+        max_age = int(os.environ.get("GLUU_LDAP_SEED_MAX_AGE", 86400))
+        if max_age < 1:
+            max_age = 86400
+    except ValueError:
+        max_age = 86400
+    return max_age
+
+
+def get_import_thread_count():
+    try:
+        count = int(os.environ.get("GLUU_LDAP_IMPORT_THREAD_COUNT", 0))
+    except ValueError:
+        count = 0
+    return count if count > 0 else (os.cpu_count() or 1) * 2
+
+
+def seed_file(seed_dir, backend):
+    return os.path.join(seed_dir, f"{backend}.ldif.gz")
+
+
+def load_manifest(seed_dir):
+    try:
+        with open(os.path.join(seed_dir, "manifest.json")) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_seeded_dns():
+    try:
+        with open(SEEDED_MARKER) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def set_seeded_dns(dns):
+    with open(SEEDED_MARKER, "w") as f:
+        f.write(json.dumps(sorted(dns)))
+
+
+def unmark_seeded_dn(base_dn):
+    dns = get_seeded_dns()
+    if base_dn in dns:
+        dns.remove(base_dn)
+        set_seeded_dns(dns)
+
+
+def export_backend(manager, backend, seed_dir, password_file):
+    """Export a backend of the running server as compressed LDIF (using a task).
+    """
+    dest = seed_file(seed_dir, backend)
+    tmp = f"{dest}.tmp"
+
+    cmd = " ".join([
+        "/opt/opendj/bin/export-ldif",
+        "--hostname localhost",
+        f"--port {os.environ.get('GLUU_LDAP_ADVERTISE_ADMIN_PORT', '4444')}",
+        f"--bindDN '{manager.config.get('ldap_binddn')}'",
+        f"--bindPasswordFile {password_file}",
+        f"--backendID {backend}",
+        f"--ldifFile {tmp}",
+        "--compress",
+        "--trustAll",
+    ])
+    out, err, code = exec_cmd(cmd)
+    if code:
+        err = err or out
+        logger.warning(f"Unable to export {backend} backend; reason={err.decode().strip()}")
+        return False
+
+    os.replace(tmp, dest)
+    return True
+
+
+def export_seed(manager):
+    seed_dir = get_seed_dir()
+    os.makedirs(seed_dir, exist_ok=True)
+    backends = get_backends()
+
+    logger.info(f"Exporting {', '.join(backends)} backends to {seed_dir}")
+    started_at = time.time()
+
+    with admin_password_bound(manager) as password_file:
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            results = dict(zip(backends, executor.map(
+                lambda backend: export_backend(manager, backend, seed_dir, password_file),
+                backends,
+            )))
+
+    manifest = {
+        "source": socket.getfqdn(),
+        # changes made after this time will be replayed by replication
+        "created_at": started_at,
+        "backends": {
+            backend: base_dn for backend, base_dn in backends.items() if results[backend]
+        },
+    }
+    with open(os.path.join(seed_dir, "manifest.json"), "w") as f:
+        f.write(json.dumps(manifest))
+
+    logger.info(f"Exported {len(manifest['backends'])} backend(s) in {time.time() - started_at:.1f} seconds")
+    return all(results.values())
+
+
+def import_backend(backend, path, thread_count):
+    """Import compressed LDIF into a backend while the server is stopped.
+    """
+    cmd = " ".join([
+        "/opt/opendj/bin/import-ldif",
+        f"--backendID {backend}",
+        f"--ldifFile {path}",
+        "--isCompressed",
+        f"--threadCount {thread_count}",
+        "--skipSchemaValidation",
+        "--clearBackend",
+    ])
+    started_at = time.time()
+    out, err, code = exec_cmd(cmd)
+    if code:
+        err = err or out
+        logger.warning(f"Unable to import {backend} backend from {path}; reason={err.decode().strip()}")
+        return False
+
+    logger.info(f"Imported {backend} backend from {path} in {time.time() - started_at:.1f} seconds")
+    return True
+
+
+def restore_seed():
+    """Restore the latest backups (see ``backup.py``) into a fresh (stopped) server.
+
+    Returns base DNs that have been restored.
+    """
+    backup_dir = get_backup_dir()
+    max_age = get_seed_max_age()
+    backends = {}
+
+    for backend, base_dn in get_backends().items():
+        manifest = load_backup_manifest(os.path.join(backup_dir, backend))
+        age = time.time() - manifest.get("updated_at", 0)
+
+        if not manifest["files"] or age > max_age:
+            logger.warning(f"Unable to find recent backup of {backend} backend in {backup_dir}; fallback to online initialization")
+            continue
+        backends[backend] = base_dn
+
+    if not backends:
+        return []
+
+    logger.info(f"Seeding {', '.join(backends)} backends from backups in {backup_dir}")
+    restored = restore_backends(list(backends))
+
+    seeded = [backends[backend] for backend in restored]
+    set_seeded_dns(seeded)
+    return seeded
+
+
+def import_seed():
+    """Import available seed files (or backups) into a fresh (stopped) server.
+
+    Returns base DNs that have been imported.
+    """
+    mode = get_seed_mode()
+    if mode == "restore":
+        return restore_seed()
+    if mode != "import":
+        return []
+
+    seed_dir = get_seed_dir()
+    manifest = load_manifest(seed_dir)
+    if not manifest:
+        logger.warning(f"Unable to find seed manifest in {seed_dir}; fallback to online initialization")
+        return []
+
+    # replication only keeps changes for a limited time (purge delay); older exports
+    # can't be caught up
+    age = time.time() - manifest.get("created_at", 0)
+    if age > get_seed_max_age():
+        logger.warning(f"Seed in {seed_dir} is {age:.0f} seconds old; fallback to online initialization")
+        return []
+
+    exported = manifest.get("backends", {})
+    if not exported:
+        logger.warning(f"Seed manifest in {seed_dir} lists no backends; fallback to online initialization")
+
+    backends = {
+        backend: base_dn
+        for backend, base_dn in get_backends().items()
+        if exported.get(backend) == base_dn and os.path.isfile(seed_file(seed_dir, backend))
+    }
+    if not backends:
+        return []
+
+    thread_count = max(1, get_import_thread_count() // len(backends))
+    logger.info(f"Seeding {', '.join(backends)} backends from {seed_dir} (exported by {manifest.get('source')})")
+
+    with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+        results = dict(zip(backends, executor.map(
+            lambda backend: import_backend(backend, seed_file(seed_dir, backend), thread_count),
+            backends,
+        )))
+
+    seeded = [base_dn for backend, base_dn in backends.items() if results[backend]]
+    set_seeded_dns(seeded)
+    return seeded
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print(f"Usage: {sys.argv[0]} export")
+        sys.exit(1)
+
+    if not export_seed(get_manager()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
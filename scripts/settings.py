@@ -1,14 +1,20 @@
+import os
+
 LOGGING_CONFIG = {
     "version": 1,
     "formatters": {
         "default": {
             "format": "%(levelname)s - %(name)s - %(asctime)s - %(message)s",
         },
+        "json": {
+            "()": "tracing.JsonFormatter",
+        },
     },
     "handlers": {
         "console": {
-            "class": "logging.StreamHandler",
-            "formatter": "default",
+            # records are written to stderr by a background thread
+            "class": "tracing.QueueingStreamHandler",
+            "formatter": "json" if os.environ.get("GLUU_LDAP_LOG_FORMAT", "text") == "json" else "default",
         },
     },
     "loggers": {
@@ -31,6 +37,81 @@ LOGGING_CONFIG = {
             "handlers": ["console"],
             "level": "INFO",
             "propagate": False,
-        }
+        },
+        "backup": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "lease": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "purge": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "seed": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "warmup": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "supervisor": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "changelog": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "consistency": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "repl_health": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "topology": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "ldap_batch": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "ldap_pool": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "toolrunner": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "tracing": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "wait": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
     },
 }
@@ -0,0 +1,387 @@
+"""Run the container's startup stages and supervise its long-running processes.
+
+Stages (``wait``, ``entrypoint``, ``register_peer``) and background tasks
+(replicator, purge, warm-up, readiness) run inside this single interpreter, while
+Serf agent, the tool server, and OpenDJ run as child processes which are restarted
+with backoff if they exit unexpectedly. ``SIGTERM`` and ``SIGINT`` are forwarded
+to all children.
+"""
+import asyncio
+import logging
+import logging.config
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from settings import LOGGING_CONFIG
+from tracing import span
+from utils import DRAIN_MARKER
+from utils import backoff_delays
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("supervisor")
+
+DEPLOY_MARKER = "/deploy/touched"
+
+#: marker file which exists while the server is ready; exec probes can check it
+#: (i.e. ``test -f /app/tmp/ready``) instead of starting an interpreter per probe
+READY_MARKER = "/app/tmp/ready"
+
+#: a child running longer than this (in seconds) is considered healthy, hence restart backoff is reset
+STABLE_RUN_TIME = 60
+
+
+class StageError(Exception):
+    def __init__(self, name, code):
+        super().__init__(f"Stage {name} exited with code {code}")
+        self.code = code
+
+
+def get_shutdown_timeout():
+    try:
+        timeout = int(os.environ.get("GLUU_SUPERVISOR_SHUTDOWN_TIMEOUT", 60))
+        if timeout < 1:
+            timeout = 60
+    except ValueError:
+        timeout = 60
+    return timeout
+
+
+def get_readiness_interval():
+    try:
+        interval = int(os.environ.get("GLUU_SUPERVISOR_READINESS_INTERVAL", 10))
+        if interval < 1:
+            interval = 10
+    except ValueError:
+        interval = 10
+    return interval
+
+
+def get_java_version():
+    """Get Java version, i.e. ``11.0.9`` (same as ``java -version`` reports).
+    """
+    proc = subprocess.run(["java", "-version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    line = proc.stdout.decode().splitlines()[0] if proc.stdout else ""
+    parts = line.split('"')
+    return parts[1].split("_")[0] if len(parts) > 1 else ""
+
+
+def run_in_thread(name, func, *args):
+    """Run a blocking stage in a daemon thread (so it never blocks shutdown).
+
+    Returns a future resolved with exit code of the stage, similar to a process.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(code):
+        if not future.done():
+            future.set_result(code)
+
+    def target():
+        try:
+            func(*args)
+            code = 0
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+        except Exception:
+            logger.exception(f"Unhandled error in {name}")
+            code = 1
+        loop.call_soon_threadsafe(set_result, code)
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+    return future
+
+
+class Child:
+    """A supervised child process.
+
+    :param name: Name used in logs.
+    :param argv: Command and its arguments.
+    :param env: Extra environment variables.
+    :param max_restarts: Give up after this many restarts in a row that didn't
+        run longer than ``STABLE_RUN_TIME`` (``None`` means unlimited).
+    """
+
+    def __init__(self, name, argv, env=None, max_restarts=None):
+        self.name = name
+        self.argv = argv
+        self.env = dict(os.environ, **(env or {}))
+        self.max_restarts = max_restarts
+        self.proc = None
+        self.stopping = False
+
+    async def supervise(self):
+        """Run the process until stopped; returns exit code of the last run.
+        """
+        delays = backoff_delays(initial=1.0, maximum=60.0)
+        restarts = 0
+
+        while True:
+            started_at = time.monotonic()
+            self.proc = await asyncio.create_subprocess_exec(*self.argv, env=self.env)
+            logger.info(f"Started {self.name} (pid={self.proc.pid})")
+            code = await self.proc.wait()
+
+            if self.stopping:
+                logger.info(f"{self.name} exited with code {code}")
+                return code
+
+            if time.monotonic() - started_at > STABLE_RUN_TIME:
+                delays = backoff_delays(initial=1.0, maximum=60.0)
+                restarts = 0
+
+            if self.max_restarts is not None and restarts >= self.max_restarts:
+                logger.error(f"{self.name} exited with code {code}; giving up after {restarts} restarts")
+                return code
+
+            delay = next(delays)
+            restarts += 1
+            logger.warning(f"{self.name} exited with code {code}; restarting in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+    def send_signal(self, signum):
+        self.stopping = True
+        if self.proc and self.proc.returncode is None:
+            self.proc.send_signal(signum)
+
+    def kill(self):
+        if self.proc and self.proc.returncode is None:
+            self.proc.kill()
+
+
+class Supervisor:
+    def __init__(self):
+        self.children = {}
+        self.shutdown_requested = asyncio.Event()
+        self.exit_code = 0
+        self.manager = None
+
+    def start_child(self, child, critical=False):
+        """Supervise a child; supervisor shuts down if a critical child gives up.
+        """
+        self.children[child.name] = child
+        task = asyncio.ensure_future(child.supervise())
+
+        def on_done(task):
+            if task.cancelled() or child.stopping:
+                return
+
+            if task.exception():
+                logger.error(f"Unable to run {child.name}; reason={task.exception()}")
+                code = 1
+            else:
+                code = task.result() or 1
+            if critical:
+                self.request_shutdown(exit_code=code)
+
+        task.add_done_callback(on_done)
+        return task
+
+    def request_shutdown(self, signum=None, exit_code=0):
+        if self.shutdown_requested.is_set():
+            return
+        if signum:
+            logger.info(f"Received {signal.Signals(signum).name}; shutting down")
+            # similar to shell, exit code is 128 + signal number
+            exit_code = 128 + signum
+        self.exit_code = exit_code
+        self.shutdown_requested.set()
+
+    async def stop_children(self, signum=signal.SIGTERM):
+        children = list(self.children.values())
+        for child in children:
+            child.send_signal(signum)
+
+        waiters = [asyncio.ensure_future(child.proc.wait()) for child in children if child.proc]
+        if not waiters:
+            return
+        _, pending = await asyncio.wait(waiters, timeout=get_shutdown_timeout())
+        if pending:
+            logger.warning("Timeout while waiting for child processes to exit; killing them")
+            for child in children:
+                child.kill()
+            await asyncio.wait(pending)
+
+    async def stage(self, name, func, *args):
+        def traced_stage(*args):
+            # calls made by the stage are recorded as children of this span
+            with span(f"stage {name}", "stage"):
+                func(*args)
+
+        started_at = time.monotonic()
+        code = await run_in_thread(name, traced_stage, *args)
+        if code:
+            raise StageError(name, code)
+        logger.info(f"Stage {name} finished in {time.monotonic() - started_at:.1f} seconds")
+
+    def background(self, name, func, *args):
+        future = run_in_thread(name, func, *args)
+        future.add_done_callback(
+            lambda future: logger.info(f"Background task {name} exited with code {future.result()}")
+        )
+
+    async def readiness_loop(self):
+        from healthcheck import check_ready
+
+        marker = pathlib.Path(READY_MARKER)
+        interval = get_readiness_interval()
+
+        def probe():
+            try:
+                ready = check_ready(self.manager)
+            except Exception as exc:
+                logger.debug(f"Readiness check failed; reason={exc}")
+                ready = False
+            sys.exit(0 if ready else 1)
+
+        while not self.shutdown_requested.is_set():
+            if await run_in_thread("readiness", probe) == 0:
+                marker.touch()
+            else:
+                marker.unlink(missing_ok=True)
+            await asyncio.sleep(interval)
+
+    async def start(self):
+        pathlib.Path("/opt/opendj/locks").mkdir(parents=True, exist_ok=True)
+        pathlib.Path(READY_MARKER).unlink(missing_ok=True)
+        pathlib.Path(DRAIN_MARKER).unlink(missing_ok=True)
+
+        os.environ["JAVA_VERSION"] = get_java_version()
+
+        from toolrunner import TOOL_SERVER_TOKEN
+        from toolrunner import tool_server_enabled
+        if tool_server_enabled():
+            # stale token would be rejected by the new server
+            pathlib.Path(TOOL_SERVER_TOKEN).unlink(missing_ok=True)
+            self.start_child(tool_server_child())
+
+        from wait import main as wait_main
+        await self.stage("wait", wait_main)
+
+        from tracing import get_manager
+        self.manager = get_manager()
+
+        if not os.path.isfile(DEPLOY_MARKER):
+            from entrypoint import main as entrypoint_main
+            await self.stage("entrypoint", entrypoint_main)
+            pathlib.Path(DEPLOY_MARKER).touch()
+
+        self.start_child(Child("serf", ["serf", "agent", "-config-file", "/etc/gluu/conf/serf.json"]))
+
+        from register_peer import main as register_peer_main
+        await self.stage("register_peer", register_peer_main)
+
+        # keep the registered address live, so joining containers keep dialing it
+        from peer_registry import run_heartbeat
+        from utils import guess_serf_addr
+        self.background("peer_heartbeat", run_heartbeat, self.manager, guess_serf_addr())
+
+        from ldap_replicator import main as replicator_main
+        self.background("ldap_replicator", replicator_main)
+
+        from purge import get_purge_interval
+        from purge import main as purge_main
+        if get_purge_interval() > 0:
+            self.background("purge", purge_main)
+
+        from changelog import get_changelog_check_interval
+        from changelog import main as changelog_main
+        if get_changelog_check_interval() > 0:
+            self.background("changelog", changelog_main)
+
+        # warm up caches before reporting ready
+        from warmup import WARMUP_MARKER
+        from warmup import main as warmup_main
+        pathlib.Path(WARMUP_MARKER).unlink(missing_ok=True)
+        self.background("warmup", warmup_main)
+
+        self.start_child(opendj_child(), critical=True)
+        asyncio.ensure_future(self.readiness_loop())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.request_shutdown, signum)
+
+        startup = asyncio.ensure_future(self.start())
+        shutdown = asyncio.ensure_future(self.shutdown_requested.wait())
+        await asyncio.wait([startup, shutdown], return_when=asyncio.FIRST_COMPLETED)
+
+        if startup.done() and startup.exception():
+            exc = startup.exception()
+            code = exc.code if isinstance(exc, StageError) else 1
+            logger.error(f"Startup failed; reason={exc}")
+            self.request_shutdown(exit_code=code)
+        elif not startup.done():
+            startup.cancel()
+
+        await shutdown
+        await self.stop_children()
+        return self.exit_code
+
+
+def tool_server_child():
+    from toolrunner import TOOL_SERVER_ADDR
+    from toolrunner import TOOL_SERVER_ROOT
+    from toolrunner import TOOL_SERVER_TOKEN
+
+    return Child(
+        "toolserver",
+        [
+            "java",
+            "-client", "-Xms8m", "-Xmx256m", "-XX:+UseSerialGC",
+            f"-Dorg.opends.server.ServerRoot={TOOL_SERVER_ROOT}",
+            f"-Dorg.opends.server.InstanceRoot={TOOL_SERVER_ROOT}",
+            "-Dcom.sun.jndi.ldap.object.disableEndpointIdentification=true",
+            "--add-exports", "java.base/sun.security.tools.keytool=ALL-UNNAMED",
+            "-cp", f"/app/toolserver:{TOOL_SERVER_ROOT}/lib/*",
+            "ToolServer", str(TOOL_SERVER_ADDR[1]), TOOL_SERVER_TOKEN,
+        ],
+        env={"INSTALL_ROOT": TOOL_SERVER_ROOT, "INSTANCE_ROOT": TOOL_SERVER_ROOT},
+    )
+
+
+def opendj_child():
+    java_args = " ".join([
+        # not sure if we can omit `-server` safely
+        "-server",
+        "-XX:+UseContainerSupport",
+        f"-XX:MaxRAMPercentage={os.environ.get('GLUU_MAX_RAM_PERCENTAGE', '75.0')}",
+        os.environ.get("GLUU_JAVA_OPTIONS", ""),
+    ])
+    return Child(
+        "opendj",
+        ["/opt/opendj/bin/start-ds", "-N"],
+        # loaded by `start-ds` script
+        env={"OPENDJ_JAVA_ARGS": java_args},
+        max_restarts=get_max_restarts(),
+    )
+
+
+def get_max_restarts():
+    try:
+        max_restarts = int(os.environ.get("GLUU_SUPERVISOR_MAX_RESTARTS", 5))
+        if max_restarts < 0:
+            max_restarts = 5
+    except ValueError:
+        max_restarts = 5
+    return max_restarts
+
+
+async def run_supervisor():
+    # created inside the running loop, as asyncio primitives are bound to it
+    supervisor = Supervisor()
+    return await supervisor.run()
+
+
+def main():
+    sys.exit(asyncio.run(run_supervisor()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""Pre-baked instance used to skip ``setup`` on first boot.
+
+At image build time, ``python3 /app/scripts/template_instance.py build`` runs
+``setup`` with placeholder host, ports, credentials, and keystore, creates the
+backends and indexes, then moves the instance files (``config``, ``db``, etc.)
+into ``TEMPLATE_DIR`` so the distribution in ``/opt/opendj`` stays pristine.
+
+On first boot, the template is copied into ``/opt/opendj`` (if it was built with
+the same backend engine, backends, and root DN as the container requires) and
+only host-specific parts are personalized while the server is stopped: listen
+ports, certificate alias and PIN of the LDAPS keystore, root password hash, and
+PINs of the admin keystore and ADS truststore.
+Keys shared with every container of the image (admin keystore and ADS truststore)
+are regenerated by the entrypoint once the server is started.
+"""
+import base64
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import re
+import secrets
+import shlex
+import shutil
+import sys
+import time
+
+from pygluu.containerlib.utils import as_boolean
+
+from settings import LOGGING_CONFIG
+from toolrunner import exec_cmd
+from utils import OPENDJ_DIR
+from utils import get_backend_type
+from utils import get_backends
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("entrypoint")
+
+TEMPLATE_DIR = "/opt/opendj-template"
+
+TEMPLATE_MANIFEST = f"{TEMPLATE_DIR}/manifest.json"
+
+#: top-level paths created by ``setup``; everything else belongs to the distribution
+INSTANCE_PATHS = ("config", "db", "changelogDb", "logs", "locks", "bak", "backup", "seed", "import-tmp", "instance.loc")
+
+#: placeholders used while building the template
+TEMPLATE_BINDDN = "cn=directory manager"
+TEMPLATE_HOSTNAME = "localhost"
+TEMPLATE_PORTS = {"ldap": 1389, "ldaps": 1636, "admin": 4444}
+TEMPLATE_KEYSTORE_ALIAS = "template-cert"
+
+#: keystore referenced by the LDAPS connection handler (same path as in running containers)
+KEYSTORE_FILE = "/etc/certs/opendj.pkcs12"
+
+ROOT_DNS_SUFFIX = "cn=root dns,cn=config"
+
+#: PIN files baked into the template, and keystores (relative to the instance) protected by each of them
+PIN_STORES = {
+    "config/admin-keystore.pin": ("config/admin-keystore", "config/admin-truststore"),
+    "config/ads-truststore.pin": ("config/ads-truststore",),
+}
+
+#: truststore of the instance, which ``setup`` fills with the certificate of the LDAPS keystore
+TRUSTSTORE_FILE = "config/truststore"
+
+#: DNs of entries which listen port is personalized, and key of the port in ``ports``
+LISTENERS = {
+    "cn=ldap connection handler,cn=connection handlers,cn=config": "ldap",
+    "cn=ldaps connection handler,cn=connection handlers,cn=config": "ldaps",
+    "cn=administration connector,cn=config": "admin",
+}
+
+
+def template_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_TEMPLATE_ENABLED", True))
+
+
+def load_manifest():
+    try:
+        with open(TEMPLATE_MANIFEST) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def template_mismatch(manifest, binddn):
+    """Get reason why the template can't be used, or an empty string if it can.
+    """
+    if not manifest:
+        return "template is not available"
+    if manifest["backend_type"] != get_backend_type():
+        return f"template uses {manifest['backend_type']} backends"
+    if manifest["backends"] != get_backends():
+        return f"template has different backends ({', '.join(sorted(manifest['backends']))})"
+    if manifest["binddn"].lower() != binddn.lower():
+        return f"template uses {manifest['binddn']} as root DN"
+    return ""
+
+
+def copy_template(opendj_dir=OPENDJ_DIR):
+    """Copy instance files of the template; directories may be mounted volumes, hence copied into.
+    """
+    for name in os.listdir(TEMPLATE_DIR):
+        src = os.path.join(TEMPLATE_DIR, name)
+        dst = os.path.join(opendj_dir, name)
+        if src == TEMPLATE_MANIFEST:
+            continue
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, dst)
+
+
+def normalize_dn(dn):
+    return re.sub(r"\s*,\s*", ",", dn.strip()).lower()
+
+
+def read_ldif(path):
+    """Read entries of an LDIF file as lists of (unfolded) lines.
+    """
+    with open(path) as f:
+        content = f.read().replace("\n ", "")
+    return [block.split("\n") for block in content.split("\n\n") if block.strip()]
+
+
+def write_ldif(path, entries):
+    with open(f"{path}.tmp", "w") as f:
+        f.write("\n\n".join("\n".join(lines) for lines in entries) + "\n\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def entry_dn(lines):
+    for line in lines:
+        if line.startswith("dn:"):
+            return normalize_dn(line[3:])
+    return ""
+
+
+def get_attr(lines, attr):
+    prefix = f"{attr.lower()}:"
+    return [line[len(prefix):].strip() for line in lines if line.lower().startswith(prefix)]
+
+
+def replace_attr(lines, attr, values):
+    """Replace all values of ``attr`` in an entry; entries without ``attr`` are left as is.
+    """
+    prefix = f"{attr.lower()}:"
+    index = next((i for i, line in enumerate(lines) if line.lower().startswith(prefix)), None)
+    if index is None:
+        return lines
+    kept = [line for line in lines if not line.lower().startswith(prefix)]
+    return kept[:index] + [f"{attr}: {value}" for value in values] + kept[index:]
+
+
+def hash_password(password):
+    """Hash ``password`` using Salted SHA-512 scheme of OpenDJ.
+    """
+    salt = secrets.token_bytes(8)
+    digest = hashlib.sha512(password.encode() + salt).digest()
+    return "{SSHA512}" + base64.b64encode(digest + salt).decode()
+
+
+def get_keystore_alias(keystore_file, password):
+    cmd = f"keytool -list -v -storetype PKCS12 -keystore {keystore_file} -storepass {shlex.quote(password)}"
+    out, err, code = exec_cmd(cmd)
+    if code != 0:
+        err = err or out
+        raise RuntimeError(f"Unable to read alias of {keystore_file}; reason={err.decode().strip()}")
+
+    match = re.search(r"^Alias name: (.+)$", out.decode(), re.MULTILINE)
+    if not match:
+        raise RuntimeError(f"Unable to find any key in {keystore_file}")
+    return match.group(1).strip()
+
+
+def personalize_config(opendj_dir, ports, keystore_alias, keystore_password, root_password):
+    """Set listen ports, LDAPS keystore alias and PIN, and root password in ``config.ldif`` of a stopped server.
+    """
+    config_file = f"{opendj_dir}/config/config.ldif"
+
+    entries = []
+    for lines in read_ldif(config_file):
+        dn = entry_dn(lines)
+        if dn in LISTENERS:
+            lines = replace_attr(lines, "ds-cfg-listen-port", [ports[LISTENERS[dn]]])
+        if dn.endswith(",cn=connection handlers,cn=config"):
+            lines = replace_attr(lines, "ds-cfg-ssl-cert-nickname", [keystore_alias])
+        if dn.endswith(",cn=key manager providers,cn=config") and KEYSTORE_FILE in get_attr(lines, "ds-cfg-key-store-file"):
+            for pin_file in get_attr(lines, "ds-cfg-key-store-pin-file"):
+                write_pin(os.path.join(opendj_dir, pin_file), keystore_password)
+            lines = replace_attr(lines, "ds-cfg-key-store-pin", [keystore_password])
+        if dn.endswith(f",{ROOT_DNS_SUFFIX}"):
+            lines = replace_attr(lines, "userPassword", [hash_password(root_password)])
+        entries.append(lines)
+    write_ldif(config_file, entries)
+
+
+def write_pin(path, pin):
+    with open(path, "w") as f:
+        f.write(pin)
+    os.chmod(path, 0o600)
+
+
+def keytool(args, action):
+    out, err, code = exec_cmd(f"keytool {args}")
+    if code != 0:
+        err = err or out
+        raise RuntimeError(f"Unable to {action}; reason={err.decode().strip()}")
+    return out.decode()
+
+
+def change_store_pin(store, old_pin_file, new_pin_file):
+    """Change password of a JKS keystore and of its keys (which share the store password).
+    """
+    out = keytool(f"-list -keystore {store} -storepass:file {old_pin_file}", f"list keys of {store}")
+    aliases = re.findall(r"^(.+?), .*, PrivateKeyEntry,", out, re.MULTILINE)
+
+    keytool(f"-storepasswd -keystore {store} -storepass:file {old_pin_file} -new:file {new_pin_file}", f"change password of {store}")
+    for alias in aliases:
+        keytool(
+            f"-keypasswd -alias {shlex.quote(alias)} -keystore {store} -storepass:file {new_pin_file} "
+            f"-keypass:file {old_pin_file} -new:file {new_pin_file}",
+            f"change password of {alias} key in {store}",
+        )
+
+
+def rotate_pins(opendj_dir=OPENDJ_DIR):
+    """Replace PINs copied from the template (hence shared by every container of the image) with random ones.
+
+    Must be called while the server is stopped, as it reads the PIN files on startup.
+    """
+    for pin_file, stores in PIN_STORES.items():
+        pin_path = os.path.join(opendj_dir, pin_file)
+        new_pin_path = f"{pin_path}.new"
+        write_pin(new_pin_path, secrets.token_urlsafe(24))
+
+        for store in stores:
+            store_path = os.path.join(opendj_dir, store)
+            if os.path.isfile(store_path):
+                change_store_pin(store_path, pin_path, new_pin_path)
+        os.replace(new_pin_path, pin_path)
+
+
+def get_truststore_pin(opendj_dir, default):
+    """Get PIN of ``TRUSTSTORE_FILE`` from trust manager providers in ``config.ldif``, or ``default``.
+    """
+    for lines in read_ldif(f"{opendj_dir}/config/config.ldif"):
+        if TRUSTSTORE_FILE not in get_attr(lines, "ds-cfg-trust-store-file"):
+            continue
+        for pin in get_attr(lines, "ds-cfg-trust-store-pin"):
+            return pin
+        for pin_file in get_attr(lines, "ds-cfg-trust-store-pin-file"):
+            with open(os.path.join(opendj_dir, pin_file)) as f:
+                return f.read().strip()
+    return default
+
+
+def build(opendj_dir=OPENDJ_DIR):
+    """Install a server with placeholder settings and move its instance files to ``TEMPLATE_DIR``.
+    """
+    # imported here, as entrypoint imports this module
+    from entrypoint import configure_opendj_indexes
+    from entrypoint import create_backends
+    from entrypoint import install_opendj
+    from ldap_pool import ConnectionPool
+
+    existing = {name for name in INSTANCE_PATHS if os.path.exists(os.path.join(opendj_dir, name))}
+    if existing:
+        logger.error(f"Found instance files ({', '.join(sorted(existing))}) in {opendj_dir}; template must be built from a pristine distribution")
+        sys.exit(1)
+
+    password = secrets.token_urlsafe(24)
+    password_file = os.path.join(opendj_dir, ".template-pw")
+    write_pin(password_file, password)
+
+    cmd = " ".join([
+        "keytool -genkeypair",
+        f"-alias {TEMPLATE_KEYSTORE_ALIAS}",
+        "-keyalg RSA",
+        "-keysize 2048",
+        "-validity 1",
+        "-storetype PKCS12",
+        f"-keystore {KEYSTORE_FILE}",
+        f"-storepass '{password}'",
+        f"-keypass '{password}'",
+        f"-dname 'CN={TEMPLATE_HOSTNAME}'",
+    ])
+    out, err, code = exec_cmd(cmd)
+    if code != 0:
+        err = err or out
+        logger.error(f"Unable to create template keystore; reason={err.decode().strip()}")
+        sys.exit(1)
+
+    try:
+        install_opendj(
+            opendj_dir=opendj_dir,
+            hostname=TEMPLATE_HOSTNAME,
+            ldap_port=TEMPLATE_PORTS["ldap"],
+            ldaps_port=TEMPLATE_PORTS["ldaps"],
+            admin_port=TEMPLATE_PORTS["admin"],
+            password_file=password_file,
+            binddn=TEMPLATE_BINDDN,
+            keystore_password=password,
+        )
+
+        _, err, code = exec_cmd(f"{opendj_dir}/bin/start-ds --quiet")
+        if code:
+            logger.error(f"Unable to start template instance; reason={err.decode().strip()}")
+            sys.exit(1)
+
+        try:
+            create_backends(
+                opendj_dir=opendj_dir,
+                hostname=TEMPLATE_HOSTNAME,
+                admin_port=TEMPLATE_PORTS["admin"],
+                password_file=password_file,
+                binddn=TEMPLATE_BINDDN,
+            )
+            pool = ConnectionPool(f"{TEMPLATE_HOSTNAME}:{TEMPLATE_PORTS['ldaps']}", TEMPLATE_BINDDN, password)
+            try:
+                configure_opendj_indexes(pool=pool)
+            finally:
+                pool.close()
+        finally:
+            exec_cmd(f"{opendj_dir}/bin/stop-ds --quiet")
+
+        # the placeholder certificate expires in a day and must not be trusted by instances
+        truststore = os.path.join(opendj_dir, TRUSTSTORE_FILE)
+        if os.path.isfile(truststore):
+            pin = get_truststore_pin(opendj_dir, password)
+            out, err, code = exec_cmd(f"keytool -delete -alias {TEMPLATE_KEYSTORE_ALIAS} -keystore {truststore} -storepass {shlex.quote(pin)}")
+            if code != 0:
+                err = err or out
+                logger.error(f"Unable to remove {TEMPLATE_KEYSTORE_ALIAS} from {truststore}; reason={err.decode().strip()}")
+                sys.exit(1)
+    finally:
+        for path in (password_file, KEYSTORE_FILE, f"{opendj_dir}/opendj-setup.properties"):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    os.makedirs(TEMPLATE_DIR, exist_ok=True)
+    for name in INSTANCE_PATHS:
+        path = os.path.join(opendj_dir, name)
+        if os.path.exists(path):
+            shutil.move(path, os.path.join(TEMPLATE_DIR, name))
+
+    # logs and locks of the build are meaningless for instances
+    for name in ("logs", "locks"):
+        path = os.path.join(TEMPLATE_DIR, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    with open(TEMPLATE_MANIFEST, "w") as f:
+        json.dump({
+            "backend_type": get_backend_type(),
+            "backends": get_backends(),
+            "binddn": TEMPLATE_BINDDN,
+            "ports": TEMPLATE_PORTS,
+            "keystore_alias": TEMPLATE_KEYSTORE_ALIAS,
+            "built_at": time.time(),
+        }, f, indent=2)
+    logger.info(f"Template instance has been built in {TEMPLATE_DIR}")
+
+
+def main():
+    if sys.argv[1:] != ["build"]:
+        print(f"Usage: {sys.argv[0]} build")
+        sys.exit(1)
+    build()
+
+
+if __name__ == "__main__":
+    main()
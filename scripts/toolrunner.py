@@ -0,0 +1,142 @@
+"""Run OpenDJ CLIs inside a warm JVM (see ``toolserver/ToolServer.java``).
+
+``exec_cmd`` is a drop-in replacement of ``pygluu.containerlib.utils.exec_cmd``;
+commands of supported tools are sent to the tool server, everything else
+(or when the server is disabled or not running yet) is run as a subprocess.
+"""
+import logging
+import os
+import shlex
+import socket
+import struct
+
+from pygluu.containerlib.utils import as_boolean
+from pygluu.containerlib.utils import exec_cmd as exec_subprocess
+
+from tracing import span
+
+logger = logging.getLogger("toolrunner")
+
+TOOL_SERVER_ADDR = ("127.0.0.1", 4446)
+
+#: OpenDJ instance the tool server runs against (``org.opends.server.ServerRoot`` of its JVM)
+TOOL_SERVER_ROOT = "/opt/opendj"
+
+#: file contains the token required by the tool server; created once the server accepts connections
+TOOL_SERVER_TOKEN = "/app/tmp/toolserver.token"
+
+#: commands (by name) that can run inside the tool server and their main class; tools which
+#: may run the server in-process (i.e. offline ``import-ldif`` or ``restore``) must not be listed
+TOOL_CLASSES = {
+    "status": "org.opends.server.tools.status.StatusCli",
+    "dsconfig": "org.forgerock.opendj.config.dsconfig.DSConfig",
+    "dsreplication": "org.opends.server.tools.dsreplication.ReplicationCliMain",
+    "ldapsearch": "org.opends.server.tools.LDAPSearch",
+    "keytool": "sun.security.tools.keytool.Main",
+}
+
+#: commands of the JDK (run from ``PATH``); others must be run from ``bin`` of ``TOOL_SERVER_ROOT``
+JDK_TOOLS = ("keytool",)
+
+#: exit code reported by the tool server when another call is running (see ``ToolServer.BUSY``)
+TOOL_SERVER_BUSY = -2 ** 31
+
+
+class ToolServerBusy(ConnectionError):
+    pass
+
+
+def get_tool_class(path):
+    """Get main class of the command at ``path``, or ``None`` if it can't run inside the tool server.
+
+    OpenDJ commands of another instance (i.e. ``GLUU_OPENDJ_DIR`` of benchmark nodes)
+    are run as a subprocess, as the tool server only knows its own instance.
+    """
+    name = os.path.basename(path)
+    if name not in TOOL_CLASSES:
+        return None
+
+    if name in JDK_TOOLS:
+        return TOOL_CLASSES[name] if path == name else None
+    if os.path.dirname(os.path.normpath(path)) != os.path.join(TOOL_SERVER_ROOT, "bin"):
+        return None
+    return TOOL_CLASSES[name]
+
+
+def tool_server_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_TOOL_SERVER_ENABLED", False))
+
+
+def _pack(value):
+    data = value.encode()
+    return struct.pack(">i", len(data)) + data
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Tool server closed the connection")
+        data += chunk
+    return data
+
+
+def _recv_bytes(sock):
+    size, = struct.unpack(">i", _recv_exactly(sock, 4))
+    return _recv_exactly(sock, size)
+
+
+def run_in_tool_server(class_name, args):
+    """Run main class of a tool inside the tool server.
+
+    Returns stdout, stderr, and exit code (similar to ``exec_cmd``); raises
+    ``OSError`` if the server is not available or is running another call.
+    """
+    with open(TOOL_SERVER_TOKEN) as f:
+        token = f.read().strip()
+    if not token:
+        raise ConnectionError("Tool server is not ready")
+
+    with socket.create_connection(TOOL_SERVER_ADDR) as sock:
+        script_name = os.path.basename(args[0])
+        sock.sendall(
+            _pack(token) + _pack(class_name) + _pack(script_name)
+            + struct.pack(">i", len(args) - 1) + b"".join(_pack(arg) for arg in args[1:])
+        )
+
+        # connection failures above are safe to retry as a subprocess, but from here
+        # the tool may have run already
+        try:
+            code, = struct.unpack(">i", _recv_exactly(sock, 4))
+            out = _recv_bytes(sock)
+            err = _recv_bytes(sock)
+        except OSError as exc:
+            return b"", f"Lost connection to tool server; reason={exc}".encode(), 1
+
+    # the tool hasn't run, hence safe to retry as a subprocess
+    if code == TOOL_SERVER_BUSY:
+        raise ToolServerBusy("Tool server is running another call")
+    return out, err, code
+
+
+def exec_cmd(cmd):
+    args = shlex.split(cmd)
+    class_name = get_tool_class(args[0]) if args else None
+
+    command = os.path.basename(args[0]) if args else ""
+    # options are not recorded, as they may contain secrets
+    subcommand = args[1] if len(args) > 1 and not args[1].startswith("-") else None
+
+    with span(f"exec {command}", "exec", command=command, subcommand=subcommand) as attrs:
+        if class_name and tool_server_enabled():
+            try:
+                out, err, code = run_in_tool_server(class_name, args)
+                attrs.update(tool_server=True, code=code)
+                return out, err, code
+            except OSError as exc:
+                logger.debug(f"Unable to use tool server for {args[0]}; reason={exc}")
+
+        out, err, code = exec_subprocess(cmd)
+        attrs.update(tool_server=False, code=code)
+        return out, err, code
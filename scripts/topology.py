@@ -0,0 +1,167 @@
+"""Plan which servers run a replication server (RS).
+
+By default every server is both a directory server (DS) and an RS, hence the
+replication mesh grows quadratically with the cluster size. If
+``GLUU_LDAP_MAX_REPLICATION_SERVERS`` is set (``0``, the default, disables the
+planner), past that many members, only a bounded set of servers (spread across
+zones) run an RS, and other servers join as DS-only members connected to them.
+
+Each server advertises the following Serf tags:
+
+- ``replication_role``: preferred role, one of ``auto``, ``rs`` (always run an RS),
+  or ``ds`` (never run an RS)
+- ``zone``: zone of the server, used to spread RS across failure domains
+- ``replication_server``: whether the server currently runs an RS (updated at runtime);
+  members without this tag predate the planner and are assumed to run an RS
+
+The plan is computed independently by each server from the same membership,
+hence it must be deterministic.
+"""
+import json
+import logging
+import os
+from collections import defaultdict
+
+from pygluu.containerlib.utils import as_boolean
+
+from toolrunner import exec_cmd
+from utils import OPENDJ_DIR
+
+logger = logging.getLogger("topology")
+
+ROLE_AUTO = "auto"
+ROLE_RS = "rs"
+ROLE_DS = "ds"
+
+
+def get_replication_role():
+    role = os.environ.get("GLUU_LDAP_REPLICATION_ROLE", ROLE_AUTO).lower()
+    if role not in (ROLE_AUTO, ROLE_RS, ROLE_DS):
+        role = ROLE_AUTO
+    return role
+
+
+def get_zone():
+    return os.environ.get("GLUU_LDAP_ZONE", "")
+
+
+def get_max_replication_servers():
+    try:
+        limit = int(os.environ.get("GLUU_LDAP_MAX_REPLICATION_SERVERS", 0))
+        if limit < 0:
+            limit = 0
+    except ValueError:
+        limit = 0
+    return limit
+
+
+def get_topology_check_interval():
+    try:
+        interval = int(os.environ.get("GLUU_LDAP_TOPOLOGY_CHECK_INTERVAL", 60))
+        if interval < 1:
+            interval = 60
+    except ValueError:
+        interval = 60
+    return interval
+
+
+def runs_replication_server(member):
+    return as_boolean(member["tags"].get("replication_server", True))
+
+
+def plan_replication_servers(members, limit=None):
+    """Get names of members which should run an RS.
+
+    Members preferring ``rs`` are always selected, and members preferring ``ds``
+    never are. Remaining slots (up to ``limit``; ``0`` means unlimited) are filled
+    round-robin across zones, preferring members already running an RS so
+    membership changes move as few RS as possible.
+    """
+    if limit is None:
+        limit = get_max_replication_servers()
+
+    planned = {
+        member["name"] for member in members
+        if member["tags"].get("replication_role") == ROLE_RS
+    }
+    candidates = [
+        member for member in members
+        if member["tags"].get("replication_role", ROLE_AUTO) == ROLE_AUTO
+    ]
+
+    if not limit:
+        return planned | {member["name"] for member in candidates}
+
+    zones = defaultdict(list)
+    for member in sorted(candidates, key=lambda member: (not runs_replication_server(member), member["name"])):
+        zones[member["tags"].get("zone", "")].append(member["name"])
+
+    # zones with fewer selected RS go first
+    taken = defaultdict(int)
+    for member in members:
+        if member["name"] in planned:
+            taken[member["tags"].get("zone", "")] += 1
+
+    while len(planned) < limit and any(zones.values()):
+        zone = min((zone for zone in zones if zones[zone]), key=lambda zone: (taken[zone], zone))
+        planned.add(zones[zone].pop(0))
+        taken[zone] += 1
+    return planned
+
+
+def pick_replication_server(peers, zone=""):
+    """Pick a peer running an RS, preferring the ones in ``zone``.
+    """
+    candidates = [peer for peer in peers if runs_replication_server(peer)]
+    candidates.sort(key=lambda peer: (peer["tags"].get("zone", "") != zone, peer["name"]))
+    return candidates[0] if candidates else None
+
+
+def has_replication_server(status):
+    """Check whether ``status`` output lists a replication connection handler, i.e.
+
+        8989         : Replication (secure) : Enabled
+    """
+    return any(": Replication" in line for line in status.splitlines())
+
+
+def advertise_replication_server(active):
+    out, err, code = exec_cmd(f"serf tags -set replication_server={str(active).lower()}")
+    if code != 0:
+        err = err or out
+        logger.warning(f"Unable to advertise replication server tag; reason={err.decode()}")
+
+
+def remove_replication_server(server, password_file):
+    """Disable the RS of ``server``; its data is still replicated through other RS.
+
+    Unlike removing the RS via ``dsconfig``, ``dsreplication`` also drops it from
+    the replication server list of other servers.
+    """
+    cmd = " ".join([
+        f"{OPENDJ_DIR}/bin/dsreplication",
+        "disable",
+        "--disableReplicationServer",
+        f"--hostname {server['name']}",
+        f"--port {server['tags']['admin_port']}",
+        "--adminUID admin",
+        f"--adminPasswordFile {password_file}",
+        "-X",
+        "-n",
+        "-Q",
+    ])
+    out, err, code = exec_cmd(cmd)
+    if code != 0:
+        err = err or out
+        logger.warning(f"Unable to disable replication server; reason={err.decode().strip()}")
+    return code == 0
+
+
+def membership_signature(members):
+    """Get a digest of members and their topology tags, used to detect membership changes.
+    """
+    keys = ("replication_role", "zone", "replication_server")
+    return json.dumps(sorted(
+        [member["name"]] + [member["tags"].get(key) for key in keys]
+        for member in members
+    ))
@@ -0,0 +1,265 @@
+"""Structured logging and timing spans of external calls.
+
+Calls to external systems (OpenDJ CLIs via ``exec_cmd``, LDAP operations of
+pooled connections, and config/secret stores) are wrapped in spans when
+``GLUU_LDAP_TRACE_ENABLED`` is set. Each span is logged by the ``tracing`` logger
+with its duration, and spans started while another one is active (in the same
+thread or asyncio task) are recorded as its children.
+
+Log records are formatted on the caller's thread and written by a background
+thread (see ``QueueingStreamHandler``), as plain text or as JSON lines when
+``GLUU_LDAP_LOG_FORMAT`` is ``json``, i.e.:
+
+    {"time": "2020-10-19T08:00:00.123Z", "level": "INFO", "logger": "tracing",
+     "message": "exec dsconfig took 1520.3 ms", "trace_id": "...", "span_id": "...",
+     "parent_id": "...", "span": "exec dsconfig", "category": "exec",
+     "duration_ms": 1520.3, "attrs": {"command": "dsconfig", "subcommand": "set-backend-prop", "code": 0}}
+
+If ``GLUU_LDAP_TRACE_FILE`` is set, spans are also appended to that file in
+Chrome trace event format, which can be opened in ``chrome://tracing`` or Perfetto.
+"""
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+
+from pygluu.containerlib import get_manager as new_manager
+from pygluu.containerlib.utils import as_boolean
+
+logger = logging.getLogger("tracing")
+
+#: identifies spans of current process
+TRACE_ID = uuid.uuid4().hex
+
+#: methods of config and secret stores wrapped in spans
+TRACED_METHODS = {
+    "config": ("get", "set", "all"),
+    "secret": ("get", "set", "all", "to_file", "from_file"),
+}
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def tracing_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_TRACE_ENABLED", False))
+
+
+def get_trace_file():
+    return os.environ.get("GLUU_LDAP_TRACE_FILE", "")
+
+
+#: spans are on the hot path of LDAP operations, hence checked once
+TRACING_ENABLED = tracing_enabled()
+
+
+class Span:
+    def __init__(self, name, category, attrs, parent=None, started_at=None):
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.started_at = started_at or time.time()
+
+    def to_dict(self, duration):
+        return {
+            "trace_id": TRACE_ID,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "span": self.name,
+            "category": self.category,
+            "started_at": self.started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "attrs": self.attrs,
+        }
+
+
+def _finish(current, duration):
+    logger.info(
+        f"{current.name} took {duration * 1000:.1f} ms",
+        extra={"span": current.to_dict(duration)},
+    )
+
+
+@contextmanager
+def span(name, category, **attrs):
+    """Time the enclosed block; yields a dict of attributes which can be updated
+    (i.e. with an exit code) before the span ends.
+    """
+    if not TRACING_ENABLED:
+        yield attrs
+        return
+
+    current = Span(name, category, attrs, parent=_current_span.get())
+    token = _current_span.set(current)
+    started_at = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as exc:
+        attrs["error"] = str(exc) or exc.__class__.__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(current, time.perf_counter() - started_at)
+
+
+def record_span(name, category, duration, **attrs):
+    """Record a span which has already ended, i.e. reported by a timing hook.
+    """
+    if not TRACING_ENABLED:
+        return
+    current = Span(name, category, attrs, parent=_current_span.get(), started_at=time.time() - duration)
+    _finish(current, duration)
+
+
+def ldap_hook(host):
+    """Get a timing hook of ``ldap_pool.ConnectionPool`` recording each operation as a span.
+    """
+    def hook(operation, elapsed, result):
+        record_span(f"ldap {operation}", "ldap", elapsed, host=host, result=(result or {}).get("description"))
+    return hook
+
+
+def _traced_method(kind, name, method):
+    @functools.wraps(method)
+    def traced(*args, **kwargs):
+        # values are never recorded, as they may be secrets
+        key = kwargs.get("key", args[0] if args else None)
+        with span(f"{kind} {name}", kind, key=key):
+            return method(*args, **kwargs)
+    return traced
+
+
+def instrument_manager(manager):
+    """Wrap calls of config and secret stores of ``manager`` in spans.
+    """
+    if not TRACING_ENABLED or getattr(manager, "_traced", False):
+        return manager
+
+    for kind, names in TRACED_METHODS.items():
+        store = getattr(manager, kind)
+        for name in names:
+            method = getattr(store, name, None)
+            if callable(method):
+                setattr(store, name, _traced_method(kind, name, method))
+    manager._traced = True
+    return manager
+
+
+def get_manager():
+    """Same as ``pygluu.containerlib.get_manager``, with traced config and secret stores.
+    """
+    return instrument_manager(new_manager())
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as a single JSON line, with IDs of the span it belongs to.
+    """
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+
+        span_data = getattr(record, "span", None)
+        if span_data:
+            data.update(span_data)
+        else:
+            current = _current_span.get()
+            if current:
+                data.update(trace_id=TRACE_ID, span_id=current.span_id)
+
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class ChromeTraceHandler(logging.Handler):
+    """Append spans to ``path`` in Chrome trace event (JSON array) format.
+
+    The closing bracket is never written, which the format allows, hence
+    several processes can append to the same file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.named_threads = set()
+
+    def emit(self, record):
+        span_data = getattr(record, "span", None)
+        if not span_data:
+            return
+
+        events = []
+        if (record.process, record.thread) not in self.named_threads:
+            self.named_threads.add((record.process, record.thread))
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": record.process, "tid": record.thread,
+                "args": {"name": record.threadName},
+            })
+        events.append({
+            "name": span_data["span"],
+            "cat": span_data["category"],
+            "ph": "X",
+            "ts": int(span_data["started_at"] * 1_000_000),
+            "dur": int(span_data["duration_ms"] * 1000),
+            "pid": record.process,
+            "tid": record.thread,
+            "args": dict(span_data["attrs"], span_id=span_data["span_id"], parent_id=span_data["parent_id"]),
+        })
+
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                if f.tell() == 0:
+                    f.write("[\n")
+                f.write("".join(json.dumps(event, default=str) + ",\n" for event in events))
+        except OSError:
+            self.handleError(record)
+
+
+class QueueingStreamHandler(logging.handlers.QueueHandler):
+    """Format records on the caller's thread and write them (to stderr and the
+    trace file, if any) from a background thread, so logging never blocks on I/O.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(queue.SimpleQueue())
+
+        stream_handler = logging.StreamHandler(stream)
+        # records are formatted already
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.handlers = [stream_handler]
+
+        trace_file = get_trace_file()
+        if trace_file:
+            self.handlers.append(ChromeTraceHandler(trace_file))
+
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers)
+        self.listener.start()
+        self._lock_listener = threading.Lock()
+
+    def close(self):
+        # flushes queued records; called by ``logging.shutdown`` on exit and on reconfiguration
+        with self._lock_listener:
+            if self.listener:
+                self.listener.stop()
+                self.listener = None
+                for handler in self.handlers:
+                    handler.close()
+        super().close()
@@ -1,7 +1,19 @@
-import json
+import contextlib
 import os
+import random
 import socket
 
+from pygluu.containerlib.utils import as_boolean
+
+#: OpenDJ installation directory; only overridden when running several
+#: instances on a single host (see ``bench_replication.py``)
+OPENDJ_DIR = os.environ.get("GLUU_OPENDJ_DIR", "/opt/opendj")
+
+DEFAULT_ADMIN_PW_PATH = f"{OPENDJ_DIR}/.pw"
+
+#: marker file which exists while the server is being drained before removal (see ``deregister_peer.py``)
+DRAIN_MARKER = "/app/tmp/draining"
+
 
 def guess_serf_addr():
     addr = os.environ.get("GLUU_SERF_ADVERTISE_ADDR", "")
@@ -10,21 +22,136 @@ def guess_serf_addr():
     return addr
 
 
-def get_serf_peers(manager):
-    return json.loads(manager.config.get("serf_peers", "[]"))
+def backoff_delays(initial=0.05, maximum=10.0, factor=2.0):
+    """Generate exponentially growing delays (in seconds) with full jitter.
+
+    Each delay is picked randomly between ``initial`` and the current ceiling,
+    where the ceiling starts at ``initial`` and is multiplied by ``factor``
+    (capped at ``maximum``) after every delay.
+    """
+    ceiling = initial
+    while True:
+        yield random.uniform(initial, ceiling)
+        ceiling = min(ceiling * factor, maximum)
+
+
+def require_site():
+    return require_mapping("site")
+
+
+#: optional backends split from ``o=gluu`` (see ``GLUU_LDAP_SPLIT_BACKENDS``); each backend
+#: has its own JE environment, hence its own cache share, cleaner, and locks
+SPLIT_BACKENDS = {
+    "people": {
+        "base_dn": "ou=people,o=gluu",
+        "mapping": "user",
+        "db_cache_percent": 20,
+        "db_num_cleaner_threads": 1,
+    },
+    "tokens": {
+        "base_dn": "ou=tokens,o=gluu",
+        "mapping": "token",
+        "db_cache_percent": 10,
+        "db_num_cleaner_threads": 2,
+    },
+    "sessions": {
+        "base_dn": "ou=sessions,o=gluu",
+        "mapping": "session",
+        "db_cache_percent": 5,
+        "db_num_cleaner_threads": 2,
+    },
+}
+
+
+def require_mapping(mapping):
+    """Check whether data of given persistence mapping is stored in LDAP.
+    """
+    persistence_type = os.environ.get("GLUU_PERSISTENCE_TYPE", "ldap")
+    ldap_mapping = os.environ.get("GLUU_PERSISTENCE_LDAP_MAPPING", "default")
+
+    if persistence_type == "ldap":
+        return True
+    if persistence_type == "hybrid" and ldap_mapping == mapping:
+        return True
+    return False
+
+
+def get_split_backends():
+    """Get split backends (if enabled) which data is stored in LDAP.
+    """
+    if not as_boolean(os.environ.get("GLUU_LDAP_SPLIT_BACKENDS", False)):
+        return {}
+    return {
+        backend: attrs for backend, attrs in SPLIT_BACKENDS.items()
+        if require_mapping(attrs["mapping"])
+    }
+
+
+def get_backend_type():
+    """Get backend engine used by all backends, either ``je`` or ``pdb``.
+    """
+    backend_type = os.environ.get("GLUU_LDAP_BACKEND_TYPE", "je")
+    if backend_type not in ("je", "pdb"):
+        backend_type = "je"
+    return backend_type
+
+
+def get_backends():
+    """Get mapping of backend ID and its base DN.
+    """
+    backends = {
+        "userRoot": "o=gluu",
+        "metric": "o=metric",
+    }
+    if require_site():
+        backends["site"] = "o=site"
+
+    for backend, attrs in get_split_backends().items():
+        backends[backend] = attrs["base_dn"]
+    return backends
+
+
+@contextlib.contextmanager
+def admin_password_bound(manager, password_file=DEFAULT_ADMIN_PW_PATH):
+    if not os.path.isfile(password_file):
+        manager.secret.to_file(
+            "encoded_ox_ldap_pw", password_file, decode=True,
+        )
+
+    try:
+        yield password_file
+    except Exception:
+        raise
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(password_file)
 
 
-def register_serf_peer(manager, addr):
-    peers = set(get_serf_peers(manager))
-    peers.add(addr)
-    manager.config.set("serf_peers", list(peers))
+def get_memory_limit():
+    """Get memory limit (in bytes) of the container, or total memory of the host.
+    """
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                limit = int(f.read().strip())
+            # unlimited cgroup reports a huge number
+            if limit < 1 << 50:
+                return limit
+        except (FileNotFoundError, ValueError):
+            continue
 
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return 0
 
-def deregister_serf_peer(manager, addr):
-    peers = set(get_serf_peers(manager))
 
+def get_heap_size():
+    """Estimate max. JVM heap (in bytes) as configured by ``GLUU_MAX_RAM_PERCENTAGE``.
+    """
     try:
-        peers.remove(addr)
-        manager.config.set("serf_peers", list(peers))
-    except KeyError:
-        pass
+        percentage = float(os.environ.get("GLUU_MAX_RAM_PERCENTAGE", "75.0"))
+    except ValueError:
+        percentage = 75.0
+    return int(get_memory_limit() * percentage / 100)
@@ -1,18 +1,130 @@
 import logging
 import logging.config
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from pygluu.containerlib import get_manager
-from pygluu.containerlib import wait_for
 from pygluu.containerlib.validators import validate_persistence_type
 from pygluu.containerlib.validators import validate_persistence_ldap_mapping
 
 from settings import LOGGING_CONFIG
+from tracing import get_manager
+from utils import backoff_delays
 
 logging.config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger("wait")
 
 
+class WaitError(Exception):
+    pass
+
+
+def probe_config(manager):
+    if not manager.config.get("hostname"):
+        raise WaitError("Config 'hostname' is not available")
+
+
+def probe_secret(manager):
+    if not manager.secret.get("ssl_cert"):
+        raise WaitError("Secret 'ssl_cert' is not available")
+
+
+PROBES = {
+    "config": probe_config,
+    "secret": probe_secret,
+}
+
+
+def get_wait_max_time():
+    try:
+        max_time = int(os.environ.get("GLUU_WAIT_MAX_TIME", 300))
+        if max_time < 1:
+            max_time = 300
+    except ValueError:
+        max_time = 300
+    return max_time
+
+
+def get_wait_sleep_duration():
+    try:
+        duration = float(os.environ.get("GLUU_WAIT_SLEEP_DURATION", 10))
+        if duration <= 0:
+            duration = 10
+    except ValueError:
+        duration = 10
+    return duration
+
+
+def get_wait_initial_delay():
+    try:
+        delay = float(os.environ.get("GLUU_WAIT_INITIAL_DELAY", 0.05))
+        if delay <= 0:
+            delay = 0.05
+    except ValueError:
+        delay = 0.05
+    return delay
+
+
+def wait_for_dependency(manager, name, deadline, initial_delay, max_delay):
+    """Probe a single dependency until it is ready or the deadline passes.
+
+    Returns the number of seconds spent waiting for the dependency.
+    """
+    probe = PROBES[name]
+    delays = backoff_delays(initial_delay, max_delay)
+    start = time.monotonic()
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            probe(manager)
+        except Exception as exc:
+            reason = exc
+        else:
+            elapsed = time.monotonic() - start
+            logger.info(f"Dependency {name} is ready after {elapsed:.3f} seconds ({attempt} attempt(s))")
+            return elapsed
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitError(f"Dependency {name} is not ready after {attempt} attempt(s); reason={reason}")
+
+        delay = min(next(delays), remaining)
+        logger.debug(f"Dependency {name} is not ready; reason={reason} ... retrying in {delay:.3f} seconds")
+        time.sleep(delay)
+
+
+def wait_for_dependencies(manager, deps):
+    """Probe all dependencies concurrently with jittered exponential backoff.
+
+    Returns a mapping of dependency name and seconds spent waiting for it.
+    """
+    max_time = get_wait_max_time()
+    deadline = time.monotonic() + max_time
+    initial_delay = get_wait_initial_delay()
+    max_delay = get_wait_sleep_duration()
+
+    with ThreadPoolExecutor(max_workers=len(deps)) as executor:
+        futures = {
+            name: executor.submit(wait_for_dependency, manager, name, deadline, initial_delay, max_delay)
+            for name in deps
+        }
+
+    elapsed = {}
+    errors = []
+    for name, future in futures.items():
+        try:
+            elapsed[name] = future.result()
+        except WaitError as exc:
+            errors.append(str(exc))
+
+    if errors:
+        raise WaitError("; ".join(errors))
+    return elapsed
+
+
 def main():
     persistence_type = os.environ.get("GLUU_PERSISTENCE_TYPE", "ldap")
     validate_persistence_type(persistence_type)
@@ -22,7 +134,15 @@ def main():
 
     manager = get_manager()
     deps = ["config", "secret"]
-    wait_for(manager, deps)
+
+    try:
+        elapsed = wait_for_dependencies(manager, deps)
+    except WaitError as exc:
+        logger.error(f"Unable to reach dependencies after {get_wait_max_time()} seconds; {exc}")
+        sys.exit(1)
+
+    summary = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in elapsed.items())
+    logger.info(f"All dependencies are ready; waited {summary}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import json
+import logging
+import logging.config
+import os
+import pathlib
+import time
+
+import ldap3
+from ldap3.core.exceptions import LDAPException
+from pygluu.containerlib.utils import as_boolean
+
+from ldap_pool import get_pool
+from settings import LOGGING_CONFIG
+from tracing import get_manager
+from utils import get_backends
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("warmup")
+
+#: marker file (container-local) signalling the server has been warmed up
+WARMUP_MARKER = "/app/tmp/warmup.done"
+
+DEFAULT_WARMUP_SEARCHES = [
+    {"base": "ou=clients,o=gluu", "filter": "(objectClass=oxAuthClient)"},
+    {"base": "ou=scopes,o=gluu", "filter": "(objectClass=oxAuthCustomScope)"},
+    {"base": "ou=configuration,o=gluu", "filter": "(objectClass=*)"},
+    {"base": "ou=groups,o=gluu", "filter": "(objectClass=gluuGroup)"},
+    {"base": "ou=attributes,o=gluu", "filter": "(objectClass=gluuAttribute)"},
+    {"base": "ou=scripts,o=gluu", "filter": "(objectClass=oxCustomScript)"},
+]
+
+#: JE environment stats (from backend monitor entry) reporting cache usage in bytes
+CACHE_SIZE_ATTRS = ("EnvironmentCacheTotalBytes", "EnvironmentCacheDataBytes")
+
+
+def warmup_enabled():
+    return as_boolean(os.environ.get("GLUU_LDAP_WARMUP_ENABLED", True))
+
+
+def get_warmup_timeout():
+    try:
+        timeout = int(os.environ.get("GLUU_LDAP_WARMUP_TIMEOUT", 300))
+        if timeout < 0:
+            timeout = 300
+    except ValueError:
+        timeout = 300
+    return timeout
+
+
+def get_warmup_cache_target():
+    try:
+        target = float(os.environ.get("GLUU_LDAP_WARMUP_CACHE_TARGET", 80))
+        if not 0 < target <= 100:
+            target = 80
+    except ValueError:
+        target = 80
+    return target
+
+
+def is_valid_search(search):
+    return (
+        isinstance(search, dict)
+        and isinstance(search.get("base"), str)
+        and isinstance(search.get("filter", ""), str)
+    )
+
+
+def get_warmup_searches():
+    raw = os.environ.get("GLUU_LDAP_WARMUP_SEARCHES", "")
+    try:
+        searches = json.loads(raw) if raw else DEFAULT_WARMUP_SEARCHES
+        if not isinstance(searches, list) or not all(is_valid_search(search) for search in searches):
+            logger.warning("Invalid GLUU_LDAP_WARMUP_SEARCHES; expecting a list of objects with base (and optional filter); using defaults")
+            searches = DEFAULT_WARMUP_SEARCHES
+    except json.JSONDecodeError:
+        logger.warning("Unable to parse GLUU_LDAP_WARMUP_SEARCHES as JSON; using defaults")
+        searches = DEFAULT_WARMUP_SEARCHES
+    return searches
+
+
+def connect(pool, deadline):
+    """Get a connection to the local server, waiting until it's up or deadline passes.
+
+    The connection must be returned to the pool after use.
+    """
+    while True:
+        try:
+            return pool.acquire()
+        except LDAPException as exc:
+            if time.monotonic() > deadline:
+                logger.warning(f"Unable to connect to LDAP server; reason={exc}")
+                return None
+            time.sleep(2)
+
+
+def run_warmup_searches(conn, searches):
+    for search in searches:
+        started_at = time.monotonic()
+        entries = conn.extend.standard.paged_search(
+            search_base=search["base"],
+            search_filter=search.get("filter", "(objectClass=*)"),
+            search_scope=ldap3.SUBTREE,
+            attributes=["*"],
+            paged_size=500,
+            generator=True,
+        )
+        count = sum(1 for entry in entries if entry.get("type") == "searchResEntry")
+        logger.info(f"Warmed up {count} entries under {search['base']} in {time.monotonic() - started_at:.1f} seconds")
+
+
+def get_cache_fill(conn):
+    """Get DB cache fill (in percent) of all backends combined.
+    """
+    conn.search("cn=System Information,cn=monitor", "(objectClass=*)", ldap3.BASE, attributes=["maxMemory"])
+    if not conn.entries:
+        return 0.0
+    max_memory = int(conn.entries[0]["maxMemory"].value or 0)
+
+    used = capacity = 0
+    for backend in get_backends():
+        conn.search(
+            f"ds-cfg-backend-id={backend},cn=Backends,cn=config", "(objectClass=*)",
+            ldap3.BASE, attributes=["ds-cfg-db-cache-percent"],
+        )
+        if not conn.entries:
+            continue
+        capacity += max_memory * int(conn.entries[0]["ds-cfg-db-cache-percent"].value or 0) / 100
+
+        conn.search(
+            "cn=monitor", f"(cn={backend} Database Environment)",
+            ldap3.SUBTREE, attributes=list(CACHE_SIZE_ATTRS),
+        )
+        for entry in conn.entries:
+            attrs = entry.entry_attributes_as_dict
+            for attr in CACHE_SIZE_ATTRS:
+                if attrs.get(attr):
+                    used += int(attrs[attr][0])
+                    break
+    return used / capacity * 100 if capacity else 0.0
+
+
+def wait_for_cache_fill(conn, deadline, target, interval=5, stable_checks=3):
+    """Wait until cache fill reaches ``target`` or stops growing (data fits in cache).
+    """
+    previous = -1.0
+    stable = 0
+
+    while time.monotonic() < deadline:
+        fill = get_cache_fill(conn)
+        if fill >= target:
+            logger.info(f"DB cache fill reached {fill:.1f}%")
+            return
+
+        stable = stable + 1 if fill <= previous else 0
+        if stable >= stable_checks:
+            logger.info(f"DB cache fill stopped growing at {fill:.1f}%")
+            return
+
+        previous = fill
+        time.sleep(interval)
+    logger.warning("Timeout while waiting for DB cache fill")
+
+
+def main():
+    marker = pathlib.Path(WARMUP_MARKER)
+
+    if warmup_enabled():
+        started_at = time.monotonic()
+        deadline = started_at + get_warmup_timeout()
+        manager = get_manager()
+
+        pool = get_pool(manager)
+        conn = connect(pool, deadline)
+        if conn:
+            try:
+                run_warmup_searches(conn, get_warmup_searches())
+                wait_for_cache_fill(conn, deadline, get_warmup_cache_target())
+            except LDAPException as exc:
+                logger.warning(f"Unable to warm up LDAP server; reason={exc}")
+            finally:
+                pool.release(conn)
+        logger.info(f"Warm-up finished in {time.monotonic() - started_at:.1f} seconds")
+
+    # mark as warmed-up regardless of the result, as readiness must not be blocked forever
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.attribute.PosixFilePermissions;
+import java.security.MessageDigest;
+import java.security.Permission;
+import java.security.SecureRandom;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.locks.ReentrantLock;
+
+/**
+ * Runs CLI entry points (i.e. OpenDJ tools and keytool) inside a single warm JVM,
+ * so each call doesn't pay JVM startup and class loading.
+ *
+ * <p>Usage: {@code java ToolServer <port> <token-file>}
+ *
+ * <p>The server listens on loopback address only and writes a random token into
+ * {@code token-file} (readable by owner only) once it accepts connections. Each
+ * connection carries a single call; all strings are sent as 4-byte length followed
+ * by UTF-8 bytes:
+ *
+ * <pre>
+ * request:  token, main class, script name, number of args (4-byte), args...
+ * response: exit code (4-byte), stdout, stderr
+ * </pre>
+ *
+ * <p>Output of each call (including threads spawned by the tool) is captured
+ * separately, and {@code System.exit} called by the tool is trapped and reported
+ * as exit code.
+ *
+ * <p>OpenDJ tools share static state (and the script name system property), hence
+ * only one call runs at a time; a call received while another one is running is
+ * answered with {@link #BUSY} as exit code (and empty output) without running the
+ * tool, so the client can run it as a separate process instead.
+ */
+public class ToolServer {
+
+    /** State of a running call, inherited by threads spawned by the tool. */
+    private static final class Call {
+        final ByteArrayOutputStream out = new ByteArrayOutputStream();
+        final ByteArrayOutputStream err = new ByteArrayOutputStream();
+        volatile Integer exitStatus;
+    }
+
+    private static final class ExitTrapped extends SecurityException {
+        ExitTrapped(int status) {
+            super("System.exit(" + status + ") trapped");
+        }
+    }
+
+    private static final InheritableThreadLocal<Call> CALL = new InheritableThreadLocal<>();
+
+    /** Exit code reported when another call is running; never returned by tools. */
+    static final int BUSY = Integer.MIN_VALUE;
+
+    private static final ReentrantLock RUNNING = new ReentrantLock();
+
+    /** Routes writes to the output of current call, or to the original stream. */
+    private static final class DispatchStream extends OutputStream {
+        private final OutputStream fallback;
+        private final boolean stderr;
+
+        DispatchStream(OutputStream fallback, boolean stderr) {
+            this.fallback = fallback;
+            this.stderr = stderr;
+        }
+
+        private OutputStream target() {
+            Call call = CALL.get();
+            if (call == null) {
+                return fallback;
+            }
+            return stderr ? call.err : call.out;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            target().write(b);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            target().write(b, off, len);
+        }
+
+        @Override
+        public void flush() throws IOException {
+            target().flush();
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        if (args.length != 2) {
+            System.err.println("Usage: java ToolServer <port> <token-file>");
+            System.exit(2);
+        }
+        int port = Integer.parseInt(args[0]);
+        Path tokenFile = Paths.get(args[1]);
+
+        byte[] raw = new byte[32];
+        new SecureRandom().nextBytes(raw);
+        StringBuilder token = new StringBuilder();
+        for (byte b : raw) {
+            token.append(String.format("%02x", b));
+        }
+
+        System.setOut(new PrintStream(new DispatchStream(new FileOutputStream(FileDescriptor.out), false), true));
+        System.setErr(new PrintStream(new DispatchStream(new FileOutputStream(FileDescriptor.err), true), true));
+        System.setIn(new ByteArrayInputStream(new byte[0]));
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkPermission(Permission perm) {
+            }
+
+            @Override
+            public void checkPermission(Permission perm, Object context) {
+            }
+
+            @Override
+            public void checkExit(int status) {
+                Call call = CALL.get();
+                if (call != null) {
+                    call.exitStatus = status;
+                    throw new ExitTrapped(status);
+                }
+            }
+        });
+
+        ServerSocket server = new ServerSocket(port, 50, InetAddress.getLoopbackAddress());
+
+        // the token is written after the socket is bound, hence clients can treat it as readiness
+        Files.deleteIfExists(tokenFile);
+        Files.createFile(tokenFile, PosixFilePermissions.asFileAttribute(PosixFilePermissions.fromString("rw-------")));
+        Files.write(tokenFile, token.toString().getBytes(StandardCharsets.UTF_8));
+
+        byte[] expected = token.toString().getBytes(StandardCharsets.UTF_8);
+        ExecutorService executor = Executors.newCachedThreadPool();
+        while (true) {
+            Socket socket = server.accept();
+            executor.submit(() -> handle(socket, expected));
+        }
+    }
+
+    private static void handle(Socket socket, byte[] expected) {
+        try (Socket s = socket;
+             DataInputStream in = new DataInputStream(new BufferedInputStream(s.getInputStream()));
+             DataOutputStream out = new DataOutputStream(new BufferedOutputStream(s.getOutputStream()))) {
+            if (!MessageDigest.isEqual(expected, readBytes(in))) {
+                return;
+            }
+
+            String className = readString(in);
+            String scriptName = readString(in);
+            String[] toolArgs = new String[in.readInt()];
+            for (int i = 0; i < toolArgs.length; i++) {
+                toolArgs[i] = readString(in);
+            }
+
+            Call call = new Call();
+            int code = BUSY;
+            if (RUNNING.tryLock()) {
+                try {
+                    code = run(call, className, scriptName, toolArgs);
+                } finally {
+                    RUNNING.unlock();
+                }
+            }
+
+            out.writeInt(code);
+            writeBytes(out, call.out.toByteArray());
+            writeBytes(out, call.err.toByteArray());
+        } catch (IOException exc) {
+            System.err.println("Unable to handle tool call; reason=" + exc);
+        }
+    }
+
+    private static int run(Call call, String className, String scriptName, String[] args) {
+        CALL.set(call);
+        try {
+            // used by OpenDJ tools in usage and error messages
+            System.setProperty("org.opends.server.scriptName", scriptName);
+
+            Method main = Class.forName(className).getMethod("main", String[].class);
+            main.invoke(null, (Object) args);
+            return call.exitStatus != null ? call.exitStatus : 0;
+        } catch (InvocationTargetException exc) {
+            // the tool may wrap or rethrow the exception thrown on exit
+            if (call.exitStatus != null) {
+                return call.exitStatus;
+            }
+            exc.getCause().printStackTrace();
+            return 1;
+        } catch (ReflectiveOperationException exc) {
+            exc.printStackTrace();
+            return 1;
+        } finally {
+            System.out.flush();
+            System.err.flush();
+            CALL.remove();
+        }
+    }
+
+    private static byte[] readBytes(DataInputStream in) throws IOException {
+        byte[] data = new byte[in.readInt()];
+        in.readFully(data);
+        return data;
+    }
+
+    private static String readString(DataInputStream in) throws IOException {
+        return new String(readBytes(in), StandardCharsets.UTF_8);
+    }
+
+    private static void writeBytes(DataOutputStream out, byte[] data) throws IOException {
+        out.writeInt(data.length);
+        out.write(data);
+    }
+}